@@ -18,7 +18,10 @@ import msgvis.apps.corpus.models as corpus_models
 import msgvis.apps.questions.models as questions_models
 import msgvis.apps.enhance.models as enhance_models
 import msgvis.apps.groups.models as groups_models
+from msgvis.apps.groups import bitmaps
+from msgvis.apps.corpus import fulltext
 from msgvis.apps.dimensions import registry
+from msgvis.apps.datatable import measures
 from django.contrib.auth.models import User
 
 # A simple string field that looks up dimensions on deserialization
@@ -30,6 +33,18 @@ class DimensionKeySerializer(serializers.CharField):
         return instance.key
 
 
+# A simple string field that looks up measures on deserialization
+class MeasureKeySerializer(serializers.CharField):
+    def to_internal_value(self, data):
+        try:
+            return measures.get_measure(data)
+        except KeyError:
+            raise serializers.ValidationError("Unknown measure: %s" % data)
+
+    def to_representation(self, instance):
+        return instance.key
+
+
 class DimensionSerializer(serializers.Serializer):
     """
     JSON representation of Dimensions for the API.
@@ -215,12 +230,20 @@ class ExampleMessageSerializer(serializers.Serializer):
     focus = serializers.ListField(child=FilterSerializer(), required=False)
     #messages = serializers.ListField(child=MessageSerializer(), required=False, read_only=True)
     groups = serializers.ListField(child=serializers.IntegerField(), required=False)
+    cursor = serializers.DictField(required=False)
+    next_cursor = serializers.DictField(required=False, read_only=True)
     messages = serializers.SerializerMethodField('paginated_messages')
     def paginated_messages(self, obj):
         request = self.context.get('request')
         messages_per_page = 10
         page = 1
 
+        if isinstance(obj["messages"], list):
+            # examples from groups are already one page, with a cursor for the next
+            paginator = Paginator(obj["messages"], max(len(obj["messages"]), 1))
+            serializer = PaginatedMessageSerializer(paginator.page(1))
+            return serializer.data
+
         if request and request.query_params.get('page'):
             page = request.query_params.get('page')
         if request and request.query_params.get('messages_per_page'):
@@ -238,6 +261,7 @@ class KeywordMessageSerializer(serializers.Serializer):
     keywords = serializers.CharField(allow_null=True, allow_blank=True, required=False)
     messages = serializers.SerializerMethodField('paginated_messages')
     types_list = serializers.ListField(child=serializers.CharField(), required=False)
+    mode = serializers.ChoiceField(choices=fulltext.MODES, required=False)
 
     def paginated_messages(self, obj):
         request = self.context.get('request')
@@ -277,9 +301,34 @@ class GroupSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = groups_models.Group
-        fields = ('id', 'owner', 'order', 'created_at', 'dataset', 'name', 'keywords', 'messages', 'message_count', 'include_types', 'types_list', 'is_search_record', )
+        fields = ('id', 'owner', 'order', 'created_at', 'dataset', 'name', 'keywords', 'expression', 'messages', 'message_count', 'include_types', 'types_list', 'is_search_record', )
         read_only_fields = ('owner', 'order', 'created_at', )
 
+    def validate_expression(self, value):
+        if value:
+            try:
+                bitmaps.parse_expression(value)
+            except ValueError as e:
+                raise serializers.ValidationError(str(e))
+        return value
+
+    def validate(self, attrs):
+        # the groups of an expression must belong to the owner of the group being saved
+        if attrs.get('expression'):
+            group_id = self.initial_data.get('id')
+            if group_id is not None:
+                owner_id = groups_models.Group.objects.filter(id=group_id).values_list('owner_id', flat=True).first()
+            else:
+                request = self.context.get('request')
+                owner_id = request.user.id if request is not None else None
+
+            try:
+                bitmaps.check_expression(attrs['expression'], attrs['dataset'].id, owner_id,
+                                         int(group_id) if group_id is not None else None)
+            except ValueError as e:
+                raise serializers.ValidationError({'expression': [str(e)]})
+        return attrs
+
     def paginated_messages(self, obj):
         if self.context and self.context.get('show_message'):
             paginator = Paginator(obj.messages.all(), 10)
@@ -301,6 +350,9 @@ class GroupSerializer(serializers.ModelSerializer):
         if validated_data.get('keywords'):
             group.keywords = validated_data.get('keywords')
             group.save()
+        if validated_data.get('expression'):
+            group.expression = validated_data.get('expression')
+            group.save()
         if validated_data.get('types_list'):
             include_types = [corpus_models.MessageType.objects.get(name=x) for x in validated_data.get('types_list')]
             group.include_types = include_types
@@ -311,6 +363,32 @@ class GroupSerializer(serializers.ModelSerializer):
 
         return group
 
+class GroupDefinitionSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=250, allow_blank=True, required=False)
+    keywords = serializers.CharField(allow_blank=True, required=False)
+    types_list = serializers.ListField(child=serializers.CharField(), required=False)
+
+    def validate_types_list(self, value):
+        known = set(corpus_models.MessageType.objects.filter(name__in=value).values_list('name', flat=True))
+        unknown = [name for name in value if name not in known]
+        if len(unknown) > 0:
+            raise serializers.ValidationError("Unknown message types: %s" % ", ".join(unknown))
+        return value
+
+
+class GroupBatchSerializer(serializers.Serializer):
+    dataset = serializers.PrimaryKeyRelatedField(queryset=corpus_models.Dataset.objects.all())
+    groups = GroupDefinitionSerializer(many=True)
+
+
+class GroupOverlapSerializer(serializers.Serializer):
+    dataset = serializers.IntegerField(required=True)
+    groups = serializers.ListField(child=serializers.IntegerField())
+    counts = serializers.ListField(child=serializers.IntegerField())
+    overlap = serializers.ListField(child=serializers.ListField(child=serializers.IntegerField()))
+    jaccard = serializers.ListField(child=serializers.ListField(child=serializers.FloatField()))
+
+
 class DatasetSerializer(serializers.ModelSerializer):
 
     class Meta:
@@ -336,6 +414,20 @@ class DataTableSerializer(serializers.Serializer):
     search_key = serializers.CharField(allow_null=True, allow_blank=True, required=False)
     mode = serializers.CharField(allow_null=True, allow_blank=True, required=False)
     groups = serializers.ListField(child=serializers.IntegerField(), required=False)
+    measure = MeasureKeySerializer(required=False)
+    approximate = serializers.BooleanField(required=False)
+    sample_rate = serializers.FloatField(required=False)
+    explain = serializers.BooleanField(required=False)
+    diagnostics = serializers.DictField(required=False, read_only=True)
+    plan = serializers.DictField(required=False, read_only=True)
+
+class FacetsSerializer(serializers.Serializer):
+    dataset = serializers.PrimaryKeyRelatedField(queryset=corpus_models.Dataset.objects.all())
+    dimensions = serializers.ListField(child=DimensionKeySerializer())
+    filters = serializers.ListField(child=FilterSerializer(), required=False)
+    exclude = serializers.ListField(child=FilterSerializer(), required=False)
+    limit = serializers.IntegerField(required=False, min_value=1)
+    result = serializers.DictField(required=False, read_only=True)
 
 class ActionHistorySerializer(serializers.ModelSerializer):
     created_at = serializers.DateTimeField(required=False)
@@ -9,6 +9,7 @@ from msgvis.apps.corpus import models as corpus_models
 from msgvis.apps.corpus import utils as corpus_utils
 from msgvis.apps.questions import models as questions_models
 from msgvis.apps.dimensions import models as dimensions_models
+from msgvis.apps.dimensions import registry
 import mock
 
 from msgvis.apps.api.tests import api_time_format, django_time_format
@@ -171,6 +172,13 @@ class ExampleMessagesViewTest(APITestCase):
 
         self.assertEquals(get_example_messages.call_count, 1)
 
+    def test_invalid_messages_per_page(self):
+        url = reverse('example-messages')
+        data = {"dataset": self.dataset.id, "groups": []}
+        for messages_per_page in ['ten', '0']:
+            response = self.client.post(url + '?messages_per_page=' + messages_per_page, data, format='json')
+            self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
 
 class DataTableViewTest(APITestCase):
     def setUp(self):
@@ -197,15 +205,15 @@ class DataTableViewTest(APITestCase):
     @mock.patch('msgvis.apps.api.serializers.DataTableSerializer')
     @mock.patch('msgvis.apps.datatable.models.DataTable')
     def test_get_datatable_api(self, DataTable, DataTableSerializer):
-        # Fake dimensions and filters
-        dimensions = [mock.Mock()]
+        # Fake filters
+        dimensions = [registry.get_dimension('time')]
         filters = mock.Mock()
 
         # Fake serialization
         serializer = DataTableSerializer.return_value
         serializer.is_valid.return_value = True
         serializer.validated_data = {
-            'dataset': self.dataset.id,
+            'dataset': self.dataset,
             'dimensions': dimensions,
             'filters': filters,
         }
@@ -218,7 +226,7 @@ class DataTableViewTest(APITestCase):
 
         # Should be sending us back the same thing we sent in plus some extra
         expected_response = {
-            'dataset': self.dataset.id,
+            'dataset': self.dataset,
             "dimensions": dimensions,
             "filters": filters,
             "result": datatable.generate.return_value,
@@ -237,6 +245,8 @@ class DataTableViewTest(APITestCase):
         # It should have constructed a serializer using the request data
         # And also with the response data
         DataTableSerializer.assert_any_call(data=request_data)
+        response_data = DataTableSerializer.call_args[0][0]
+        self.assertEquals(response_data.pop('plan')['strategy'], 'live')
         DataTableSerializer.assert_any_call(expected_response)
 
         # It should have checked for validity of input
@@ -250,3 +260,131 @@ class DataTableViewTest(APITestCase):
         #datatable.generate.assert_called_once_with(self.dataset.id, filters, [], 30, None, None, None )
 
         # TODO: write tests for paging and searching
+
+
+class GroupOverlapViewTest(APITestCase):
+    def setUp(self):
+        import tempfile
+        from msgvis.apps.groups import models as groups_models
+
+        self.precalc_root = tempfile.mkdtemp()
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        self.dataset.message_set.create(text="soup")
+        self.groups = [groups_models.Group.objects.create(dataset=self.dataset, name=name, keywords=name, order=i)
+                       for i, name in enumerate(['soup', 'food'])]
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.precalc_root)
+
+    def test_get_group_overlap_api(self):
+        from django.test.utils import override_settings
+
+        url = reverse('group-overlap')
+        with override_settings(PRECALC_ROOT=self.precalc_root):
+            response = self.client.get(url, {'dataset': self.dataset.id}, format='json')
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['groups'], [group.id for group in self.groups])
+        self.assertEquals(response.data['overlap'], [[0, 0], [0, 0]])
+
+        response = self.client.get(url, format='json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class GroupExpressionViewTest(APITestCase):
+    def setUp(self):
+        from msgvis.apps.groups import models as groups_models
+
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        other_dataset = corpus_models.Dataset.objects.create(name="Other Corpus", description="My Dataset")
+        self.soup = groups_models.Group.objects.create(dataset=self.dataset, name="soup", keywords="soup")
+        self.derived = groups_models.Group.objects.create(dataset=self.dataset, name="derived",
+                                                          expression="#%d" % self.soup.id)
+        self.other = groups_models.Group.objects.create(dataset=other_dataset, name="other", keywords="soup")
+
+    def test_invalid_expressions(self):
+        """Expressions with missing groups, groups of other datasets, or cycles should be rejected"""
+        url = reverse('group')
+        data = {'dataset': self.dataset.id, 'name': 'new', 'keywords': ''}
+        for expression in ["#%d" % (self.other.id + 1), "#%d | #%d" % (self.soup.id, self.other.id)]:
+            data['expression'] = expression
+            response = self.client.post(url, data, format='json')
+            self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn('expression', response.data)
+
+        data['id'] = self.soup.id
+        for expression in ["#%d" % self.soup.id, "#%d" % self.derived.id]:
+            data['expression'] = expression
+            response = self.client.put(url, data, format='json')
+            self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        data['id'] = self.derived.id
+        data['expression'] = "#%d - #%d" % (self.soup.id, self.soup.id)
+        response = self.client.put(url, data, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+
+class GroupBatchViewTest(APITestCase):
+    def setUp(self):
+        import tempfile
+
+        self.precalc_root = tempfile.mkdtemp()
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.precalc_root)
+
+    def test_create_groups_api(self):
+        from django.test.utils import override_settings
+
+        url = reverse('group-batch')
+        data = {
+            'dataset': self.dataset.id,
+            'groups': [{'name': 'soup', 'keywords': 'soup'}, {'name': 'food', 'keywords': 'food,soup'}],
+        }
+        with override_settings(PRECALC_ROOT=self.precalc_root):
+            response = self.client.post(url, data, format='json')
+
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals([group['name'] for group in response.data], ['soup', 'food'])
+        self.assertEquals([group['message_count'] for group in response.data], [0, 0])
+
+        data['groups'][0]['types_list'] = ['missing']
+        response = self.client.post(url, data, format='json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class KeywordViewTest(APITestCase):
+    def setUp(self):
+        import tempfile
+        from msgvis.apps.enhance import models as enhance_models
+
+        self.precalc_root = tempfile.mkdtemp()
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        for level, count in [('super', 5), ('superbowl', 7)]:
+            enhance_models.PrecalcCategoricalDistribution.objects.create(dataset=self.dataset, dimension_key='words',
+                                                                         level=level, count=count)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.precalc_root)
+
+    def get_keywords(self, q):
+        response = self.client.get(reverse('keyword'), {'dataset': self.dataset.id, 'q': q}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        return [keyword['text'] for keyword in response.data['keywords']]
+
+    def test_completions_match_fallback(self):
+        """The saved completions and the database should complete phrases the same way"""
+        from django.test.utils import override_settings
+        from msgvis.apps.enhance import tasks
+
+        with override_settings(PRECALC_ROOT=self.precalc_root):
+            fallback = [self.get_keywords(q) for q in ["sup", "big sup"]]
+            tasks.build_completions(self.dataset.id)
+            completed = [self.get_keywords(q) for q in ["sup", "big sup"]]
+
+        self.assertEquals(fallback, [['superbowl', 'super'], ['big superbowl', 'big super']])
+        self.assertEquals(completed, fallback)
@@ -5,10 +5,13 @@ from django.views.decorators.csrf import csrf_exempt
 
 api_root_urls = {
     'data-tables': url(r'^table/$', views.DataTableView.as_view(), name='data-table'),
+    'facets': url(r'^facets/$', views.FacetsView.as_view(), name='facets'),
     'example-messages': url(r'^message/$', views.ExampleMessagesView.as_view(), name='example-messages'),
     'keyword-messages': url(r'^search/$', views.KeywordMessagesView.as_view(), name='keyword-messages'),
     'keyword': url(r'^keyword/$', views.KeywordView.as_view(), name='keyword'),
     'group': url(r'^group/$', csrf_exempt(views.GroupView.as_view()), name='group'),
+    'group-batch': url(r'^group/batch/$', csrf_exempt(views.GroupBatchView.as_view()), name='group-batch'),
+    'group-overlap': url(r'^group/overlap/$', views.GroupOverlapView.as_view(), name='group-overlap'),
     'research-questions': url(r'^questions/$', views.ResearchQuestionsView.as_view(), name='research-questions'),
     'action-history': url(r'^history/$', views.ActionHistoryView.as_view(), name='action-history'),
     'dataset': url(r'^dataset/$', csrf_exempt(views.DatasetView.as_view()), name='dataset'),
@@ -1,21 +1,26 @@
 """
 The view classes below define the API endpoints.
 
-+-----------------------------------------------------------------+-----------------+-------------------------------------------------+
-| Endpoint                                                        | Url             | Purpose                                         |
-+=================================================================+=================+=================================================+
-| :class:`Get Data Table <DataTableView>`                         | /api/table      | Get table of counts based on dimensions/filters |
-+-----------------------------------------------------------------+-----------------+-------------------------------------------------+
-| :class:`Get Example Messages <ExampleMessagesView>`             | /api/messages   | Get example messages for slice of data          |
-+-----------------------------------------------------------------+-----------------+-------------------------------------------------+
-| :class:`Get Research Questions <ResearchQuestionsView>`         | /api/questions  | Get RQs related to dimensions/filters           |
-+-----------------------------------------------------------------+-----------------+-------------------------------------------------+
-| Message Context                                                 | /api/context    | Get context for a message                       |
-+-----------------------------------------------------------------+-----------------+-------------------------------------------------+
-| Snapshots                                                       | /api/snapshots  | Save a visualization snapshot                   |
-+-----------------------------------------------------------------+-----------------+-------------------------------------------------+
++-----------------------------------------------------------------+--------------------+-------------------------------------------------+
+| Endpoint                                                        | Url                | Purpose                                         |
++=================================================================+====================+=================================================+
+| :class:`Get Data Table <DataTableView>`                         | /api/table         | Get table of counts based on dimensions/filters |
++-----------------------------------------------------------------+--------------------+-------------------------------------------------+
+| :class:`Get Facets <FacetsView>`                                | /api/facets        | Get distributions of many dimensions at once    |
++-----------------------------------------------------------------+--------------------+-------------------------------------------------+
+| :class:`Create Groups <GroupBatchView>`                         | /api/group/batch   | Create many keyword groups at once              |
++-----------------------------------------------------------------+--------------------+-------------------------------------------------+
+| :class:`Get Group Overlap <GroupOverlapView>`                   | /api/group/overlap | Get the pairwise overlap of a user's groups     |
++-----------------------------------------------------------------+--------------------+-------------------------------------------------+
+| :class:`Get Example Messages <ExampleMessagesView>`             | /api/messages      | Get example messages for slice of data          |
++-----------------------------------------------------------------+--------------------+-------------------------------------------------+
+| :class:`Get Research Questions <ResearchQuestionsView>`         | /api/questions     | Get RQs related to dimensions/filters           |
++-----------------------------------------------------------------+--------------------+-------------------------------------------------+
+| Message Context                                                 | /api/context       | Get context for a message                       |
++-----------------------------------------------------------------+--------------------+-------------------------------------------------+
+| Snapshots                                                       | /api/snapshots     | Save a visualization snapshot                   |
++-----------------------------------------------------------------+--------------------+-------------------------------------------------+
 """
-import types
 from django.db import transaction
 
 from rest_framework import status
@@ -30,12 +35,19 @@ from django.contrib.auth.models import User
 
 from msgvis.apps.api import serializers
 from msgvis.apps.corpus import models as corpus_models
+from msgvis.apps.corpus import keywords as keywords_module
+from msgvis.apps.corpus import fulltext
 from msgvis.apps.questions import models as questions_models
 from msgvis.apps.datatable import models as datatable_models
+from msgvis.apps.datatable import diagnostics
+from msgvis.apps.datatable import planner
 from msgvis.apps.enhance import models as enhance_models
+from msgvis.apps.enhance.completions import Completions, split_phrase
 import msgvis.apps.groups.models as groups_models
+from msgvis.apps.groups import bitmaps as group_bitmaps
 import json
 import logging
+from time import time
 
 logger = logging.getLogger(__name__)
 
@@ -53,7 +65,10 @@ class DataTableView(APIView):
 
     The request should post a JSON object containing a list of one or two
     dimension ids and a list of filters. A ``measure`` may also be specified
-    in the request, but the default measure is message count.
+    in the request, but the default measure is message count. The other measures
+    are ``share_count``, ``reply_count``, ``mean_sentiment``, ``sender_count`` and
+    ``hashtag_count``. ``sender_count_approx`` and ``hashtag_count_approx`` estimate
+    the distinct counts with HyperLogLog sketches and mark the result ``approximate``.
 
     The response will be a JSON object that mimics the request body, but
     with a new ``result`` field added. The result field
@@ -69,6 +84,24 @@ class DataTableView(APIView):
     defines the list of possible values within the selected data
     for each of the dimensions in the request.
 
+    If ``approximate`` is true and a sample of the dataset has been drawn
+    (see the ``build_message_sample`` command), only the sampled messages are
+    counted. The values are scaled up by the sampling rate, each table row gets an
+    ``error`` (the half-width of a 95% confidence interval) and the result
+    includes ``approximate`` and ``sample_rate``. A ``sample_rate`` in the request
+    picks the sample with the closest rate. Exact precalculated counts take
+    precedence over the sample when they can answer the request.
+
+    The response's ``plan`` describes how the table was calculated: the ``strategy``
+    (``precalc``, ``rollup``, ``cached``, ``live`` or ``sample``) that was chosen as the cheapest
+    accurate enough one, its estimated ``cost`` in rows read, and the other ``candidates``.
+
+    If ``explain`` is true, the response includes ``diagnostics``: the duration of the
+    request and every SQL statement it ran, with its parameters, time, row count and
+    the database's query plan. Requests slower than ``DATATABLE_SLOW_REQUEST_SECONDS``
+    are written to ``logs/slow_tables.log`` and can be replayed with the
+    ``replay_table_request`` command.
+
     This is the most general output format for results, but later we may
     switch to a more compact format.
 
@@ -124,40 +157,34 @@ class DataTableView(APIView):
         input = serializers.DataTableSerializer(data=request.data)
         if input.is_valid():
             data = input.validated_data
-
-            dataset = data['dataset']
-            dimensions = data['dimensions']
-            filters = data.get('filters', [])
-            exclude = data.get('exclude', [])
-            search_key = data.get('search_key')
-            mode = data.get('mode')
-            groups = data.get('groups', [])
-            if len(groups) == 0:
-                groups = None
-
-            page_size = 100
-            page = None
-            if data.get('page_size'):
-                page_size = data.get('page_size')
-                page_size = max(1, int(data.get('page_size')))
-            if data.get('page'):
-                page = max(1, int(data.get('page')))
-
-            if type(filters) == types.ListType and len(filters) == 0 and \
-               type(exclude) == types.ListType and len(exclude) == 0 and len(dimensions) == 1 and dimensions[0].is_categorical():
-                result = dataset.get_precalc_distribution(dimension=dimensions[0], search_key=search_key, page=page, page_size=page_size, mode=mode)
-
+            explain = data.get('explain', False)
+
+            table_request = planner.TableRequest(data)
+
+            started = time()
+            queries = None
+            if explain:
+                # record the statements and their query plans
+                with diagnostics.QueryCapture() as capture:
+                    result, plan = planner.generate(table_request)
+                    diagnostics.evaluate_result(result)
+                capture.explain()
+                queries = capture.get_report()
             else:
+                result, plan = planner.generate(table_request)
+            duration = time() - started
 
-                datatable = datatable_models.DataTable(*dimensions)
-                if mode is not None:
-                    datatable.set_mode(mode)
-
-                result = datatable.generate(dataset, filters, exclude, page_size, page, search_key, groups)
+            diagnostics.log_slow_request(request.data, duration, queries)
 
             # Just add the result key
             response_data = data
             response_data['result'] = result
+            response_data['plan'] = plan
+            if explain:
+                response_data['diagnostics'] = {
+                    'duration': round(duration, 4),
+                    'queries': queries,
+                }
 
             output = serializers.DataTableSerializer(response_data)
             return Response(output.data, status=status.HTTP_200_OK)
@@ -165,6 +192,63 @@ class DataTableView(APIView):
         return Response(input.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class FacetsView(APIView):
+    """
+    Get the distributions of several dimensions under the same filters,
+    e.g. for the filter panel, in one request instead of one per dimension.
+
+    The filtered messages are found once and every dimension is counted
+    against them. Categorical dimensions include their ``limit`` (default 10)
+    most frequent levels, and ``levels`` gives the total number of levels.
+
+    **Request:** ``POST /api/facets``
+
+    **Format:** (request without ``result`` key)
+
+    ::
+
+        {
+          "dataset": 1,
+          "dimensions": ["hashtags", "sender", "time"],
+          "filters": [
+            {
+              "dimension": "contains_url",
+              "value": true
+            }
+          ],
+          "limit": 10,
+          "result": {
+            "hashtags": {
+              "table": [{"hashtags": "superbowl", "value": 523}, ...],
+              "domains": {"hashtags": ["superbowl", ...]},
+              "domain_labels": {},
+              "levels": 1210
+            },
+            ...
+          }
+        }
+    """
+
+    def post(self, request, format=None):
+        input = serializers.FacetsSerializer(data=request.data)
+        if input.is_valid():
+            data = input.validated_data
+
+            limit = data.get('limit') or datatable_models.MAX_CATEGORICAL_LEVELS
+            result = datatable_models.generate_facets(data['dataset'], data['dimensions'],
+                                                      filters=data.get('filters', []),
+                                                      exclude=data.get('exclude', []),
+                                                      limit=limit)
+
+            response_data = data
+            response_data['result'] = result
+
+            output = serializers.FacetsSerializer(response_data)
+            return Response(output.data, status=status.HTTP_200_OK)
+
+        return Response(input.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
 class ExampleMessagesView(APIView):
     """
     Get some example messages matching the current filters and a focus
@@ -207,6 +291,9 @@ class ExampleMessagesView(APIView):
                 }
             ]
         }
+
+    If the request has a list of ``groups``, the messages are taken from each group in turn.
+    Send the ``next_cursor`` of the response back as ``cursor`` to get the next page.
     """
 
     def post(self, request, format=None):
@@ -222,13 +309,24 @@ class ExampleMessagesView(APIView):
             focus = data.get('focus', [])
             groups = data.get('groups')
 
+            # Just add the messages key to the response
+            response_data = data
+
             if groups is None:
                 example_messages = dataset.get_example_messages(filters + focus, excludes)
             else:
-                example_messages = dataset.get_example_messages_by_groups(groups, filters + focus, excludes)
+                try:
+                    page_size = int(request.query_params.get('messages_per_page', 10))
+                except ValueError:
+                    page_size = 0
+                if page_size < 1:
+                    return Response({'messages_per_page': ["A positive number is required."]},
+                                    status=status.HTTP_400_BAD_REQUEST)
+                example_messages, next_cursor = dataset.get_example_messages_by_groups(groups, filters + focus, excludes,
+                                                                                       cursor=data.get('cursor'),
+                                                                                       page_size=page_size)
+                response_data["next_cursor"] = next_cursor
 
-            # Just add the messages key to the response
-            response_data = data
             response_data["messages"] = example_messages
 
             output = serializers.ExampleMessageSerializer(response_data, context={'request': request})
@@ -244,6 +342,10 @@ class KeywordMessagesView(APIView):
 
     **Format:**: (request should not have ``messages`` key)
 
+    With a ``mode`` of ``phrase``, ``prefix`` or ``substring``, the keywords are
+    searched for in the message text instead, best matches first
+    (see :mod:`msgvis.apps.corpus.fulltext`).
+
     ::
 
         {
@@ -281,7 +383,13 @@ class KeywordMessagesView(APIView):
             if len(types_list) > 0:
                 include_types = [corpus_models.MessageType.objects.get(name=x) for x in types_list]
 
-            messages = dataset.get_advanced_search_results(keywords, include_types)
+            if data.get('mode'):
+                # phrases, prefixes and substrings of the text itself
+                messages = fulltext.get_backend().search(dataset, keywords, data['mode'], include_types)
+            else:
+                # refining the session's previous searches is cheaper than searching again
+                history = keywords_module.get_search_history(request.session.session_key)
+                messages = dataset.search_messages(keywords, include_types, history=history)
 
             # Just add the messages key to the response
             response_data = data
@@ -374,7 +482,7 @@ class GroupView(APIView):
 
     def post(self, request, format=None):
         add_history(self.request.user, 'group:create', request.data)
-        input = serializers.GroupSerializer(data=request.data)
+        input = serializers.GroupSerializer(data=request.data, context={'request': request})
         if input.is_valid():
             data = input.validated_data
             group = input.save()
@@ -405,7 +513,8 @@ class GroupView(APIView):
             if user.id is not None and User.objects.filter(id=1).count() != 0:
                 owner = User.objects.get(id=self.request.user.id)
                 groups = groups.filter(owner=owner)
-            groups = groups.order_by('order', 'created_at').all()
+            # the message counts are stored with the groups
+            groups = groups.order_by('order', 'created_at').prefetch_related('include_types')
             output = serializers.GroupSerializer(groups, many=True)
             return Response(output.data, status=status.HTTP_200_OK)
         elif request.query_params.get('group_id'):
@@ -421,7 +530,7 @@ class GroupView(APIView):
 
     def put(self, request, format=None):
         add_history(self.request.user, 'group:update', request.data)
-        input = serializers.GroupSerializer(data=request.data)
+        input = serializers.GroupSerializer(data=request.data, context={'request': request})
         if input.is_valid():
             data = input.validated_data
             group = groups_models.Group.objects.get(id=request.data["id"])
@@ -431,12 +540,16 @@ class GroupView(APIView):
             if data.get('keywords') is not None:
                 group.keywords = data.get('keywords')
                 group.save()
+            if data.get('expression') is not None:
+                group.expression = data.get('expression')
+                group.save()
 
             if data.get('types_list') is not None:
                 type_list = data.get('types_list')
                 include_types = map(lambda x: corpus_models.MessageType.objects.get(name=x), type_list)
                 group.include_types.clear()
                 group.include_types = include_types
+                group.invalidate_message_count()
 
 
             output = serializers.GroupSerializer(group, context={'request': request, 'show_message': False})
@@ -454,6 +567,82 @@ class GroupView(APIView):
             return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class GroupBatchView(APIView):
+    """
+    Create many keyword groups at once. Their queries are evaluated together,
+    and the groups are saved with their message counts in one transaction.
+
+    **Request:** ``POST /api/group/batch``
+
+    **Format:**: (the response is a list of groups, like ``GET /api/group?dataset=1``)
+
+    ::
+
+        {
+            "dataset": 1,
+            "groups": [
+                {"name": "soup", "keywords": "soup ladies,NOT job"},
+                {"name": "food", "keywords": "food,soup", "types_list": ["tweet", "reply"]}
+            ]
+        }
+    """
+
+    def post(self, request, format=None):
+        add_history(self.request.user, 'group:create-batch', request.data)
+        input = serializers.GroupBatchSerializer(data=request.data)
+        if input.is_valid():
+            data = input.validated_data
+
+            owner = None
+            user = self.request.user
+            if user.id is not None and User.objects.filter(id=1).count() != 0:
+                owner = User.objects.get(id=self.request.user.id)
+
+            groups = groups_models.Group.create_batch(data['dataset'], data['groups'], owner=owner)
+
+            output = serializers.GroupSerializer(groups, many=True, context={'request': request, 'show_message': False})
+            return Response(output.data, status=status.HTTP_200_OK)
+
+        return Response(input.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class GroupOverlapView(APIView):
+    """
+    Get the size of each of the user's groups in a dataset,
+    and the overlap and Jaccard index of every pair of them.
+
+    **Request:** ``GET /api/group/overlap?dataset=1``
+
+    ::
+
+        {
+            "dataset": 1,
+            "groups": [3, 4, 7],
+            "counts": [1520, 1315, 80],
+            "overlap": [[1520, 213, 0], [213, 1315, 12], [0, 12, 80]],
+            "jaccard": [[1.0, 0.081, 0.0], [0.081, 1.0, 0.009], [0.0, 0.009, 1.0]]
+        }
+    """
+
+    def get(self, request, format=None):
+        if request.query_params.get('dataset'):
+            add_history(self.request.user, 'group:get-overlap', request.query_params)
+            dataset_id = int(request.query_params.get('dataset'))
+            groups = groups_models.Group.objects.filter(dataset_id=dataset_id, deleted=False, is_search_record=False)
+            user = self.request.user
+            if user.id is not None and User.objects.filter(id=1).count() != 0:
+                owner = User.objects.get(id=self.request.user.id)
+                groups = groups.filter(owner=owner)
+            groups = groups.order_by('order', 'created_at').all()
+
+            response_data = group_bitmaps.overlap_matrix(groups)
+            response_data['dataset'] = dataset_id
+            output = serializers.GroupOverlapSerializer(response_data)
+            return Response(output.data, status=status.HTTP_200_OK)
+
+        return Response(status=status.HTTP_400_BAD_REQUEST)
+
+
 class KeywordView(APIView):
     """
     Get top 10 keyword results.
@@ -478,22 +667,27 @@ class KeywordView(APIView):
                 "dataset": dataset_id
             }
 
+            completions = Completions.load(int(dataset_id))
+
             if request.query_params.get('q') is None:
-                keywords = enhance_models.TweetWord.objects.filter(dataset_id=dataset_id).values('text').distinct()[:20]
+                if completions is not None:
+                    keywords = [{"text": word} for word, count in completions.complete("")]
+                else:
+                    keywords = enhance_models.Lemma.objects.filter(dataset_id=dataset_id).values('text')[:20]
                 response_data["keywords"] = keywords
                 output = serializers.KeywordListSerializer(response_data)
             else:
                 q = request.query_params.get('q')
                 response_data["q"] = q
 
-                strings = q.split(' ')
-                prefix = " ".join(strings[:-1]) + " "
-                keyword = strings[-1]
-                keywords = enhance_models.PrecalcCategoricalDistribution.objects.filter(dataset_id=dataset_id,
-                                                                                        dimension_key="words",
-                                                                                        level__istartswith=keyword).order_by('-count')
-
-                response_data["keywords"] = map(lambda x: prefix + x.level, keywords[:20])
+                if completions is not None:
+                    response_data["keywords"] = completions.complete_phrase(q)
+                else:
+                    prefix, keyword = split_phrase(q)
+                    keywords = enhance_models.PrecalcCategoricalDistribution.objects.filter(dataset_id=dataset_id,
+                                                                                            dimension_key="words",
+                                                                                            level__istartswith=keyword).order_by('-count')
+                    response_data["keywords"] = map(lambda x: prefix + x.level, keywords[:20])
                 output = serializers.KeywordListSerializer(response_data)
 
                 for idx, keyword in enumerate(output.data['keywords']):
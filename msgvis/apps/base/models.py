@@ -21,15 +21,24 @@ class MappedValuesQuerySet(query.ValuesQuerySet):
     def __init__(self, *args, **kwargs):
         super(MappedValuesQuerySet, self).__init__(*args, **kwargs)
         self.field_map = kwargs.get('field_map', {})
+        self.converters = kwargs.get('converters', {})
 
     @classmethod
-    def create_from(cls, values_query_set, field_map):
-        """Create a MappedValueQuerySet with a field name mapping dictionary."""
-        return values_query_set._clone(cls, field_map=field_map)
+    def create_from(cls, values_query_set, field_map, converters=None):
+        """
+        Create a MappedValueQuerySet with a field name mapping dictionary.
+        Optionally, converters maps (new) field names to functions applied to their values.
+        """
+        if isinstance(values_query_set, MappedValuesQuerySet):
+            # combine with the existing mapping
+            field_map = dict(values_query_set.field_map, **field_map)
+            converters = dict(values_query_set.converters, **(converters or {}))
+        return values_query_set._clone(cls, field_map=field_map, converters=converters or {})
 
     def _clone(self, klass=None, setup=False, **kwargs):
         c = super(MappedValuesQuerySet, self)._clone(klass, setup, **kwargs)
-        c.field_map = self.field_map
+        c.field_map = kwargs.get('field_map', self.field_map)
+        c.converters = kwargs.get('converters', self.converters)
         return c
 
     def iterator(self):
@@ -44,7 +53,34 @@ class MappedValuesQuerySet(query.ValuesQuerySet):
         names = [self.field_map.get(name, name) for name in names]
 
         for row in self.query.get_compiler(self.db).results_iter():
-            yield dict(zip(names, row))
+            row = dict(zip(names, row))
+            for name, convert in self.converters.iteritems():
+                if name in row:
+                    row[name] = convert(row[name])
+            yield row
+
+
+class InTemporaryTable(models.Lookup):
+    """
+    A lookup for values listed in the level column of a temporary table,
+    e.g. ``hashtags__text__in_temporary_table='level_filter_1a2b'``.
+    See :func:`msgvis.apps.corpus.utils.levels_in_temp_table`.
+    """
+    lookup_name = 'in_temporary_table'
+
+    def get_prep_lookup(self):
+        # the right hand side is a table name
+        return self.rhs
+
+    def as_sql(self, qn, connection):
+        from msgvis.apps.corpus.utils import temp_table_reference
+
+        lhs, params = self.process_lhs(qn, connection)
+        quote_name = connection.ops.quote_name
+        table_name = temp_table_reference(self.rhs, connection)
+        return '%s IN (SELECT %s FROM %s)' % (lhs, quote_name('level'), quote_name(table_name)), params
+
+models.Field.register_lookup(InTemporaryTable)
 
 
 class CharsetFieldMixin(object):
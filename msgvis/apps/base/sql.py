@@ -0,0 +1,67 @@
+"""
+Compose raw SQL around querysets without turning their parameters into text.
+
+Some queries, such as a UNION of several querysets, cannot be written with the ORM.
+Instead of formatting ``str(queryset.query)`` (which inlines the values without
+proper quoting), compile each queryset into ``(sql, params)``, wrap the SQL
+in a template, and let the database driver bind the parameters.
+
+.. code-block:: python
+
+    sql, params = union([group_a_messages, group_b_messages])
+    messages = Message.objects.raw(sql, params)
+
+Templates that only depend on the models can be cached with :func:`cached_template`,
+so the SQL text for the same kind of request is identical every time.
+"""
+from django.db import connections
+
+_template_cache = {}
+
+
+def compile_queryset(queryset):
+    """The SQL and parameters of a queryset"""
+    return queryset.query.get_compiler(using=queryset.db).as_sql()
+
+
+def union(querysets):
+    """Combine the querysets with UNION, returning (sql, params)"""
+    parts = []
+    params = []
+    for i, queryset in enumerate(querysets):
+        sql, queryset_params = compile_queryset(queryset)
+        # sqlite does not accept a parenthesized SELECT in a UNION
+        parts.append("SELECT * FROM (%s) AS `union_%d`" % (sql, i))
+        params.extend(queryset_params)
+    return " UNION ".join(parts), tuple(params)
+
+
+def cached_template(key, build):
+    """
+    Return the template for the key, calling build() to make it the first time.
+    Templates contain a {query} placeholder for the wrapped SQL.
+    """
+    template = _template_cache.get(key)
+    if template is None:
+        template = _template_cache[key] = build()
+    return template
+
+
+def wrap(template, sql, params):
+    """Put the SQL into the template, returning (sql, params)"""
+    return template.format(query=sql), params
+
+
+def fetch_column(sql, params=(), using='default'):
+    """Run the query and return the values of the first column"""
+    cursor = connections[using].cursor()
+    cursor.execute(sql, params)
+    return [row[0] for row in cursor.fetchall()]
+
+
+def fetch_dicts(sql, params=(), using='default'):
+    """Run the query and return the rows as dictionaries"""
+    cursor = connections[using].cursor()
+    cursor.execute(sql, params)
+    names = [col[0] for col in cursor.description]
+    return [dict(zip(names, row)) for row in cursor.fetchall()]
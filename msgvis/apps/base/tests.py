@@ -316,4 +316,64 @@ class DistributionTestCaseMixins(object):
             distribution=author_distribution,
             dataset=dataset,
         )
+
+        # the messages only have sender ids, so copy the counters as the importer does
+        from django.db import connection
+        from msgvis.apps.corpus import utils
+        utils.refresh_sender_counters(connection, dataset.id)
+
         return author_distribution
+
+
+class PrecalcTestCaseMixins(object):
+    """
+    Utilities for testing searches and precalculated files.
+    Each test gets its own PRECALC_ROOT, which is deleted afterwards.
+    """
+
+    def setUp(self):
+        import tempfile
+        from django.test.utils import override_settings
+
+        super(PrecalcTestCaseMixins, self).setUp()
+        self.precalc_root = tempfile.mkdtemp()
+        self.precalc_settings = override_settings(PRECALC_ROOT=self.precalc_root)
+        self.precalc_settings.enable()
+
+    def tearDown(self):
+        import shutil
+
+        self.precalc_settings.disable()
+        shutil.rmtree(self.precalc_root)
+        super(PrecalcTestCaseMixins, self).tearDown()
+
+    def create_word_messages(self, dataset, spellings, texts):
+        """
+        Create a message for each of the texts, linked to the words it contains, and rebuild
+        the lemmas of the dataset. Spellings is a list of the words to index, or a dict
+        from each spelling to its normalized word. A text may be a (text, fields) tuple
+        to set other fields of its message. Returns the messages.
+        """
+        from django.db import connection
+        from msgvis.apps.enhance import models as enhance_models
+
+        if not isinstance(spellings, dict):
+            spellings = dict((text, text) for text in spellings)
+        words = dict((original_text, enhance_models.TweetWord.objects.create(dataset=dataset,
+                                                                            original_text=original_text,
+                                                                            text=text))
+                     for original_text, text in spellings.iteritems())
+
+        messages = []
+        for text in texts:
+            fields = {}
+            if isinstance(text, tuple):
+                text, fields = text
+            message = dataset.message_set.create(text=text, **fields)
+            for word in text.split(' '):
+                if word in words:
+                    words[word].messages.add(message)
+            messages.append(message)
+
+        enhance_models.Lemma.rebuild(connection, dataset.id)
+        return messages
@@ -0,0 +1,20 @@
+"""
+Helpers for the files saved under ``settings.PRECALC_ROOT``.
+"""
+import os
+
+
+def save_atomically(path, write):
+    """
+    Write a file with ``write(fp)`` under a temporary name and rename it into place.
+    Other processes that have the old file open or memory-mapped keep reading
+    the old contents, and new readers only ever see a complete file.
+    """
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(temp_path, 'wb') as fp:
+            write(fp)
+        os.rename(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
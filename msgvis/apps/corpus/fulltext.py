@@ -0,0 +1,304 @@
+"""
+Full-text search over the text of messages, for phrases, word prefixes and substrings
+that the keyword search (which only knows the words found by the tagger) cannot answer.
+
+Each database backend has its own index with the same interface:
+
+- MySQL: a ``FULLTEXT`` index on ``corpus_message.text``, queried in boolean mode.
+  MySQL cannot look up substrings in it, so substring queries scan the dataset's messages.
+- SQLite: FTS5 shadow tables with the text of each message, one with whole words
+  and one with trigrams for substrings, kept up to date by triggers.
+
+The index is optional. Install it with the ``build_fulltext_index`` command;
+the database keeps it up to date as messages are imported. Without it, every
+query scans the dataset's messages with ``LIKE``.
+
+.. code-block:: python
+
+    results = get_backend().search(dataset, "soup ladies", mode='phrase')
+    results.count()
+    # 52
+    results[0:10]
+    # [<Message: ...>, ...] (best matches first)
+"""
+import re
+
+from django.db import connections, OperationalError
+
+from msgvis.apps.corpus import models as corpus_models
+
+MODES = ('phrase', 'prefix', 'substring')
+
+
+def _words(text):
+    """The words of a query, without characters that are operators in full-text queries"""
+    return [word for word in re.split(r'[\s"*+\-<>()~@]+', text) if word]
+
+
+def _escape_like(text):
+    """The text with the LIKE wildcards escaped by ``!``, which means the same on every backend"""
+    return text.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+
+
+class RankedResults(object):
+    """
+    The messages matching a full-text query, best first. Counts and slices
+    run their own queries, so a Paginator only fetches the page it shows.
+    """
+
+    def __init__(self, using, select_sql, select_params, count_sql, count_params):
+        self.using = using
+        self.select_sql = select_sql
+        self.select_params = tuple(select_params)
+        self.count_sql = count_sql
+        self.count_params = tuple(count_params)
+        self._count = None
+
+    def all(self):
+        return self
+
+    def count(self):
+        if self._count is None:
+            cursor = connections[self.using].cursor()
+            cursor.execute(self.count_sql, self.count_params)
+            self._count = cursor.fetchone()[0]
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def ids(self, offset=0, limit=None):
+        """The ids of the matching messages, best first"""
+        sql = self.select_sql
+        params = self.select_params
+        if limit is not None:
+            sql += " LIMIT %s OFFSET %s"
+            params += (limit, offset)
+        cursor = connections[self.using].cursor()
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step is not None:
+                raise ValueError("Full-text results cannot be sliced with a step")
+            start = key.start or 0
+            limit = key.stop - start if key.stop is not None else None
+            ids = self.ids(start, limit)
+        else:
+            ids = self.ids(key, 1)
+            if len(ids) == 0:
+                raise IndexError(key)
+
+        messages = corpus_models.Message.objects.using(self.using).select_related('sender', 'type').in_bulk(ids)
+        messages = [messages[message_id] for message_id in ids if message_id in messages]
+        return messages if isinstance(key, slice) else messages[0]
+
+
+class FullTextBackend(object):
+    """
+    Search the text of messages by scanning it. The indexed backends override this.
+    A scan cannot tell where words end, so a phrase may also end inside a word.
+    """
+
+    def __init__(self, using='default'):
+        self.using = using
+        self.connection = connections[using]
+        self.table = corpus_models.Message._meta.db_table
+
+    def is_supported(self):
+        """Whether the database can build the index"""
+        return True
+
+    def is_installed(self):
+        return True
+
+    def install(self):
+        """Create the index and add the existing messages"""
+        pass
+
+    def uninstall(self):
+        pass
+
+    def _restrict(self, dataset, types):
+        """The condition on the messages M of the dataset with any of the types"""
+        condition = "M.`dataset_id` = %s"
+        params = [dataset.id]
+        if types:
+            condition += " AND M.`type_id` IN (%s)" % ", ".join(["%s"] * len(types))
+            params.extend(message_type.id for message_type in types)
+        return condition, params
+
+    def _scan(self, dataset, types, condition, params):
+        restriction, restriction_params = self._restrict(dataset, types)
+        where = "WHERE %s AND %s" % (restriction, condition)
+        select_sql = "SELECT M.`id` FROM `{table}` AS M {where} ORDER BY M.`id`".format(table=self.table, where=where)
+        count_sql = "SELECT COUNT(*) FROM `{table}` AS M {where}".format(table=self.table, where=where)
+        params = restriction_params + list(params)
+        return RankedResults(self.using, select_sql, params, count_sql, params)
+
+    def search(self, dataset, text, mode='phrase', types=None):
+        """
+        The messages of the dataset (with any of the message types, if given) matching the query,
+        as :class:`RankedResults`. A phrase matches the words in order, a prefix query matches
+        messages with words starting with each of the words, and a substring query matches
+        the text anywhere.
+        """
+        if mode not in MODES:
+            raise ValueError("Unknown full-text search mode: %s" % mode)
+
+        words = _words(text)
+        if len(words) == 0:
+            return self._scan(dataset, types, "1 = 0", [])
+
+        like = "M.`text` LIKE %s ESCAPE '!'"
+        if mode == 'prefix':
+            # each word at the start of the text or after a space
+            condition = " AND ".join(["(%s OR %s)" % (like, like)] * len(words))
+            params = []
+            for word in words:
+                params.extend([_escape_like(word) + '%', '% ' + _escape_like(word) + '%'])
+            return self._scan(dataset, types, condition, params)
+        if mode == 'phrase':
+            return self._scan(dataset, types, like, ['%' + _escape_like(" ".join(words)) + '%'])
+        return self._scan(dataset, types, like, ['%' + _escape_like(text.strip()) + '%'])
+
+
+class MySQLFullTextBackend(FullTextBackend):
+    """A FULLTEXT index on the message text, queried in boolean mode"""
+
+    index_name = 'corpus_message_text_fulltext'
+
+    def is_installed(self):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM information_schema.statistics "
+                       "WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s",
+                       [self.table, self.index_name])
+        return cursor.fetchone()[0] > 0
+
+    def install(self):
+        if not self.is_installed():
+            cursor = self.connection.cursor()
+            cursor.execute("ALTER TABLE `%s` ADD FULLTEXT INDEX `%s` (`text`)" % (self.table, self.index_name))
+
+    def uninstall(self):
+        if self.is_installed():
+            cursor = self.connection.cursor()
+            cursor.execute("ALTER TABLE `%s` DROP INDEX `%s`" % (self.table, self.index_name))
+
+    def _match(self, dataset, types, query):
+        restriction, params = self._restrict(dataset, types)
+        where = "WHERE %s AND MATCH(M.`text`) AGAINST(%%s IN BOOLEAN MODE)" % restriction
+        select_sql = ("SELECT M.`id` FROM `{table}` AS M {where} "
+                      "ORDER BY MATCH(M.`text`) AGAINST(%s IN BOOLEAN MODE) DESC, M.`id`").format(table=self.table,
+                                                                                                where=where)
+        count_sql = "SELECT COUNT(*) FROM `{table}` AS M {where}".format(table=self.table, where=where)
+        return RankedResults(self.using, select_sql, params + [query, query], count_sql, params + [query])
+
+    def search(self, dataset, text, mode='phrase', types=None):
+        words = _words(text)
+        if mode not in ('phrase', 'prefix') or len(words) == 0 or not self.is_installed():
+            return super(MySQLFullTextBackend, self).search(dataset, text, mode, types)
+
+        if mode == 'phrase':
+            return self._match(dataset, types, '"%s"' % " ".join(words))
+        return self._match(dataset, types, " ".join("+%s*" % word for word in words))
+
+
+class SQLiteFullTextBackend(FullTextBackend):
+    """FTS5 tables that shadow the message text, one by word and one by trigram"""
+
+    def __init__(self, using='default'):
+        super(SQLiteFullTextBackend, self).__init__(using)
+        self.word_table = self.table + '_fts'
+        self.trigram_table = self.table + '_fts_trigram'
+
+    def _has_table(self, name):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = %s", [name])
+        return cursor.fetchone()[0] > 0
+
+    def is_supported(self):
+        # FTS5 is an optional part of SQLite
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE temp.`fts5_probe` USING fts5(text)")
+        except OperationalError:
+            return False
+        cursor.execute("DROP TABLE temp.`fts5_probe`")
+        return True
+
+    def is_installed(self):
+        return self._has_table(self.word_table)
+
+    def install(self):
+        cursor = self.connection.cursor()
+        for fts_table, tokenize in ((self.word_table, 'unicode61'), (self.trigram_table, 'trigram')):
+            if self._has_table(fts_table):
+                continue
+            try:
+                cursor.execute("CREATE VIRTUAL TABLE `{fts}` USING fts5(text, content='{table}', content_rowid='id', "
+                               "tokenize='{tokenize}')".format(fts=fts_table, table=self.table, tokenize=tokenize))
+            except OperationalError:
+                # SQLite before 3.34 has no trigrams, so substrings are scanned
+                if tokenize != 'trigram':
+                    raise
+                continue
+
+            # keep the index up to date as messages are imported or changed
+            cursor.execute("CREATE TRIGGER `{fts}_insert` AFTER INSERT ON `{table}` BEGIN "
+                           "INSERT INTO `{fts}` (rowid, text) VALUES (new.id, new.text); END"
+                           .format(fts=fts_table, table=self.table))
+            cursor.execute("CREATE TRIGGER `{fts}_delete` AFTER DELETE ON `{table}` BEGIN "
+                           "INSERT INTO `{fts}` (`{fts}`, rowid, text) VALUES ('delete', old.id, old.text); END"
+                           .format(fts=fts_table, table=self.table))
+            cursor.execute("CREATE TRIGGER `{fts}_update` AFTER UPDATE OF text ON `{table}` BEGIN "
+                           "INSERT INTO `{fts}` (`{fts}`, rowid, text) VALUES ('delete', old.id, old.text); "
+                           "INSERT INTO `{fts}` (rowid, text) VALUES (new.id, new.text); END"
+                           .format(fts=fts_table, table=self.table))
+            cursor.execute("INSERT INTO `{fts}` (`{fts}`) VALUES ('rebuild')".format(fts=fts_table))
+
+    def uninstall(self):
+        cursor = self.connection.cursor()
+        for fts_table in (self.word_table, self.trigram_table):
+            for suffix in ('insert', 'delete', 'update'):
+                cursor.execute("DROP TRIGGER IF EXISTS `%s_%s`" % (fts_table, suffix))
+            cursor.execute("DROP TABLE IF EXISTS `%s`" % fts_table)
+
+    def _match(self, dataset, types, fts_table, query):
+        restriction, params = self._restrict(dataset, types)
+        where = "WHERE F.`{fts}` MATCH %s AND M.`id` = F.rowid AND {restriction}".format(fts=fts_table,
+                                                                                         restriction=restriction)
+        select_sql = "SELECT M.`id` FROM `{fts}` AS F, `{table}` AS M {where} ORDER BY F.rank, M.`id`" \
+            .format(fts=fts_table, table=self.table, where=where)
+        count_sql = "SELECT COUNT(*) FROM `{fts}` AS F, `{table}` AS M {where}" \
+            .format(fts=fts_table, table=self.table, where=where)
+        params = [query] + params
+        return RankedResults(self.using, select_sql, params, count_sql, params)
+
+    def search(self, dataset, text, mode='phrase', types=None):
+        words = _words(text)
+        if mode not in MODES or len(words) == 0 or not self.is_installed():
+            return super(SQLiteFullTextBackend, self).search(dataset, text, mode, types)
+
+        if mode == 'phrase':
+            return self._match(dataset, types, self.word_table, '"%s"' % " ".join(words))
+        if mode == 'prefix':
+            return self._match(dataset, types, self.word_table, " ".join('"%s"*' % word for word in words))
+
+        # trigrams cannot find fewer than three characters
+        substring = text.strip()
+        if len(substring) < 3 or not self._has_table(self.trigram_table):
+            return super(SQLiteFullTextBackend, self).search(dataset, text, mode, types)
+        return self._match(dataset, types, self.trigram_table, '"%s"' % substring.replace('"', '""'))
+
+
+backends = {
+    'mysql': MySQLFullTextBackend,
+    'sqlite': SQLiteFullTextBackend,
+}
+
+
+def get_backend(using='default'):
+    """The full-text backend for the database"""
+    return backends.get(connections[using].vendor, FullTextBackend)(using)
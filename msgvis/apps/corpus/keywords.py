@@ -0,0 +1,535 @@
+"""
+Parse and evaluate the keyword queries that define searches and groups.
+
+The syntax is small: clauses are separated by commas and match messages that
+contain all of the clause's space-separated words. A message matches the query if
+it matches any clause, unless it also matches a clause that starts with ``NOT``.
+
+.. code-block:: python
+
+    query = parse("super bowl, Super  Bowl, superbowl, NOT bowl ads")
+    query
+    # Difference(Or(And(Term(u'super'), Term(u'bowl')), Term(u'superbowl')),
+    #            And(Term(u'bowl'), Term(u'ads')))
+
+:func:`parse` normalizes the query: words are lower-cased, repeated words and clauses
+are removed, and a clause is dropped if another clause already matches all of its
+messages. The query can then be evaluated in two ways:
+
+- :class:`PostingListPlan` intersects, merges and subtracts the posting lists of a
+  :class:`msgvis.apps.enhance.word_index.WordIndex`.
+- :class:`SQLPlan` compiles the whole query into one ``Q`` object, with one
+  semi-join on the :class:`msgvis.apps.enhance.models.Lemma` links per word,
+  so it runs as a single statement.
+
+Both evaluate the rarest words first and stop as soon as a conjunction is empty.
+A word that does not occur in the dataset matches no messages.
+:func:`evaluate_many` evaluates a batch of queries with one posting list plan,
+so shared words and clauses are only looked up and evaluated once.
+
+The ids found with the posting lists are wrapped in :class:`MessageIdResults`,
+which pages through them and only fetches the messages of the page shown.
+
+Searches are typed a word at a time, so each :class:`SearchHistory` remembers the
+matching ids of a session's recent queries. A query that :func:`refines` a remembered
+one (by adding a word to a clause, adding a ``NOT`` clause, or removing a clause)
+can only match a subset of its messages, so it is evaluated within them.
+Entries are keyed on the dataset's data version, so imported messages are not missed,
+and the ids remembered by all the sessions of a process are limited together.
+"""
+import operator
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import Q, Count
+
+
+class Node(object):
+    """A node of a keyword query"""
+
+    def terms(self):
+        """The set of words in the query"""
+        raise NotImplementedError()
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self), self._key()))
+
+
+class Term(Node):
+    """Messages containing a word"""
+
+    def __init__(self, word):
+        self.word = word
+
+    def _key(self):
+        return self.word
+
+    def terms(self):
+        return {self.word}
+
+    def __repr__(self):
+        return 'Term(%r)' % self.word
+
+
+class _Group(Node):
+    def __init__(self, children):
+        self.children = frozenset(children)
+
+    def _key(self):
+        return self.children
+
+    def terms(self):
+        return set().union(*[child.terms() for child in self.children])
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(sorted(repr(c) for c in self.children)))
+
+
+class And(_Group):
+    """Messages matching all of the children"""
+    pass
+
+
+class Or(_Group):
+    """Messages matching any of the children"""
+    pass
+
+
+class Difference(Node):
+    """Messages matching the left side but not the right side"""
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def _key(self):
+        return (self.left, self.right)
+
+    def terms(self):
+        return self.left.terms() | self.right.terms()
+
+    def __repr__(self):
+        return 'Difference(%r, %r)' % (self.left, self.right)
+
+
+def _conjunction(words):
+    """A clause matching all of the words, or None if there are none"""
+    words = set(word.lower() for word in words if word.strip())
+    if len(words) == 0:
+        return None
+    if len(words) == 1:
+        return Term(words.pop())
+    return And(Term(word) for word in words)
+
+
+def _disjunction(clauses):
+    """
+    A node matching any of the clauses, or None if there are none.
+    A clause is dropped if its words include all of the words of another clause.
+    """
+    clauses = set(clauses)
+    kept = [clause for clause in clauses
+            if not any(other is not clause and other.terms() < clause.terms() for other in clauses)]
+    if len(kept) == 0:
+        return None
+    if len(kept) == 1:
+        return kept[0]
+    return Or(kept)
+
+
+def parse(keywords_text):
+    """Parse and normalize a keyword query. Returns None if it has no words."""
+    include = []
+    exclude = []
+    for clause in keywords_text.split(','):
+        clause = clause.strip()
+        if clause.startswith("NOT "):
+            node = _conjunction(clause[4:].split(' '))
+            if node is not None:
+                exclude.append(node)
+        else:
+            node = _conjunction(clause.split(' '))
+            if node is not None:
+                include.append(node)
+
+    include = _disjunction(include)
+    if include is None:
+        # nothing to match
+        return None
+
+    exclude = _disjunction(exclude)
+    if exclude is None:
+        return include
+    return Difference(include, exclude)
+
+
+def _clauses(node):
+    """The sets of words of the clauses of a disjunction"""
+    if isinstance(node, Or):
+        return [frozenset(child.terms()) for child in node.children]
+    return [frozenset(node.terms())]
+
+
+def refines(query, previous):
+    """
+    True if the query can only match messages that the previous query matches:
+    each of its clauses has all the words of some previous clause, and each
+    previous NOT clause has all the words of one of its NOT clauses.
+    """
+    if query is None or previous is None:
+        return False
+
+    def split(node):
+        if isinstance(node, Difference):
+            return _clauses(node.left), _clauses(node.right)
+        return _clauses(node), []
+
+    include, exclude = split(query)
+    previous_include, previous_exclude = split(previous)
+    return all(any(old <= new for old in previous_include) for new in include) and \
+        all(any(new <= old for new in exclude) for old in previous_exclude)
+
+
+class PostingListPlan(object):
+    """
+    Evaluate queries with the posting lists of a word index,
+    optionally only among the sorted message ids ``within``.
+    """
+
+    def __init__(self, index, within=None):
+        self.index = index
+        self.within = within
+        self._postings = {}
+        self._results = {}
+
+    def postings(self, word):
+        if word not in self._postings:
+            import numpy
+            ids = self.index.lookup(word)
+            if ids is None:
+                ids = numpy.array([], dtype=numpy.int64)
+            elif self.within is not None:
+                ids = numpy.intersect1d(ids, self.within, assume_unique=True)
+            self._postings[word] = ids
+        return self._postings[word]
+
+    def estimate(self, node):
+        """An upper bound on the number of messages matching the node"""
+        if isinstance(node, Term):
+            return len(self.postings(node.word))
+        if isinstance(node, And):
+            return min(self.estimate(child) for child in node.children)
+        if isinstance(node, Or):
+            return sum(self.estimate(child) for child in node.children)
+        return self.estimate(node.left)
+
+    def evaluate(self, node):
+        """
+        The sorted ids of the messages matching the node. The results of
+        sub-expressions are kept, so queries evaluated with the same plan share them.
+        """
+        import numpy
+
+        if node is None:
+            return numpy.array([], dtype=numpy.int64)
+
+        if node not in self._results:
+            self._results[node] = self._evaluate(node)
+        return self._results[node]
+
+    def _evaluate(self, node):
+        import numpy
+
+        if isinstance(node, Term):
+            return self.postings(node.word)
+
+        if isinstance(node, And):
+            ids = None
+            for child in sorted(node.children, key=self.estimate):
+                child_ids = self.evaluate(child)
+                ids = child_ids if ids is None else numpy.intersect1d(ids, child_ids, assume_unique=True)
+                if len(ids) == 0:
+                    break
+            return ids
+
+        if isinstance(node, Or):
+            parts = [self.evaluate(child) for child in node.children]
+            return numpy.unique(numpy.concatenate(parts))
+
+        ids = self.evaluate(node.left)
+        if len(ids) == 0:
+            return ids
+        return numpy.setdiff1d(ids, self.evaluate(node.right), assume_unique=True)
+
+
+class MessageIdResults(object):
+    """
+    The messages with a sorted array of ids, for a Paginator. Counting needs no query,
+    and each slice fetches only the messages of its ids.
+    """
+
+    def __init__(self, queryset, ids):
+        self.queryset = queryset
+        self.ids = ids
+
+    def all(self):
+        return self
+
+    def count(self):
+        return len(self.ids)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        ids = self.ids[key] if isinstance(key, slice) else self.ids[key:key + 1]
+        if not isinstance(key, slice) and len(ids) == 0:
+            raise IndexError(key)
+
+        messages = self.queryset.select_related('sender', 'type').in_bulk(ids.tolist())
+        messages = [messages[message_id] for message_id in ids.tolist() if message_id in messages]
+        return messages if isinstance(key, slice) else messages[0]
+
+
+class SQLPlan(object):
+    """Compile queries into a filter on a dataset's messages"""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.words = None
+
+    def resolve(self, words):
+        """
+        Find the lemmas of the words and their message counts,
+        with one query for the spellings and one for the counts.
+        """
+        from msgvis.apps.enhance.models import TweetWord, Lemma
+
+        self.words = dict((word, ([], 0)) for word in words)
+        if len(words) == 0:
+            return
+
+        spellings = TweetWord.objects.filter(dataset=self.dataset, lemma__isnull=False)
+        spellings = spellings.filter(reduce(operator.or_, [Q(original_text__iexact=word) for word in words]))
+        lemma_words = {}
+        for original_text, lemma_id in spellings.values_list('original_text', 'lemma_id').distinct():
+            lemma_words.setdefault(lemma_id, set()).add(original_text.lower())
+
+        if len(lemma_words) == 0:
+            return
+
+        lemmas = Lemma.objects.filter(id__in=lemma_words.keys())
+        for lemma_id, frequency in lemmas.annotate(frequency=Count('messages')).values_list('id', 'frequency'):
+            for word in lemma_words[lemma_id]:
+                if word in self.words:
+                    ids, total = self.words[word]
+                    self.words[word] = (ids + [lemma_id], total + frequency)
+
+    def estimate(self, node):
+        """An upper bound on the number of messages matching the node"""
+        if isinstance(node, Term):
+            return self.words[node.word][1]
+        if isinstance(node, And):
+            return min(self.estimate(child) for child in node.children)
+        if isinstance(node, Or):
+            return sum(self.estimate(child) for child in node.children)
+        return self.estimate(node.left)
+
+    def _compile(self, node):
+        """A Q object for the node, or None if it cannot match anything"""
+        from msgvis.apps.enhance.models import Lemma
+
+        if isinstance(node, Term):
+            lemma_ids = self.words[node.word][0]
+            if len(lemma_ids) == 0:
+                return None
+            links = Lemma.messages.through.objects
+            if len(lemma_ids) == 1:
+                # usually a word has one lemma
+                links = links.filter(lemma_id=lemma_ids[0])
+            else:
+                links = links.filter(lemma_id__in=lemma_ids)
+            return Q(pk__in=links.values('message_id'))
+
+        if isinstance(node, And):
+            conditions = []
+            for child in sorted(node.children, key=self.estimate):
+                condition = self._compile(child)
+                if condition is None:
+                    return None
+                conditions.append(condition)
+            return reduce(operator.and_, conditions)
+
+        if isinstance(node, Or):
+            conditions = [c for c in (self._compile(child) for child in node.children) if c is not None]
+            if len(conditions) == 0:
+                return None
+            return reduce(operator.or_, conditions)
+
+        left = self._compile(node.left)
+        if left is None:
+            return None
+        right = self._compile(node.right)
+        if right is None:
+            return left
+        return left & ~right
+
+    def compile(self, node):
+        """A Q object matching the messages of the node"""
+        if node is None:
+            return Q(pk__in=[])
+
+        self.resolve(node.terms())
+        condition = self._compile(node)
+        if condition is None:
+            return Q(pk__in=[])
+        return condition
+
+
+class DatabasePostings(object):
+    """
+    The posting lists of a few words, read from the lemma links of a dataset with one
+    query, for evaluating several queries with a :class:`PostingListPlan` when there is
+    no word index.
+    """
+
+    def __init__(self, dataset, words):
+        import numpy
+        from msgvis.apps.enhance.models import Lemma
+
+        plan = SQLPlan(dataset)
+        plan.resolve(words)
+
+        lemma_ids = set()
+        for ids, frequency in plan.words.itervalues():
+            lemma_ids.update(ids)
+
+        links = {}
+        if len(lemma_ids) > 0:
+            rows = Lemma.messages.through.objects.filter(lemma_id__in=list(lemma_ids))
+            for lemma_id, message_id in rows.values_list('lemma_id', 'message_id').iterator():
+                links.setdefault(lemma_id, []).append(message_id)
+
+        self.postings = {}
+        for word, (ids, frequency) in plan.words.iteritems():
+            if len(ids) > 0:
+                message_ids = [message_id for lemma_id in ids for message_id in links.get(lemma_id, [])]
+                self.postings[word] = numpy.unique(numpy.array(message_ids, dtype=numpy.int64))
+
+    def lookup(self, word):
+        return self.postings.get(word)
+
+
+def evaluate_many(dataset, keywords_texts):
+    """
+    The sorted ids of the messages matching each of several keyword queries.
+    Each word is looked up once, and clauses shared by several queries are evaluated once.
+    """
+    from msgvis.apps.enhance.word_index import WordIndex
+
+    queries = [parse(keywords_text) for keywords_text in keywords_texts]
+
+    index = WordIndex.load(dataset.id)
+    if index is None:
+        words = set().union(*[query.terms() for query in queries if query is not None])
+        index = DatabasePostings(dataset, words)
+
+    plan = PostingListPlan(index)
+    return [plan.evaluate(query) for query in queries]
+
+class SearchHistory(object):
+    """
+    The matching message ids of a session's most recent queries.
+    The dataset is given as a (dataset id, data version) pair,
+    e.g. ``(dataset.id, dataset.get_data_version())``.
+    """
+
+    def __init__(self, size=None):
+        self.size = size or getattr(settings, 'SEARCH_HISTORY_SIZE', 10)
+        self.entries = OrderedDict()
+
+    def find(self, dataset, types, query):
+        """
+        The remembered ids for the query, or for the smallest result that it refines.
+        Returns (ids, exact), or (None, False) if neither is remembered.
+        """
+        with _lock:
+            key = (dataset, types, query)
+            if key in self.entries:
+                self.entries[key] = self.entries.pop(key)
+                return self.entries[key], True
+
+            best = None
+            for (entry_dataset, entry_types, entry_query), ids in self.entries.iteritems():
+                if entry_dataset == dataset and entry_types == types and refines(query, entry_query):
+                    if best is None or len(ids) < len(best[1]):
+                        best = ((entry_dataset, entry_types, entry_query), ids)
+
+            if best is None:
+                return None, False
+            self.entries[best[0]] = self.entries.pop(best[0])
+            return best[1], False
+
+    def remember(self, dataset, types, query, ids):
+        """
+        Keep the sorted ids matching the query, forgetting the oldest query if full,
+        and the queries of older versions of the dataset.
+        """
+        if len(ids) > getattr(settings, 'SEARCH_HISTORY_MAX_IDS', 100000):
+            return
+        with _lock:
+            dataset_id = dataset[0]
+            for key in [key for key in self.entries if key[0][0] == dataset_id and key[0] != dataset]:
+                del self.entries[key]
+
+            key = (dataset, types, query)
+            self.entries.pop(key, None)
+            self.entries[key] = ids
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+            _limit_histories()
+
+    def total_ids(self):
+        return sum(len(ids) for ids in self.entries.itervalues())
+
+
+_histories = OrderedDict()
+_lock = threading.RLock()
+
+
+def _limit_histories():
+    """Forget the oldest queries of the least recent sessions until the ids fit in SEARCH_HISTORY_MAX_TOTAL_IDS"""
+    max_total = getattr(settings, 'SEARCH_HISTORY_MAX_TOTAL_IDS', 1000000)
+    total = sum(history.total_ids() for history in _histories.itervalues())
+    while total > max_total and len(_histories) > 0:
+        session_key, history = next(_histories.iteritems())
+        if len(history.entries) == 0:
+            del _histories[session_key]
+            continue
+        key, ids = history.entries.popitem(last=False)
+        total -= len(ids)
+
+
+def get_search_history(session_key):
+    """
+    The search history of a session in this process.
+    Returns None if there is no session key, since unsaved sessions would share it.
+    """
+    if session_key is None:
+        return None
+
+    with _lock:
+        history = _histories.pop(session_key, None)
+        if history is None:
+            history = SearchHistory()
+        _histories[session_key] = history
+        while len(_histories) > getattr(settings, 'SEARCH_HISTORY_SESSIONS', 100):
+            _histories.popitem(last=False)
+        return history
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from msgvis.apps.corpus import utils
+
+
+class Command(BaseCommand):
+    """
+    Fill in the epoch seconds and minute/hour/day bucket columns of messages,
+    e.g. after messages were loaded without going through Message.save().
+
+    .. code-block :: bash
+
+        $ python manage.py backfill_time_buckets [<dataset id>]
+
+    """
+    args = '[<dataset id>]'
+    help = "Fill in the time bucket columns of messages."
+
+    def handle(self, dataset_id=None, *args, **options):
+
+        if dataset_id is not None:
+            try:
+                dataset_id = int(dataset_id)
+            except ValueError:
+                raise CommandError("Dataset id must be a number.")
+
+        with transaction.atomic(savepoint=False):
+            updated = utils.backfill_time_buckets(connection, dataset_id)
+
+        print "Updated the time buckets of %d messages" % updated
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError, make_option
+from time import time
+
+from msgvis.apps.corpus import fulltext
+
+
+class Command(BaseCommand):
+    """
+    Create the full-text index of message text used for phrase, prefix and substring searches.
+    The database keeps it up to date afterwards, so this only needs to run once.
+
+    .. code-block :: bash
+
+        $ python manage.py build_fulltext_index [--uninstall]
+
+    """
+    help = "Create (or drop) the full-text index of message text."
+    option_list = BaseCommand.option_list + (
+        make_option('--uninstall',
+                    action='store_true',
+                    default=False,
+                    dest='uninstall',
+                    help='Drop the index instead'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        backend = fulltext.get_backend()
+
+        start = time()
+        if options.get('uninstall'):
+            backend.uninstall()
+            print "Dropped the full-text index"
+        elif not backend.is_supported():
+            raise CommandError("The database cannot build a full-text index")
+        else:
+            backend.install()
+            print "Built the full-text index with %s" % backend.__class__.__name__
+        print "Time: %.2fs" % (time() - start)
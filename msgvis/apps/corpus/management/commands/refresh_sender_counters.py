@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from msgvis.apps.corpus import utils
+
+
+class Command(BaseCommand):
+    """
+    Copy the current counters of each message's sender (followers, friends, ...)
+    onto the message, e.g. after the people were updated.
+
+    .. code-block :: bash
+
+        $ python manage.py refresh_sender_counters [<dataset id>]
+
+    """
+    args = '[<dataset id>]'
+    help = "Copy the sender counters onto messages."
+
+    def handle(self, dataset_id=None, *args, **options):
+
+        if dataset_id is not None:
+            try:
+                dataset_id = int(dataset_id)
+            except ValueError:
+                raise CommandError("Dataset id must be a number.")
+
+        with transaction.atomic(savepoint=False):
+            updated = utils.refresh_sender_counters(connection, dataset_id)
+
+        print "Updated the sender counters of %d messages" % updated
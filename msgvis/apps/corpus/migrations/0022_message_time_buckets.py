@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def backfill_time_buckets(apps, schema_editor):
+    from msgvis.apps.corpus.utils import backfill_time_buckets
+    backfill_time_buckets(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0021_dataset_has_prefetched_images'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='time_day',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='time_epoch',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='time_hour',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='time_minute',
+            field=models.BigIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('dataset', 'original_id'), ('dataset', 'time_hour'), ('dataset', 'time_day'), ('dataset', 'time'), ('dataset', 'time_minute')]),
+        ),
+        migrations.RunPython(backfill_time_buckets),
+    ]
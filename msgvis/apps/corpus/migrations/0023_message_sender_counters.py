@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def refresh_sender_counters(apps, schema_editor):
+    from msgvis.apps.corpus.utils import refresh_sender_counters
+    refresh_sender_counters(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0022_message_time_buckets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='sender_follower_count',
+            field=models.PositiveIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='sender_friend_count',
+            field=models.PositiveIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='sender_mentioned_count',
+            field=models.PositiveIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='sender_message_count',
+            field=models.PositiveIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='sender_replied_to_count',
+            field=models.PositiveIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='sender_shared_count',
+            field=models.PositiveIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('dataset', 'time_day'), ('dataset', 'time'), ('dataset', 'time_hour'), ('dataset', 'original_id'), ('dataset', 'sender_shared_count'), ('dataset', 'sender_friend_count'), ('dataset', 'time_minute'), ('dataset', 'sender_follower_count'), ('dataset', 'sender_replied_to_count'), ('dataset', 'sender_mentioned_count'), ('dataset', 'sender_message_count')]),
+        ),
+        migrations.RunPython(refresh_sender_counters),
+    ]
@@ -1,6 +1,7 @@
 import operator
 from django.db import models
 from django.db.models import Q
+from django.conf import settings
 from caching.base import CachingManager, CachingMixin
 
 from msgvis.apps.base import models as base_models
@@ -36,70 +37,105 @@ class Dataset(models.Model):
     def message_count(self):
         return self.message_set.count()
 
+    def get_data_version(self):
+        """
+        The id of the dataset's newest message, or 0. Imports only add messages,
+        so results that are kept between requests can include it to notice new ones.
+        This is one index lookup, unlike counting the messages.
+        """
+        return self.message_set.aggregate(max_id=models.Max('id'))['max_id'] or 0
+
     def __unicode__(self):
         return self.name
 
     def get_example_messages(self, filters=[], excludes=[]):
         """Get example messages given some filters (dictionaries containing dimensions and filter params)"""
 
-        messages = self.message_set.all()
-
-        for filter in filters:
-            dimension = filter["dimension"]
-
-            # Remove the dimension key
-            params = {key: value for key, value in filter.iteritems() if key != "dimension"}
+        from msgvis.apps.dimensions.filters import apply_filters
 
-            messages = dimension.filter(messages, **params)
+        return apply_filters(self.message_set.all(), filters, excludes)
 
-        for exclude in excludes:
-            dimension = exclude["dimension"]
+    def get_example_messages_by_groups(self, groups, filters=[], excludes=[], cursor=None, page_size=10):
+        """
+        Get a page of example messages from several groups, taking the same number
+        from each group in turn. Group membership comes from the group bitmaps
+        (see :mod:`msgvis.apps.groups.bitmaps`), and each group is paged through its
+        sorted message ids, so only a few ids past the cursor are sent to the database.
 
-            # Remove the dimension key
-            params = {key: value for key, value in excludes.iteritems() if key != "dimension"}
+        The cursor maps each group id to the id of the last message shown from it,
+        or None if the group has no more messages. Groups missing from the cursor start
+        from the beginning. A message in several groups is only shown with the first of them,
+        and messages without a time are not shown. Returns the messages
+        and the cursor for the next page (None if every group is finished).
+        """
+        import numpy
+        from msgvis.apps.dimensions.filters import apply_filters
 
-            messages = dimension.exclude(messages, **params)
-
-        return messages
-
-    def get_example_messages_by_groups(self, groups, filters=[], excludes=[]):
         include_groups = map(lambda x: int(x['value']), filter(lambda x: x['dimension'].key=='groups', filters))
         if len(include_groups)> 0:
             groups = include_groups
         exclude_groups = map(lambda x: int(x['value']), filter(lambda x: x['dimension'].key=='groups', excludes))
         groups = filter(lambda x: x not in exclude_groups, groups)
 
-        per_group = int(10 / len(groups))
-        combined_messages = []
-        group_querysets = []
-        for group in groups:
-            group_obj = self.groups.get(id=group)
-            messages = group_obj.messages
-            for filterA in filters:
-                dimension = filterA["dimension"]
-
-                # Remove the dimension key
-                params = {key: value for key, value in filterA.iteritems() if key != "dimension"}
-                messages = dimension.filter(messages, **params)
-
-            for exclude in excludes:
-                dimension = exclude["dimension"]
-
-                # Remove the dimension key
-                params = {key: value for key, value in excludes.iteritems() if key != "dimension"}
-
-                messages = dimension.exclude(messages, **params)
-
-            group_querysets.append(messages)
-            #combined_messages.extend(messages[:per_group])
-        query = ""
-        for idx, queryset in enumerate(group_querysets):
-            if idx > 0:
-                query += " UNION "
-            query += "(%s)" %(utils.quote(str(queryset.query)))
-        query = utils.convert_boolean(query)
-        queryset = Message.objects.raw(query)
-        return queryset
+        # group filters are answered from the membership
+        filters = filter(lambda x: x['dimension'].key != 'groups', filters)
+        excludes = filter(lambda x: x['dimension'].key != 'groups', excludes)
+
+        cursor = dict((int(key), value) for key, value in (cursor or {}).iteritems())
+        positions = {}
+        for group_id in groups:
+            position = cursor.get(group_id, 0)
+            if position is not None:
+                positions[group_id] = int(position)
+        if len(positions) == 0:
+            return [], None
+
+        # a message in several groups is shown with the first of them
+        group_objs = self.groups.in_bulk(groups)
+        members = {}
+        shown = numpy.array([], dtype=numpy.int64)
+        for group_id in groups:
+            if group_id in group_objs:
+                ids = numpy.setdiff1d(group_objs[group_id].bitmap.ids(), shown, assume_unique=True)
+                shown = numpy.union1d(shown, ids)
+                if group_id in positions:
+                    members[group_id] = ids[numpy.searchsorted(ids, positions[group_id], side='right'):]
+        if len(members) == 0:
+            return [], None
+
+        per_group = max(1, page_size // len(members))
+        messages = apply_filters(self.message_set.filter(time__isnull=False), filters, excludes)
+
+        # check the ids after the cursor a few at a time until the group has enough messages
+        chunk_size = per_group * 4
+        chosen = {}
+        for group_id, ids in members.iteritems():
+            chosen[group_id] = []
+            offset = 0
+            while len(chosen[group_id]) < per_group and offset < len(ids):
+                chunk = ids[offset:offset + chunk_size].tolist()
+                offset += len(chunk)
+                visible = set(messages.filter(id__in=chunk).values_list('id', flat=True))
+                chosen[group_id].extend([message_id for message_id in chunk if message_id in visible])
+            chosen[group_id] = chosen[group_id][:per_group]
+
+        # interleave the groups
+        by_id = self.message_set.select_related('sender', 'type').in_bulk(sum(chosen.values(), []))
+        page = []
+        for i in range(per_group):
+            for group_id in groups:
+                if group_id in chosen and i < len(chosen[group_id]):
+                    page.append(by_id[chosen[group_id][i]])
+
+        next_cursor = dict((group_id, None) for group_id in groups if group_id not in members)
+        for group_id in members:
+            if len(chosen[group_id]) < per_group:
+                next_cursor[group_id] = None
+            else:
+                next_cursor[group_id] = chosen[group_id][-1]
+        if all(position is None for position in next_cursor.itervalues()):
+            next_cursor = None
+        return page, next_cursor
 
     def get_dictionary(self):
         dictionary = self.dictionary.all()
@@ -108,51 +144,86 @@ class Dataset(models.Model):
             return dictionary
         return None
 
-    def get_advanced_search_results(self, keywords_text, include_types):
+    def get_advanced_search_results(self, keywords_text, include_types, history=None):
+        """
+        Get the messages matching a keyword query (see :mod:`msgvis.apps.corpus.keywords`)
+        with any of the given message types (or any type if none are given).
+        If a :class:`msgvis.apps.corpus.keywords.SearchHistory` is given, a query that
+        refines a recent one with few enough matches for an IN list
+        (``settings.LEVEL_FILTER_TEMP_TABLE_THRESHOLD``) is only evaluated among them.
+        Larger results are searched again in one statement rather than sent back to the database.
+        """
+        import numpy
+        from msgvis.apps.corpus import keywords
 
-        clauses = keywords_text.split(',')
-        inclusive_keywords = []
-        exclusive_keywords = []
-        queryset = self.tweet_words.all()
         message_queryset = self.message_set.all()
         if (len(include_types) > 0):
             message_queryset = message_queryset.filter(utils.levels_or('type__name', map(lambda x: x.name, include_types)))
-        final_queryset = self.message_set.none()
-        for clause in clauses:
-            if clause.startswith("NOT "):
-                words = clause[4:].split(' ')
-                word_list = utils.get_word_objs(queryset=queryset, text_field_name='original_text', related_field_name="tweet_words__id", words=words)
-                if len(word_list) > 0:
-                    # TODO: makes this real AND
-                    #and_word_list = reduce(operator.or_, word_list)
-                    exclusive_keywords.extend(word_list)
-
-            else:
-                words = clause.split(' ')
-                word_list = utils.get_word_objs(queryset=queryset, text_field_name='original_text', related_field_name="tweet_words__id", words=words)
-                if len(word_list) > 0:
-                    #and_word_list = reduce(operator.and_, word_list)
-                    #inclusive_keywords.append(and_word_list)
-                    clause_queryset = message_queryset
-                    for or_word_list in word_list:
-                        clause_queryset = clause_queryset.filter(or_word_list)
-
-
-                    final_queryset |= clause_queryset
-
-
-        queryset = final_queryset
 
-
-        #if len(inclusive_keywords) > 0:
-        #    inclusive_keywords = reduce(operator.or_, inclusive_keywords)
-        #    queryset = queryset.filter(inclusive_keywords)
-
-        if len(exclusive_keywords) > 0:
-            for word in exclusive_keywords:
-                queryset = queryset.exclude(word)
-
-        return queryset.distinct()
+        query = keywords.parse(keywords_text)
+        if history is None or query is None:
+            return message_queryset.filter(keywords.SQLPlan(self).compile(query))
+
+        max_ids = getattr(settings, 'LEVEL_FILTER_TEMP_TABLE_THRESHOLD', 500)
+        dataset_key = (self.id, self.get_data_version())
+        types = tuple(sorted(x.name for x in include_types))
+        within, exact = history.find(dataset_key, types, query)
+        if within is not None and len(within) <= max_ids:
+            message_queryset = message_queryset.filter(id__in=within.tolist())
+            if exact:
+                return message_queryset
+
+        matches = message_queryset.filter(keywords.SQLPlan(self).compile(query))
+        ids = list(matches.order_by('id').values_list('id', flat=True)[:max_ids + 1])
+        if len(ids) <= max_ids:
+            history.remember(dataset_key, types, query, numpy.array(ids, dtype=numpy.int64))
+        return matches
+
+    def get_advanced_search_ids(self, keywords_text, include_types, history=None):
+        """
+        The sorted ids (a numpy array) of the messages matching a keyword query, from the
+        posting lists of the word index (see :mod:`msgvis.apps.enhance.word_index`).
+        Returns None if the index has not been built or is out of date, or if the search
+        is restricted to message types, which are only known to the database.
+        A history is used as in :meth:`get_advanced_search_results`.
+        """
+        from msgvis.apps.corpus import keywords
+        from msgvis.apps.enhance.word_index import WordIndex
+
+        if len(include_types) > 0:
+            return None
+
+        query = keywords.parse(keywords_text)
+
+        index = WordIndex.load(self.id)
+        if index is None:
+            return None
+
+        within = None
+        if history is not None and query is not None:
+            dataset_key = (self.id, index.data_version)
+            within, exact = history.find(dataset_key, (), query)
+            if exact:
+                return within
+
+        ids = keywords.PostingListPlan(index, within=within).evaluate(query)
+        if history is not None and query is not None:
+            history.remember(dataset_key, (), query, ids)
+        return ids
+
+    def search_messages(self, keywords_text, include_types, history=None):
+        """
+        The messages matching a keyword query, to be paged through. If the word index can
+        answer the query, only the messages of the page shown are fetched
+        (see :class:`msgvis.apps.corpus.keywords.MessageIdResults`).
+        Otherwise this is :meth:`get_advanced_search_results`.
+        """
+        from msgvis.apps.corpus import keywords
+
+        ids = self.get_advanced_search_ids(keywords_text, include_types, history=history)
+        if ids is not None:
+            return keywords.MessageIdResults(self.message_set.all(), ids)
+        return self.get_advanced_search_results(keywords_text, include_types, history=history)
 
     def get_precalc_distribution(self, dimension, search_key=None, page=None, page_size=100, mode=None):
         dimension_key = dimension.key
@@ -198,6 +269,62 @@ class Dataset(models.Model):
 
         return results
 
+    def get_precalc_pair_distribution(self, primary_dimension, secondary_dimension, mode=None):
+        """
+        Get a precalculated distribution over two categorical dimensions.
+        Returns None if the pair has not been precalculated or if the
+        precalculated levels cannot answer the requested mode.
+        """
+        primary_key = primary_dimension.key
+        secondary_key = secondary_dimension.key
+        distribution = self.pair_distributions.filter(primary_dimension_key=primary_key,
+                                                      secondary_dimension_key=secondary_key)
+        distribution = list(distribution.order_by('primary_rank', 'secondary_rank'))
+        if len(distribution) == 0:
+            return None
+
+        primary_other = u'Other ' + primary_dimension.name
+        secondary_other = u'Other ' + secondary_dimension.name
+        has_others = any(x.primary_level == primary_other or x.secondary_level == secondary_other
+                         for x in distribution)
+
+        if mode != "omit_others" and mode != "enable_others" and has_others:
+            # only the top levels were precalculated
+            return None
+
+        if mode == "omit_others":
+            distribution = filter(lambda x: x.primary_level != primary_other and x.secondary_level != secondary_other,
+                                  distribution)
+
+        primary_ranks = {}
+        secondary_ranks = {}
+        for x in distribution:
+            primary_ranks[x.primary_level] = x.primary_rank
+            secondary_ranks[x.secondary_level] = x.secondary_rank
+
+        domains = {}
+        domain_labels = {}
+
+        domains[primary_key] = sorted(primary_ranks.keys(), key=lambda x: primary_ranks[x])
+        domains[secondary_key] = sorted(secondary_ranks.keys(), key=lambda x: secondary_ranks[x])
+
+        for dimension in (primary_dimension, secondary_dimension):
+            labels = dimension.get_domain_labels(domains[dimension.key])
+            if labels is not None:
+                domain_labels[dimension.key] = labels
+
+        table = map(lambda x: {primary_key: x.primary_level,
+                               secondary_key: x.secondary_level,
+                               "value": x.count}, distribution)
+
+        results = {
+            "table": table,
+            "domains": domains,
+            "domain_labels": domain_labels
+        }
+
+        return results
+
 
 
 
@@ -343,6 +470,15 @@ class Message(models.Model):
         index_together = (
             ('dataset', 'original_id'),  # used by importer
             ('dataset', 'time'),
+            ('dataset', 'time_minute'),  # used for binning by time
+            ('dataset', 'time_hour'),
+            ('dataset', 'time_day'),
+            ('dataset', 'sender_message_count'),  # used for binning by sender counters
+            ('dataset', 'sender_replied_to_count'),
+            ('dataset', 'sender_shared_count'),
+            ('dataset', 'sender_mentioned_count'),
+            ('dataset', 'sender_friend_count'),
+            ('dataset', 'sender_follower_count'),
         )
             
     dataset = models.ForeignKey(Dataset)
@@ -357,9 +493,58 @@ class Message(models.Model):
     sender = models.ForeignKey(Person, null=True, blank=True, default=None)
     """The :class:`Person` who sent the message"""
 
+    # A snapshot of the sender's counters, so messages can be binned by them without joining Person
+    sender_message_count = models.PositiveIntegerField(null=True, blank=True, default=None)
+    """The sender's :attr:`Person.message_count`"""
+
+    sender_replied_to_count = models.PositiveIntegerField(null=True, blank=True, default=None)
+    """The sender's :attr:`Person.replied_to_count`"""
+
+    sender_shared_count = models.PositiveIntegerField(null=True, blank=True, default=None)
+    """The sender's :attr:`Person.shared_count`"""
+
+    sender_mentioned_count = models.PositiveIntegerField(null=True, blank=True, default=None)
+    """The sender's :attr:`Person.mentioned_count`"""
+
+    sender_friend_count = models.PositiveIntegerField(null=True, blank=True, default=None)
+    """The sender's :attr:`Person.friend_count`"""
+
+    sender_follower_count = models.PositiveIntegerField(null=True, blank=True, default=None)
+    """The sender's :attr:`Person.follower_count`"""
+
+    SENDER_COUNTERS = (
+        ('sender_message_count', 'message_count'),
+        ('sender_replied_to_count', 'replied_to_count'),
+        ('sender_shared_count', 'shared_count'),
+        ('sender_mentioned_count', 'mentioned_count'),
+        ('sender_friend_count', 'friend_count'),
+        ('sender_follower_count', 'follower_count'),
+    )
+    """The sender counter fields and the :class:`Person` fields they copy"""
+
     time = models.DateTimeField(null=True, blank=True, default=None)
     """The :py:class:`datetime.datetime` (in UTC) when the message was sent"""
 
+    time_epoch = models.BigIntegerField(null=True, blank=True, default=None)
+    """The time in seconds since the epoch"""
+
+    time_minute = models.BigIntegerField(null=True, blank=True, default=None)
+    """The start of the minute of the time, in seconds since the epoch"""
+
+    time_hour = models.BigIntegerField(null=True, blank=True, default=None)
+    """The start of the hour of the time, in seconds since the epoch"""
+
+    time_day = models.BigIntegerField(null=True, blank=True, default=None)
+    """The start of the (UTC) day of the time, in seconds since the epoch"""
+
+    TIME_BUCKETS = (
+        ('time_day', 86400),
+        ('time_hour', 3600),
+        ('time_minute', 60),
+        ('time_epoch', 1),
+    )
+    """The time bucket fields and their sizes in seconds, largest first"""
+
     language = models.ForeignKey(Language, null=True, blank=True, default=None)
     """The :class:`Language` of the message."""
 
@@ -429,6 +614,38 @@ class Message(models.Model):
         return url
 
 
+    def set_time_buckets(self):
+        """Update the epoch and time bucket fields from the time"""
+        time = self._meta.get_field('time').to_python(self.time)
+        if time is None:
+            epoch = None
+        else:
+            epoch = utils.epoch_seconds(time)
+
+        for field_name, bucket_size in self.TIME_BUCKETS:
+            value = bucket_size * (epoch // bucket_size) if epoch is not None else None
+            setattr(self, field_name, value)
+
+    def set_sender_counters(self):
+        """
+        Copy the sender's current counters onto the message. The sender is not fetched:
+        if only the sender_id is known, the counters are left for
+        :func:`msgvis.apps.corpus.utils.refresh_sender_counters`.
+        """
+        sender = None
+        if self.sender_id is not None:
+            sender = getattr(self, Message._meta.get_field('sender').get_cache_name(), None)
+            if sender is None or sender.id != self.sender_id:
+                return
+        for field_name, person_field_name in self.SENDER_COUNTERS:
+            value = getattr(sender, person_field_name) if sender is not None else None
+            setattr(self, field_name, value)
+
+    def save(self, *args, **kwargs):
+        self.set_time_buckets()
+        self.set_sender_counters()
+        super(Message, self).save(*args, **kwargs)
+
     def __repr__(self):
         return str(self.time) + " || " + self.text
 
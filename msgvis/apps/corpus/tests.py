@@ -2,9 +2,12 @@ from datetime import datetime
 
 from unittest import skip
 from django.test import TestCase
+import mock
 
 from msgvis.apps.corpus import models as corpus_models
+from msgvis.apps.corpus import utils
 from msgvis.apps.dimensions import registry
+from msgvis.apps.base.tests import PrecalcTestCaseMixins
 
 class DatasetModelTest(TestCase):
     def test_created_at_set(self):
@@ -26,6 +29,67 @@ class MessageModelTest(TestCase):
         self.assertEquals(msgs.count(), 1)
         self.assertEquals(msgs.first().text, "Some text")
 
+    def test_time_buckets_set_on_save(self):
+        """Saving a message should fill in its epoch and time bucket fields."""
+        msg = corpus_models.Message.objects.create(dataset=self.dataset, text="Some text",
+                                                   time="2015-02-02T01:19:02Z")
+
+        self.assertEquals(msg.time_epoch, 1422839942)
+        self.assertEquals(msg.time_minute, 1422839940)
+        self.assertEquals(msg.time_hour, 1422838800)
+        self.assertEquals(msg.time_day, 1422835200)
+
+        msg = corpus_models.Message.objects.create(dataset=self.dataset, text="No time")
+        self.assertIsNone(msg.time_epoch)
+        self.assertIsNone(msg.time_day)
+
+    def test_backfill_time_buckets(self):
+        """The time buckets can be filled in for existing messages."""
+        from django.db import connection
+        from msgvis.apps.corpus import utils
+
+        msg = corpus_models.Message.objects.create(dataset=self.dataset, text="Some text",
+                                                   time="2015-02-02T01:19:02Z")
+        corpus_models.Message.objects.filter(id=msg.id).update(time_epoch=None, time_minute=None,
+                                                               time_hour=None, time_day=None)
+
+        utils.backfill_time_buckets(connection, self.dataset.id)
+
+        msg = corpus_models.Message.objects.get(id=msg.id)
+        self.assertEquals(msg.time_epoch, 1422839942)
+        self.assertEquals(msg.time_minute, 1422839940)
+        self.assertEquals(msg.time_hour, 1422838800)
+        self.assertEquals(msg.time_day, 1422835200)
+
+
+    def test_sender_counters_set_on_save(self):
+        """Saving a message should copy its sender's counters."""
+        sender = corpus_models.Person.objects.create(dataset=self.dataset, follower_count=10, friend_count=3)
+        msg = corpus_models.Message.objects.create(dataset=self.dataset, text="Some text", sender=sender)
+
+        self.assertEquals(msg.sender_follower_count, 10)
+        self.assertEquals(msg.sender_friend_count, 3)
+        self.assertEquals(msg.sender_message_count, 0)
+
+        # saving with only the sender id should not fetch the sender
+        msg = corpus_models.Message.objects.get(id=msg.id)
+        with self.assertNumQueries(1):
+            msg.save()
+
+    def test_refresh_sender_counters(self):
+        """Messages can be updated with the current sender counters."""
+        from django.db import connection
+        from msgvis.apps.corpus import utils
+
+        sender = corpus_models.Person.objects.create(dataset=self.dataset, follower_count=10)
+        msg = corpus_models.Message.objects.create(dataset=self.dataset, text="Some text", sender=sender)
+        no_sender = corpus_models.Message.objects.create(dataset=self.dataset, text="No sender")
+
+        corpus_models.Person.objects.filter(id=sender.id).update(follower_count=25)
+        utils.refresh_sender_counters(connection, self.dataset.id)
+
+        self.assertEquals(corpus_models.Message.objects.get(id=msg.id).sender_follower_count, 25)
+        self.assertIsNone(corpus_models.Message.objects.get(id=no_sender.id).sender_follower_count)
 
 class GetExampleMessageTest(TestCase):
     def generate_some_messages(self, dataset):
@@ -126,3 +190,261 @@ class GetExampleMessageTest(TestCase):
         filters = {}
         msgs = self.dataset.get_example_messages(filters)
         self.assertEquals(msgs.count(), 2)
+
+
+class LevelsOrTest(TestCase):
+    """Test matching messages with any of a set of levels"""
+
+    def setUp(self):
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        for text in ["one", "two", "three"]:
+            hashtag = corpus_models.Hashtag.objects.create(text=text)
+            msg = self.dataset.message_set.create(text="#" + text, shared_count=len(text))
+            msg.hashtags.add(hashtag)
+        self.dataset.message_set.create(text="no hashtags", shared_count=0)
+
+    def assertMatches(self, q, texts):
+        msgs = self.dataset.message_set.filter(q)
+        self.assertEquals(sorted(msgs.values_list('text', flat=True)), sorted(texts))
+
+    def test_in_list(self):
+        """Levels should match through related fields, with empty levels matching nulls"""
+        self.assertMatches(utils.levels_or('hashtags__text', ['one', 'three']), ['#one', '#three'])
+        self.assertMatches(utils.levels_or('hashtags__text', ['two', None]), ['#two', 'no hashtags'])
+        self.assertMatches(utils.levels_or('hashtags__text', []), [])
+
+    def test_temp_table(self):
+        """Long lists of levels should give the same matches through a temporary table"""
+        with self.settings(LEVEL_FILTER_TEMP_TABLE_THRESHOLD=1):
+            self.assertMatches(utils.levels_or('hashtags__text', ['one', 'three', 'four']), ['#one', '#three'])
+            self.assertMatches(utils.levels_or('shared_count', [3, 5, None]), ['#one', '#two', '#three'])
+            self.assertMatches(utils.levels_or('hashtags__text', ['two', 'four', '']), ['#two', 'no hashtags'])
+
+            ids = corpus_models.Hashtag.objects.filter(text__in=['one', 'two']).values_list('id', flat=True)
+            self.assertMatches(utils.levels_or('hashtags__id', list(ids)), ['#one', '#two'])
+            self.assertEquals(self.dataset.message_set.exclude(utils.levels_or('hashtags__text', ['one', 'two'])).count(), 2)
+
+    def test_temp_table_copies(self):
+        """Each reference to a temporary table should read its own copy where tables open only once"""
+        from django.db import connection
+
+        with self.settings(LEVEL_FILTER_TEMP_TABLE_THRESHOLD=1), \
+                mock.patch.object(utils, 'SINGLE_REFERENCE_TEMP_TABLE_VENDORS', (connection.vendor,)):
+            with utils.dropping_temp_tables():
+                q = utils.levels_or('hashtags__text', ['one', 'three', 'four'])
+                table_name = q.children[0][1]
+
+                subquery = self.dataset.message_set.filter(q).values('id')
+                msgs = self.dataset.message_set.filter(q, id__in=subquery)
+                query = unicode(msgs.query)
+                self.assertNotIn(table_name, query)
+                self.assertEquals(query.count('level_copy_'), 2)
+
+                self.assertEquals(sorted(msgs.values_list('text', flat=True)), ['#one', '#three'])
+
+    def temp_table_count(self):
+        from django.db import connection
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM sqlite_temp_master WHERE type = 'table' AND name LIKE 'level_filter_%'")
+        return cursor.fetchone()[0]
+
+    def test_temp_tables_dropped(self):
+        """The temporary tables should be dropped after the block or request that created them"""
+        from django.db import connection
+        if connection.vendor != 'sqlite':
+            self.skipTest("Counts sqlite temporary tables")
+
+        with self.settings(LEVEL_FILTER_TEMP_TABLE_THRESHOLD=1):
+            with utils.dropping_temp_tables():
+                self.assertMatches(utils.levels_or('hashtags__text', ['one', 'three']), ['#one', '#three'])
+                self.assertEquals(self.temp_table_count(), 1)
+            self.assertEquals(self.temp_table_count(), 0)
+
+            self.assertMatches(utils.levels_or('hashtags__text', ['one', 'three']), ['#one', '#three'])
+            utils.drop_registered_temp_tables()
+            self.assertEquals(self.temp_table_count(), 0)
+
+
+class KeywordQueryTest(PrecalcTestCaseMixins, TestCase):
+    """Test parsing and evaluating keyword queries"""
+
+    def setUp(self):
+        super(KeywordQueryTest, self).setUp()
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        self.create_word_messages(self.dataset, {'bowl': 'bowl', 'bowls': 'bowl', 'super': 'super', 'ads': 'ad'},
+                                  ["super bowl", "super bowls ads", "bowl ads", "super ads", "nothing"])
+
+    def assertMatches(self, keywords_text, texts):
+        messages = self.dataset.get_advanced_search_results(keywords_text, [])
+        self.assertEquals(sorted(messages.values_list('text', flat=True)), sorted(texts))
+
+    def test_normalize(self):
+        """Repeated words and clauses, and clauses implied by others, should be removed"""
+        from msgvis.apps.corpus.keywords import parse, Term, And, Or, Difference
+
+        self.assertEquals(parse("Super  bowl,bowl super,super bowl ads"), And([Term('super'), Term('bowl')]))
+        self.assertEquals(parse("bowl, ads,NOT super"), Difference(Or([Term('bowl'), Term('ads')]), Term('super')))
+        self.assertIsNone(parse(" , NOT bowl"))
+
+    def test_and(self):
+        """All of a clause's words should be required, and unknown words match nothing"""
+        self.assertMatches("super bowl", ["super bowl", "super bowls ads"])
+        self.assertMatches("super missing", [])
+        self.assertMatches("super missing,bowl ads", ["super bowls ads", "bowl ads"])
+
+    def test_not(self):
+        """A NOT clause should exclude the messages containing all of its words"""
+        self.assertMatches("super,NOT bowl ads", ["super bowl", "super ads"])
+        self.assertMatches("super,NOT bowl,NOT missing", ["super ads"])
+
+    def test_one_statement(self):
+        """The whole query should run as one statement after resolving the words"""
+        from msgvis.apps.corpus import keywords
+
+        q = keywords.SQLPlan(self.dataset).compile(keywords.parse("super bowl,ads,NOT bowl ads"))
+        with self.assertNumQueries(1):
+            texts = list(self.dataset.message_set.filter(q).values_list('text', flat=True))
+        self.assertEquals(sorted(texts), ["super ads", "super bowl"])
+
+    def test_refines(self):
+        """Adding words or NOT clauses, or removing clauses, should refine a query"""
+        from msgvis.apps.corpus.keywords import parse, refines
+
+        self.assertTrue(refines(parse("super bowl"), parse("super")))
+        self.assertTrue(refines(parse("super,NOT ads"), parse("super")))
+        self.assertTrue(refines(parse("super"), parse("super,bowl")))
+        self.assertTrue(refines(parse("super,NOT ads"), parse("super,NOT bowl ads")))
+        self.assertFalse(refines(parse("super,bowl"), parse("super")))
+        self.assertFalse(refines(parse("super"), parse("super,NOT ads")))
+        self.assertFalse(refines(parse("super,NOT bowl ads"), parse("super,NOT ads")))
+
+    def test_search_history(self):
+        """A refined search should only look among the messages of the previous one"""
+        from msgvis.apps.corpus.keywords import SearchHistory, parse
+
+        history = SearchHistory(size=2)
+        messages = self.dataset.get_advanced_search_results("super", [], history=history)
+        self.assertEquals(messages.count(), 3)
+
+        # forget that "super ads" matches the earlier search
+        dataset_key = (self.dataset.id, self.dataset.get_data_version())
+        ids, exact = history.find(dataset_key, (), parse("super"))
+        self.assertTrue(exact)
+        ads = self.dataset.message_set.get(text="super ads")
+        history.remember(dataset_key, (), parse("super"), ids[ids != ads.id])
+
+        messages = self.dataset.get_advanced_search_results("super ads", [], history=history)
+        self.assertEquals(list(messages.values_list('text', flat=True)), ["super bowls ads"])
+
+        # not a refinement, so searched from scratch
+        messages = self.dataset.get_advanced_search_results("ads", [], history=history)
+        self.assertEquals(messages.count(), 3)
+        self.assertEquals(len(history.entries), 2)
+
+        # new messages change the data version, so nothing is remembered for them
+        self.create_word_messages(self.dataset, {'super': 'super', 'ads': 'ad'}, ["super ads"])
+        messages = self.dataset.get_advanced_search_results("super ads", [], history=history)
+        self.assertEquals(messages.count(), 3)
+
+    def test_search_history_large_results(self):
+        """Results too large for an IN list should be searched again rather than remembered"""
+        from django.test.utils import override_settings
+        from msgvis.apps.corpus.keywords import SearchHistory
+
+        history = SearchHistory()
+        with override_settings(LEVEL_FILTER_TEMP_TABLE_THRESHOLD=2):
+            messages = self.dataset.get_advanced_search_results("super", [], history=history)
+            self.assertEquals(messages.count(), 3)
+            self.assertEquals(len(history.entries), 0)
+
+            messages = self.dataset.get_advanced_search_results("super ads", [], history=history)
+            self.assertEquals(messages.count(), 2)
+            self.assertEquals(len(history.entries), 1)
+
+    def test_session_histories(self):
+        """Sessions without a key should not share a history, and all sessions share one limit"""
+        import numpy
+        from django.test.utils import override_settings
+        from msgvis.apps.corpus import keywords
+
+        self.assertIsNone(keywords.get_search_history(None))
+
+        dataset_key = (self.dataset.id, self.dataset.get_data_version())
+        with override_settings(SEARCH_HISTORY_MAX_TOTAL_IDS=5):
+            first = keywords.get_search_history('first')
+            first.remember(dataset_key, (), keywords.parse("super"), numpy.arange(3))
+            second = keywords.get_search_history('second')
+            second.remember(dataset_key, (), keywords.parse("bowl"), numpy.arange(3))
+
+        self.assertEquals(len(first.entries), 0)
+        self.assertEquals(len(second.entries), 1)
+        keywords._histories.clear()
+
+
+class FullTextSearchTest(TestCase):
+    """Test phrase, prefix and substring searches of the message text"""
+
+    def setUp(self):
+        from msgvis.apps.corpus import fulltext
+
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        self.tweet = corpus_models.MessageType.objects.create(name="tweet")
+        for text in ["the super bowl", "super bowls and ads", "a bowl of soup", "superbowl party", "nothing"]:
+            self.dataset.message_set.create(text=text, type=self.tweet)
+
+        self.backend = fulltext.get_backend()
+        if self.backend.is_supported():
+            self.backend.install()
+
+    def tearDown(self):
+        self.backend.uninstall()
+
+    def requireIndex(self):
+        if not self.backend.is_supported():
+            self.skipTest("The database cannot build a full-text index (e.g. SQLite without FTS5)")
+
+    def assertFinds(self, backend, text, mode, texts):
+        results = backend.search(self.dataset, text, mode)
+        self.assertEquals(results.count(), len(texts))
+        self.assertEquals(sorted(message.text for message in results[:]), sorted(texts))
+
+    def test_modes(self):
+        """Phrases should match whole words in order, prefixes the start of words and substrings anywhere"""
+        self.requireIndex()
+        self.assertTrue(self.backend.is_installed())
+        self.assertFinds(self.backend, "super bowl", 'phrase', ["the super bowl"])
+        self.assertFinds(self.backend, "sup bowl", 'prefix', ["the super bowl", "super bowls and ads"])
+        self.assertFinds(self.backend, "erbow", 'substring', ["superbowl party"])
+        self.assertFinds(self.backend, "ow", 'substring',
+                         ["the super bowl", "super bowls and ads", "a bowl of soup", "superbowl party"])
+        self.assertFinds(self.backend, " ", 'phrase', [])
+        self.assertRaises(ValueError, self.backend.search, self.dataset, "bowl", 'regex')
+
+    def test_scan(self):
+        """Without an index the text should be scanned, where a phrase can end inside a word"""
+        from msgvis.apps.corpus import fulltext
+
+        backend = fulltext.FullTextBackend()
+        self.assertFinds(backend, "super bowl", 'phrase', ["the super bowl", "super bowls and ads"])
+        self.assertFinds(backend, "sup bowl", 'prefix', ["the super bowl", "super bowls and ads"])
+        self.assertFinds(backend, "erbow", 'substring', ["superbowl party"])
+        self.assertFinds(backend, "100%", 'substring', [])
+
+    def test_new_messages_and_types(self):
+        """Messages added after the index was built should be found, and types should filter them"""
+        self.requireIndex()
+        retweet = corpus_models.MessageType.objects.create(name="retweet")
+        self.dataset.message_set.create(text="RT the super bowl", type=retweet)
+
+        self.assertEquals(self.backend.search(self.dataset, "super bowl", 'phrase').count(), 2)
+        results = self.backend.search(self.dataset, "super bowl", 'phrase', [retweet])
+        self.assertEquals([message.text for message in results[0:10]], ["RT the super bowl"])
+
+    def test_paging(self):
+        """Slices should fetch only their page, in the same order as the whole results"""
+        results = self.backend.search(self.dataset, "bowl", 'prefix')
+        ids = results.ids()
+        self.assertEquals(len(ids), 3)
+        self.assertEquals([message.id for message in results[1:3]], ids[1:3])
+        self.assertEquals(results[2].id, ids[2])
+        self.assertEquals(results[3:10], [])
@@ -6,6 +6,13 @@ import os
 import os.path
 from django.db.models import Q
 import operator
+import calendar
+import uuid
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from django.utils import timezone
+from django.core.signals import request_finished
 
 def get_embedded_html(tweet_original_id):
 
@@ -58,41 +65,284 @@ def render_html_tag(text):
     text = re.sub(pattern, render_link_html, text)
     return text
 
-def quote_query(matchobj):
-    return "'" + matchobj.group(0) + "'"
+def levels_or(field_name, domain, model=None):
+    """
+    Return a Q object matching messages with any of the levels of a field.
+    Empty levels match null values. Long lists of levels are loaded into a temporary
+    table (see :func:`levels_in_temp_table`) instead of being sent as an IN list.
+    """
+    from django.conf import settings
 
-def quote(text):
-    pattern = r'(?<== )\d+\-\d+\-\d+ \d+:\d+:\d+|(?<== )[\da-zA-Z_#\-.]+(?=[ )])'
-    text = re.sub(pattern, quote_query, text)
-    return text
+    levels = []
+    include_null = False
+    for level in domain:
+        if level is None or unicode(level).strip() == "":
+            include_null = True
+        else:
+            levels.append(level)
 
-def convert_boolean(query):
-    query = query.replace('\'True\'', "1")
-    query = query.replace('\'False\'', "0")
-    return query
+    conditions = []
+    if len(levels) > getattr(settings, 'LEVEL_FILTER_TEMP_TABLE_THRESHOLD', 500):
+        conditions.append(levels_in_temp_table(field_name, levels, model=model))
+    elif len(levels) > 0:
+        conditions.append(Q((field_name + "__in", levels)))
 
-def quote(text):
-    pattern = r'(?<== )\d+\-\d+\-\d+ \d+:\d+:\d+|(?<== )[\da-zA-Z_#\-.]+(?=[ )])'
-    text = re.sub(pattern, quote_query, text)
-    return text
+    if include_null:
+        conditions.append(Q((field_name + "__isnull", True)))
 
-def levels_or(field_name, domain):
-    filter_ors = []
-    for level in domain:
-        if level is None or str(level).strip() == "":
-            filter_ors.append((field_name + "__isnull", True))
+    if len(conditions) == 0:
+        # matches nothing
+        return Q(pk__in=[])
+
+    return reduce(operator.or_, conditions)
+
+
+def _resolve_field(model, field_name):
+    """Follow a field expression like hashtags__text from the model to the final field"""
+    parts = field_name.split('__')
+    for part in parts[:-1]:
+        field, field_model, direct, m2m = model._meta.get_field_by_name(part)
+        if direct:
+            model = field.rel.to
         else:
-            filter_ors.append((field_name, level))
+            model = field.model
+    return model._meta.get_field(parts[-1])
+
+
+def levels_in_temp_table(field_name, levels, model=None):
+    """
+    Load the levels into a new temporary table and return a Q object
+    matching messages with any of them, with the in_temporary_table lookup.
+
+    Temporary tables belong to the database connection, so the returned Q object
+    must be used on the same connection. The table is dropped at the end of the
+    request, or at the end of a :func:`dropping_temp_tables` block.
+    """
+    from django.db import connection, models
+    from msgvis.apps.corpus.models import Message
+
+    if model is None:
+        model = Message
+
+    field = _resolve_field(model, field_name)
+    if isinstance(field, models.AutoField):
+        # the levels are ids, the column should not generate them
+        column_type = models.IntegerField().db_type(connection)
+    else:
+        column_type = field.db_parameters(connection)['type']
+
+    table_name = _create_temp_table('level_filter', column_type)
+
+    cursor = connection.cursor()
+    qn = connection.ops.quote_name
+    cursor.executemany("INSERT INTO %s (%s) VALUES (%%s)" % (qn(table_name), qn('level')),
+                       [(level,) for level in levels])
+    _registered_temp_tables().append(table_name)
+
+    return Q((field_name + "__in_temporary_table", table_name))
+
+
+def _create_temp_table(prefix, column_type, constraint=""):
+    """Create a temporary table with one column named level and return its name"""
+    from django.db import connection
+
+    table_name = '%s_%s' % (prefix, uuid.uuid4().hex[:16])
+    qn = connection.ops.quote_name
+
+    cursor = connection.cursor()
+    cursor.execute("CREATE TEMPORARY TABLE %s (%s %s %s)" % (qn(table_name), qn('level'), column_type, constraint))
+    return table_name
+
+
+# Databases that cannot open a temporary table twice in one query
+SINGLE_REFERENCE_TEMP_TABLE_VENDORS = ('mysql',)
+
+
+def temp_table_reference(table_name, connection):
+    """
+    The name of the table a query should read for one reference to a temporary table.
+
+    MySQL cannot open a temporary table twice in one query, which happens when a
+    filter also ends up in a subquery, so there each reference reads its own copy.
+    The copies are dropped with the level filter tables.
+    """
+    if connection.vendor not in SINGLE_REFERENCE_TEMP_TABLE_VENDORS:
+        return table_name
+
+    copy_name = 'level_copy_%s' % uuid.uuid4().hex[:16]
+    qn = connection.ops.quote_name
+
+    cursor = connection.cursor()
+    cursor.execute("CREATE TEMPORARY TABLE %s AS SELECT %s FROM %s" % (qn(copy_name), qn('level'), qn(table_name)))
+    _registered_temp_tables().append(copy_name)
+    return copy_name
+
+
+def messages_in_temp_table(queryset):
+    """
+    Copy the ids of a set of messages into a new temporary table, so the set
+    can be filtered once and reused by several queries with
+    ``Q(pk__in_temporary_table=table_name)``. Returns the table name.
+    """
+    from django.db import connection, models
+    from msgvis.apps.base import sql
+
+    column_type = models.IntegerField().db_type(connection)
+    table_name = _create_temp_table('message_set', column_type, "PRIMARY KEY")
+
+    query, params = sql.compile_queryset(queryset.values('pk').distinct().order_by())
+    qn = connection.ops.quote_name
+
+    cursor = connection.cursor()
+    cursor.execute("INSERT INTO %s (%s) %s" % (qn(table_name), qn('level'), query), params)
+    return table_name
+
+
+def drop_temp_table(table_name, if_exists=False):
+    """Drop a temporary table before the connection closes"""
+    from django.db import connection
+
+    # mysql would otherwise drop a permanent table with the same name
+    statement = "DROP TEMPORARY TABLE" if connection.vendor == 'mysql' else "DROP TABLE"
+    if if_exists:
+        # e.g. created in a transaction that was rolled back
+        statement += " IF EXISTS"
+
+    cursor = connection.cursor()
+    cursor.execute("%s %s" % (statement, connection.ops.quote_name(table_name)))
+
+
+_temp_tables = threading.local()
+
+
+def _registered_temp_tables():
+    """The names of the level filter tables this thread has created and not dropped yet"""
+    if not hasattr(_temp_tables, 'names'):
+        _temp_tables.names = []
+    return _temp_tables.names
+
+
+def drop_registered_temp_tables(**kwargs):
+    """Drop the level filter tables that have been created. Runs at the end of every request."""
+    from django.db import connection
+
+    names = _registered_temp_tables()
+    # closing the connection already dropped them
+    if connection.connection is not None:
+        for table_name in names:
+            drop_temp_table(table_name, if_exists=True)
+    del names[:]
+
+request_finished.connect(drop_registered_temp_tables, dispatch_uid='corpus_drop_registered_temp_tables')
+
+
+@contextmanager
+def dropping_temp_tables():
+    """
+    Drop the level filter tables created inside the block when it ends,
+    for long-running commands that never finish a request.
+    """
+    from django.db import connection
+
+    names = _registered_temp_tables()
+    start = len(names)
+    try:
+        yield
+    finally:
+        if connection.connection is not None:
+            for table_name in names[start:]:
+                drop_temp_table(table_name, if_exists=True)
+        del names[start:]
+
+
+def epoch_seconds(value):
+    """The whole seconds since the epoch of a datetime (naive datetimes are taken as UTC)"""
+    return calendar.timegm(value.utctimetuple())
+
+
+def from_epoch_seconds(timestamp):
+    """The UTC datetime for seconds since the epoch (aware if time zones are in use)"""
+    from django.conf import settings
+
+    dt = datetime.utcfromtimestamp(timestamp)
+    if settings.USE_TZ:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+# Set the epoch seconds and the minute, hour and day bucket columns from the message time
+backfill_time_buckets_sql = {
+    'mysql': "UPDATE `corpus_message` SET "
+             "`time_epoch` = UNIX_TIMESTAMP(`time`), "
+             "`time_minute` = 60 * FLOOR(UNIX_TIMESTAMP(`time`) / 60), "
+             "`time_hour` = 3600 * FLOOR(UNIX_TIMESTAMP(`time`) / 3600), "
+             "`time_day` = 86400 * FLOOR(UNIX_TIMESTAMP(`time`) / 86400) "
+             "WHERE `time` IS NOT NULL",
+    'sqlite': "UPDATE `corpus_message` SET "
+              "`time_epoch` = CAST(STRFTIME('%%s', `time`) AS INTEGER), "
+              "`time_minute` = 60 * (CAST(STRFTIME('%%s', `time`) AS INTEGER) / 60), "
+              "`time_hour` = 3600 * (CAST(STRFTIME('%%s', `time`) AS INTEGER) / 3600), "
+              "`time_day` = 86400 * (CAST(STRFTIME('%%s', `time`) AS INTEGER) / 86400) "
+              "WHERE `time` IS NOT NULL",
+}
+
+
+def backfill_time_buckets(connection, dataset_id=None):
+    """
+    Fill in the epoch and time bucket columns of messages from their times in the database.
+    Returns the number of messages updated.
+    """
+    sql = backfill_time_buckets_sql[connection.vendor]
+    params = []
+    if dataset_id is not None:
+        sql += " AND `dataset_id` = %s"
+        params.append(dataset_id)
+
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return cursor.rowcount
+
+
+# Copy the sender counters from corpus_person onto corpus_message
+refresh_sender_counters_sql = {
+    'mysql': "UPDATE `corpus_message` INNER JOIN `corpus_person` "
+             "ON `corpus_message`.`sender_id` = `corpus_person`.`id` SET "
+             "`corpus_message`.`sender_message_count` = `corpus_person`.`message_count`, "
+             "`corpus_message`.`sender_replied_to_count` = `corpus_person`.`replied_to_count`, "
+             "`corpus_message`.`sender_shared_count` = `corpus_person`.`shared_count`, "
+             "`corpus_message`.`sender_mentioned_count` = `corpus_person`.`mentioned_count`, "
+             "`corpus_message`.`sender_friend_count` = `corpus_person`.`friend_count`, "
+             "`corpus_message`.`sender_follower_count` = `corpus_person`.`follower_count` "
+             "WHERE 1",
+    'sqlite': "UPDATE `corpus_message` SET "
+              "`sender_message_count` = (SELECT `message_count` FROM `corpus_person` "
+              "WHERE `corpus_person`.`id` = `corpus_message`.`sender_id`), "
+              "`sender_replied_to_count` = (SELECT `replied_to_count` FROM `corpus_person` "
+              "WHERE `corpus_person`.`id` = `corpus_message`.`sender_id`), "
+              "`sender_shared_count` = (SELECT `shared_count` FROM `corpus_person` "
+              "WHERE `corpus_person`.`id` = `corpus_message`.`sender_id`), "
+              "`sender_mentioned_count` = (SELECT `mentioned_count` FROM `corpus_person` "
+              "WHERE `corpus_person`.`id` = `corpus_message`.`sender_id`), "
+              "`sender_friend_count` = (SELECT `friend_count` FROM `corpus_person` "
+              "WHERE `corpus_person`.`id` = `corpus_message`.`sender_id`), "
+              "`sender_follower_count` = (SELECT `follower_count` FROM `corpus_person` "
+              "WHERE `corpus_person`.`id` = `corpus_message`.`sender_id`) "
+              "WHERE `sender_id` IS NOT NULL",
+}
 
-    return reduce(operator.or_, [Q(x) for x in filter_ors])
 
-def get_word_objs(queryset, text_field_name, related_field_name, words):
-    word_objs = []
-    for word in words:
-        obj = queryset.filter(Q((text_field_name, word)))
-        if obj.count() > 0:
-            word_obj = obj[0]
-            or_objs = levels_or(related_field_name, map(lambda x: x.id, word_obj.related_words))
-            word_objs.append(or_objs)
+def refresh_sender_counters(connection, dataset_id=None):
+    """
+    Copy the current counters of each message's sender onto the message,
+    e.g. after the importer has updated the people.
+    Returns the number of messages updated.
+    """
+    sql = refresh_sender_counters_sql[connection.vendor]
+    params = []
+    if dataset_id is not None:
+        sql += " AND `corpus_message`.`dataset_id` = %s"
+        params.append(dataset_id)
 
-    return word_objs
\ No newline at end of file
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return cursor.rowcount
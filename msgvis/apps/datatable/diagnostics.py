@@ -0,0 +1,187 @@
+"""
+Diagnostics for slow data table requests.
+
+:class:`QueryCapture` records every SQL statement run on a database connection,
+with its parameters, duration and number of rows fetched, and can then ask the
+database to ``EXPLAIN`` each ``SELECT``.
+
+.. code-block:: python
+
+    with QueryCapture() as capture:
+        datatable.generate(dataset, filters)
+    capture.explain()
+
+    capture.queries[0]
+    # {'sql': 'SELECT ...', 'params': [1], 'time': 0.231, 'rows': 52, 'explain': [...]}
+
+Data table requests slower than ``settings.DATATABLE_SLOW_REQUEST_SECONDS`` are logged
+(see :func:`log_slow_request`) so that they can be replayed with the
+``replay_table_request`` command.
+"""
+import json
+import logging
+from time import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends import utils as backend_utils
+
+slow_request_logger = logging.getLogger('msgvis.slow_tables')
+
+explain_prefixes = {
+    'mysql': 'EXPLAIN ',
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+}
+
+
+class CapturingCursorWrapper(backend_utils.CursorWrapper):
+    """A cursor that records its statements in a QueryCapture"""
+
+    def __init__(self, cursor, db, capture):
+        super(CapturingCursorWrapper, self).__init__(cursor, db)
+        self.capture = capture
+        self.current = None
+
+    def _record(self, sql, params, start):
+        self.current = {
+            'sql': sql,
+            'params': list(params) if params is not None else [],
+            'time': round(time() - start, 4),
+            'rows': None,
+        }
+        if self.cursor.rowcount is not None and self.cursor.rowcount >= 0:
+            # the number of rows changed (and for some backends, selected)
+            self.current['rows'] = self.cursor.rowcount
+        self.capture.queries.append(self.current)
+
+    def _count_rows(self, rows):
+        if self.current is not None and rows is not None:
+            if not self.current.get('fetched'):
+                self.current['rows'] = 0
+                self.current['fetched'] = True
+            self.current['rows'] += len(rows)
+        return rows
+
+    def execute(self, sql, params=None):
+        start = time()
+        try:
+            return super(CapturingCursorWrapper, self).execute(sql, params)
+        finally:
+            self._record(sql, params, start)
+
+    def executemany(self, sql, param_list):
+        start = time()
+        try:
+            return super(CapturingCursorWrapper, self).executemany(sql, param_list)
+        finally:
+            # the statement cannot be explained with a list of parameters
+            self._record(sql, None, start)
+            self.current['many'] = True
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        self._count_rows([row] if row is not None else [])
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        return self._count_rows(self.cursor.fetchmany(*args, **kwargs))
+
+    def fetchall(self):
+        return self._count_rows(self.cursor.fetchall())
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+
+class QueryCapture(object):
+    """Record the statements run on a connection while in the with block"""
+
+    def __init__(self, using='default'):
+        self.connection = connections[using]
+        self.queries = []
+        self.duration = None
+
+    def __enter__(self):
+        self._saved = (self.connection.use_debug_cursor, self.connection.__dict__.get('make_debug_cursor'))
+        self.connection.use_debug_cursor = True
+        self.connection.make_debug_cursor = lambda cursor: CapturingCursorWrapper(cursor, self.connection, self)
+        self._start = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = round(time() - self._start, 4)
+        use_debug_cursor, make_debug_cursor = self._saved
+        self.connection.use_debug_cursor = use_debug_cursor
+        if make_debug_cursor is None:
+            del self.connection.make_debug_cursor
+        else:
+            self.connection.make_debug_cursor = make_debug_cursor
+
+    def explain(self):
+        """Add the backend's query plan for each SELECT to the captured queries"""
+        for query in self.queries:
+            if query.get('many') or not query['sql'].lstrip().upper().startswith('SELECT'):
+                continue
+            query['explain'] = explain_query(self.connection, query['sql'], query['params'])
+        return self.queries
+
+    def get_report(self):
+        """The captured queries, without internal bookkeeping"""
+        return [dict((key, value) for key, value in query.iteritems() if key not in ('fetched', 'many'))
+                for query in self.queries]
+
+
+def explain_query(connection, sql, params):
+    """Return the rows of the backend's EXPLAIN output for a statement, as lists of strings"""
+    prefix = explain_prefixes.get(connection.vendor)
+    if prefix is None:
+        return None
+
+    # a plain cursor, so the EXPLAIN is not captured itself
+    cursor = backend_utils.CursorWrapper(connection._cursor(), connection)
+    try:
+        cursor.execute(prefix + sql, params)
+        return [[unicode(value) for value in row] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def evaluate_result(result):
+    """
+    Run the queries that a data table result holds lazily,
+    so they are captured with the rest of the request.
+    """
+    if not isinstance(result, dict):
+        return result
+    if result.get('table') is not None:
+        result['table'] = list(result['table'])
+    for key, domain in (result.get('domains') or {}).items():
+        if domain is not None:
+            result['domains'][key] = list(domain)
+    return result
+
+
+def canonical_request(data):
+    """The request body as JSON with sorted keys, so equal requests log the same way"""
+    return json.dumps(data, sort_keys=True)
+
+
+def log_slow_request(data, duration, queries=None):
+    """
+    Write the request to the slow request log if it took longer than the threshold.
+    Each line of the log is a JSON object with the duration and the request.
+    """
+    threshold = getattr(settings, 'DATATABLE_SLOW_REQUEST_SECONDS', None)
+    if threshold is None or duration < threshold:
+        return False
+
+    entry = {
+        'duration': round(duration, 4),
+        'request': json.loads(canonical_request(data)),
+    }
+    if queries is not None:
+        entry['queries'] = queries
+
+    slow_request_logger.warning(json.dumps(entry, sort_keys=True, default=unicode))
+    return True
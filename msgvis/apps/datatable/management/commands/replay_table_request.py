@@ -0,0 +1,80 @@
+import json
+
+from django.core.management.base import BaseCommand, make_option, CommandError
+from django.conf import settings
+
+
+class Command(BaseCommand):
+    help = "Replay a data table request and show the SQL statements it ran, with their timings and query plans."
+    args = "[<request json>]"
+    option_list = BaseCommand.option_list + (
+        make_option('--log',
+                    dest='log',
+                    default=None,
+                    help='A slow request log to read the request from (default logs/slow_tables.log)'),
+        make_option('--line',
+                    dest='line',
+                    default=-1,
+                    help='The line of the log to replay, counting from 1 (default the last line)'),
+        make_option('--no-explain',
+                    action='store_false',
+                    dest='explain',
+                    default=True,
+                    help='Skip the query plans'),
+    )
+
+    def handle(self, request_json=None, *args, **options):
+        if request_json is None:
+            request_data = self.read_log(options.get('log'), int(options.get('line')))
+        else:
+            try:
+                request_data = json.loads(request_json)
+            except ValueError:
+                raise CommandError("The request must be a JSON object.")
+
+        from msgvis.apps.api import serializers
+        from msgvis.apps.datatable import planner
+        from msgvis.apps.datatable.diagnostics import QueryCapture, evaluate_result
+
+        input = serializers.DataTableSerializer(data=request_data)
+        if not input.is_valid():
+            raise CommandError("Invalid request: %s" % json.dumps(input.errors))
+
+        with QueryCapture() as capture:
+            result, plan = planner.generate(planner.TableRequest(input.validated_data))
+            evaluate_result(result)
+        if options.get('explain'):
+            capture.explain()
+
+        for i, query in enumerate(capture.get_report()):
+            print "-- %d: %.4fs, %s rows" % (i + 1, query['time'], query['rows'])
+            print query['sql']
+            if query['params']:
+                print "-- params: %s" % json.dumps(query['params'], default=unicode)
+            for row in query.get('explain') or []:
+                print "--   " + " | ".join(row)
+            print
+
+        print "%d statements in %.4fs using the %s strategy" % (len(capture.queries), capture.duration,
+                                                               plan['strategy'])
+
+    def read_log(self, log_path, line):
+        if log_path is None:
+            log_path = settings.LOGS_ROOT / 'slow_tables.log'
+
+        try:
+            with open(log_path) as log:
+                lines = [l for l in log.read().splitlines() if l.strip()]
+        except IOError:
+            raise CommandError("Could not read %s" % log_path)
+
+        index = line - 1 if line > 0 else line
+        try:
+            entry = json.loads(lines[index])
+        except IndexError:
+            raise CommandError("%s has no line %d" % (log_path, line))
+        except ValueError:
+            raise CommandError("The log line is not JSON.")
+
+        print "Replaying a request that took %.4fs" % entry['duration']
+        return entry['request']
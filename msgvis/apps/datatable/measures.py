@@ -0,0 +1,186 @@
+"""
+Measures summarize the messages that fall into each cell of a data table.
+The default measure counts the messages.
+
+.. code-block:: python
+
+    from msgvis.apps.datatable import measures
+
+    datatable = DataTable('time')
+    datatable.set_measure(measures.get_measure('sender_count_approx'))
+    datatable.generate(dataset)
+    # { 'table': [ { 'time': ..., 'value': 1523 }, ... ], ... }
+
+Distinct counts over many-to-many joins are slow in the database, so the
+``_approx`` measures estimate them with a :class:`msgvis.apps.enhance.sketches.HyperLogLog`
+per cell instead.
+"""
+from django.db import models
+from django.conf import settings
+
+_measure_registry = {}
+
+
+def register(measure):
+    """Register a measure"""
+    if measure.key in _measure_registry:
+        raise KeyError("The measure %s is already registered." % measure.key)
+    _measure_registry[measure.key] = measure
+
+
+def get_measure(measure_key):
+    """Get a specific measure by key"""
+    return _measure_registry[measure_key]
+
+
+def get_measures():
+    """Get a list of all the registered measures."""
+    return _measure_registry.values()
+
+
+class Measure(object):
+    """
+    A basic measure class.
+
+    Attributes:
+
+        - key (str): A string id for the measure (e.g. 'sender_count')
+        - name (str): A nicely-formatted name for the measure (e.g. 'Senders')
+        - field_name (str): The message field that is aggregated
+    """
+
+    additive = False
+    """True if the measure of a set of messages is the sum of the measures of its parts"""
+
+    def __init__(self, key, name=None, field_name='id'):
+        self.key = key
+        self.name = name
+        self.field_name = field_name
+
+    def is_approximate(self):
+        """Return True if the values are estimates"""
+        return False
+
+    def get_aggregate(self):
+        """The aggregate expression for the measure"""
+        raise NotImplementedError()
+
+    def aggregate(self, queryset):
+        """
+        Given a ValuesQuerySet that has been grouped by one or more dimensions,
+        add the measure for each group under the key 'value'.
+        """
+        return queryset.annotate(value=self.get_aggregate())
+
+    def aggregate_all(self, queryset):
+        """The measure of all of the messages in the queryset"""
+        return queryset.aggregate(value=self.get_aggregate())['value']
+
+
+class CountMeasure(Measure):
+    """The number of messages"""
+    additive = True
+
+    def get_aggregate(self):
+        return models.Count(self.field_name)
+
+    def aggregate_all(self, queryset):
+        return queryset.count()
+
+
+class SumMeasure(Measure):
+    """The sum of a numeric field"""
+    additive = True
+
+    def get_aggregate(self):
+        return models.Sum(self.field_name)
+
+
+class MeanMeasure(Measure):
+    """The average of a numeric field"""
+
+    def get_aggregate(self):
+        return models.Avg(self.field_name)
+
+
+class DistinctCountMeasure(Measure):
+    """The number of distinct values of a field"""
+
+    def get_aggregate(self):
+        return models.Count(self.field_name, distinct=True)
+
+
+class ApproximateDistinctCountMeasure(DistinctCountMeasure):
+    """
+    The number of distinct values of a field, estimated with a HyperLogLog sketch per group.
+    The values are streamed from the database instead of being counted there.
+    """
+
+    def __init__(self, key, name=None, field_name='id', precision=None):
+        super(ApproximateDistinctCountMeasure, self).__init__(key, name, field_name)
+        self.precision = precision if precision is not None else \
+            getattr(settings, 'HYPERLOGLOG_PRECISION', 11)
+
+    def is_approximate(self):
+        return True
+
+    def create_sketch(self):
+        from msgvis.apps.enhance.sketches import HyperLogLog
+        return HyperLogLog(self.precision)
+
+    def aggregate_sketches(self, queryset):
+        """
+        Given a ValuesQuerySet that has been grouped by one or more dimensions,
+        return a list of (group row, sketch) tuples.
+        """
+        group_names = list(queryset.query.extra_select) + list(queryset.field_names)
+        field_map = getattr(queryset, 'field_map', {})
+        keys = [field_map.get(name, name) for name in group_names]
+        converters = getattr(queryset, 'converters', {})
+
+        rows = queryset.values_list(*(group_names + [self.field_name]))
+
+        sketches = {}
+        groups = []
+        for row in rows.iterator():
+            group, value = tuple(row[:-1]), row[-1]
+            sketch = sketches.get(group)
+            if sketch is None:
+                sketch = sketches[group] = self.create_sketch()
+                groups.append(group)
+            if value is not None:
+                sketch.add(value)
+
+        results = []
+        for group in groups:
+            row = dict(zip(keys, group))
+            for key, converter in converters.iteritems():
+                if key in row:
+                    row[key] = converter(row[key])
+            results.append((row, sketches[group]))
+        return results
+
+    def aggregate(self, queryset):
+        table = []
+        for row, sketch in self.aggregate_sketches(queryset):
+            row['value'] = sketch.cardinality()
+            table.append(row)
+        return table
+
+    def aggregate_all(self, queryset):
+        sketch = self.create_sketch()
+        values = queryset.exclude(**{self.field_name + "__isnull": True})
+        sketch.update_all(values.values_list(self.field_name, flat=True).iterator())
+        return sketch.cardinality()
+
+
+register(CountMeasure('count', name='Messages'))
+register(SumMeasure('share_count', name='Shares', field_name='shared_count'))
+register(SumMeasure('reply_count', name='Replies', field_name='replied_to_count'))
+register(MeanMeasure('mean_sentiment', name='Average sentiment', field_name='sentiment'))
+register(DistinctCountMeasure('sender_count', name='Senders', field_name='sender'))
+register(DistinctCountMeasure('hashtag_count', name='Hashtags', field_name='hashtags'))
+register(ApproximateDistinctCountMeasure('sender_count_approx', name='Senders (approximate)',
+                                         field_name='sender'))
+register(ApproximateDistinctCountMeasure('hashtag_count_approx', name='Hashtags (approximate)',
+                                         field_name='hashtags'))
@@ -1,18 +1,25 @@
 from django.db import models
 from django.db.models import Q
+from django.conf import settings
 from datetime import timedelta
 import operator
+import math
 
 from msgvis.apps.base.models import MappedValuesQuerySet
+from msgvis.apps.base import sql
 from msgvis.apps.corpus import models as corpus_models
 from msgvis.apps.groups import models as groups_models
+from msgvis.apps.enhance import models as enhance_models
 from msgvis.apps.dimensions import registry
+from msgvis.apps.dimensions.models import TimeDimension, TIME_ROLLUP_DIMENSIONS
+from msgvis.apps.dimensions.filters import apply_filters
 from msgvis.apps.corpus import utils
+from msgvis.apps.datatable import measures
 
 import re
-from django.db import connection
 
 MAX_CATEGORICAL_LEVELS = 10
+HEAVY_HITTER_DIMENSIONS = getattr(settings, 'HEAVY_HITTER_DIMENSIONS', ())
 
 def find_messages(queryset):
     """If the given queryset is actually a :class:`.Dataset` model, get its messages queryset."""
@@ -27,40 +34,28 @@ def get_field_name(text):
         return results.group()
     return None
 
-def fetchall(sql):
-    sql = utils.convert_boolean(sql)
-    cursor = connection.cursor()
-    cursor.execute(sql)
-    desc = cursor.description
-    return [
-        row[0]
-        for row in cursor.fetchall()
-    ]
-
-def fetchall_table(sql):
-    sql = utils.convert_boolean(sql)
-    cursor = connection.cursor()
-    cursor.execute(sql)
-    desc = cursor.description
-    return [
-        dict(zip([col[0] for col in desc], row))
-        for row in cursor.fetchall()
-    ]
-
-def group_messages_by_dimension_with_raw_query(query, dimension, callback):
-    queryset = corpus_models.Message.objects.raw(query)
+def exclude_outlier_times(dataset, queryset):
+    """Remove messages with no time or a time far outside the dataset's time range."""
+    queryset = queryset.exclude(time__isnull=True)
+    if dataset.start_time and dataset.end_time:
+        range = dataset.end_time - dataset.start_time
+        buffer = timedelta(seconds=range.total_seconds() * 0.1)
+        queryset = queryset.filter(time__gte=dataset.start_time - buffer,
+                                   time__lte=dataset.end_time + buffer)
+    return queryset
+
+def _build_dimension_grouping_template(dimension):
+    """The SQL template for counting the messages in a subquery for each level of a related dimension"""
     message_id = corpus_models.Message._meta.model_name + "_id" #message_id
     fieldname = get_field_name(dimension.field_name)
     key = dimension.key
     related_mgr = getattr(corpus_models.Message, dimension.key)
     if hasattr(related_mgr, "RelatedObjectDoesNotExist"):
         related_table = related_mgr.field.rel.to._meta.db_table
-        related_id = related_mgr.field.rel.to._meta.model._meta.model_name + "_id"
-        if related_id == "person_id":
-            related_id = "sender_id"
-        elif related_id == "messagetype_id":
-            related_id = "type_id"
-        final_query = "SELECT B.%s AS `%s`, count(*) AS `value` FROM (%s) AS A, `%s` AS B WHERE A.%s=B.id GROUP BY B.%s ORDER BY `value` DESC" %(fieldname, key, query, related_table, related_id, fieldname)
+        related_id = related_mgr.field.column # e.g., sender_id
+        return "SELECT B.`%s` AS `%s`, count(*) AS `value` FROM ({query}) AS A, `%s` AS B " \
+               "WHERE A.`%s`=B.id GROUP BY B.`%s` ORDER BY `value` DESC" % (fieldname, key, related_table,
+                                                                             related_id, fieldname)
 
     else:
         if hasattr(related_mgr, "field"):
@@ -72,21 +67,61 @@ def group_messages_by_dimension_with_raw_query(query, dimension, callback):
             related_table = related_mgr.related.model._meta.db_table # e.g., enhance_word
             related_id = related_mgr.related.model._meta.model_name + "_id"  # e.g., word_id
 
-        final_query = "SELECT B.%s AS `%s`, count(*) AS `value` FROM (%s) AS A, `%s` AS B, `%s` AS C WHERE A.id=C.%s AND B.id=C.%s GROUP BY B.%s ORDER BY `value` DESC" %(fieldname, key, query, related_table, through_table, message_id, related_id, fieldname)
-    return callback(final_query)
+        return "SELECT B.`%s` AS `%s`, count(*) AS `value` FROM ({query}) AS A, `%s` AS B, `%s` AS C " \
+               "WHERE A.id=C.`%s` AND B.id=C.`%s` GROUP BY B.`%s` ORDER BY `value` DESC" % (
+                   fieldname, key, related_table, through_table, message_id, related_id, fieldname)
 
 
-def group_messages_by_words_with_raw_query(query, callback):
+def group_messages_by_dimension_with_raw_query(query, params, dimension, callback):
+    """
+    Count the messages selected by the query (sql and params) for each level of a related dimension.
+    The callback runs the final query.
+    """
+    template = sql.cached_template(('group_by_dimension', dimension.key),
+                                   lambda: _build_dimension_grouping_template(dimension))
+    return callback(*sql.wrap(template, query, params))
 
-    pattern = re.compile(r'T\d+.`text`')
-    results = pattern.search(query)
-    if results:
-        table = results.group()
-        query = query.replace("`corpus_message`.`id`, `corpus_message`.`dataset_id`, `corpus_message`.`original_id`, `corpus_message`.`type_id`, `corpus_message`.`sender_id`, `corpus_message`.`time`, `corpus_message`.`language_id`, `corpus_message`.`sentiment`, `corpus_message`.`timezone_id`, `corpus_message`.`replied_to_count`, `corpus_message`.`shared_count`, `corpus_message`.`contains_hashtag`, `corpus_message`.`contains_url`, `corpus_message`.`contains_media`, `corpus_message`.`contains_mention`, `corpus_message`.`text`",
-                              "%s AS words, count(*) AS value" %(table))
-        query += "GROUP BY `words` ORDER BY `value` DESC"
 
-    return callback(query)
+def group_messages_by_words_with_raw_query(queryset, callback):
+    """
+    Count the messages in the queryset for each word.
+    If the queryset is already filtered on words, only those words are counted.
+    The callback runs the final query.
+    """
+    dimension = registry.get_dimension('words')
+    column = get_field_name(dimension.field_name)
+
+    # values() reuses the join of any filter on the words
+    query, params = sql.compile_queryset(queryset.values(dimension.field_name))
+
+    template = sql.cached_template(('group_by_words', column), lambda: (
+        "SELECT A.`%s` AS `%s`, count(*) AS `value` FROM ({query}) AS A "
+        "GROUP BY A.`%s` ORDER BY `value` DESC" % (column, dimension.key, column)
+    ))
+    return callback(*sql.wrap(template, query, params))
+
+def time_filter_range(filters, accepts):
+    """
+    The intersection (min_time, max_time) of the ranges of the time filters, with None for an open end.
+    Returns None if a filter is on a dimension that ``accepts`` rejects, is not a time range,
+    or the ranges do not overlap.
+    """
+    min_time = None
+    max_time = None
+    for filter in filters or []:
+        if not accepts(filter['dimension']):
+            return None
+        if 'value' in filter or filter.get('levels') or filter.get('min') or filter.get('max'):
+            return None
+        if filter.get('min_time') is not None and (min_time is None or filter['min_time'] > min_time):
+            min_time = filter['min_time']
+        if filter.get('max_time') is not None and (max_time is None or filter['max_time'] < max_time):
+            max_time = filter['max_time']
+
+    if min_time is not None and max_time is not None and min_time > max_time:
+        return None
+    return min_time, max_time
+
 
 class DataTable(object):
     """
@@ -122,10 +157,56 @@ class DataTable(object):
         self.secondary_dimension = secondary_dimension
 
         self.mode = "default"
+        self.sample = None
+        self.measure = measures.get_measure('count')
+
+    def get_join_dimensions(self):
+        """
+        The dimensions whose filters should be joined rather than applied as semi-joins,
+        because a filter on a dimension that is grouped by also restricts its groups.
+        """
+        return [dimension for dimension in (self.primary_dimension, self.secondary_dimension)
+                if dimension is not None]
 
     def set_mode(self, mode):
         self.mode = mode
 
+    def set_measure(self, measure):
+        """
+        Summarize the messages in each cell with a :class:`msgvis.apps.datatable.measures.Measure`
+        (or measure key) instead of counting them.
+        """
+        if isinstance(measure, basestring):
+            measure = measures.get_measure(measure)
+        self.measure = measure
+
+    def set_sample(self, sample):
+        """
+        Count only the messages in a :class:`msgvis.apps.enhance.models.MessageSample`.
+        The counts are scaled up by the sampling rate and each row gets an
+        approximate 95% confidence interval half-width as its 'error'.
+        """
+        self.sample = sample
+
+    def scale_to_sample(self, table):
+        """
+        Scale the sampled counts (or other additive measures) in a table up to
+        estimates for the whole dataset. Other measures are estimated by their sample values.
+        """
+        if not self.measure.additive:
+            return table
+
+        rate = self.sample.rate
+        scaled = []
+        for row in table:
+            row = dict(row)
+            value = row['value'] or 0
+            row['value'] = int(round(value / rate))
+            if isinstance(self.measure, measures.CountMeasure):
+                row['error'] = 1.96 * math.sqrt(value * (1 - rate)) / rate
+            scaled.append(row)
+        return scaled
+
     def render(self, queryset, desired_primary_bins=None, desired_secondary_bins=None):
         """
         Given a set of messages (already filtered as necessary),
@@ -145,7 +226,7 @@ class DataTable(object):
                                                        grouping_key=self.primary_dimension.key,
                                                        bins=desired_primary_bins)
 
-            return queryset.annotate(value=models.Count('id'))
+            return self.measure.aggregate(queryset)
 
         else:
             # Now it gets nasty...
@@ -171,9 +252,6 @@ class DataTable(object):
             queryset = queryset.values(internal_primary_key,
                                        internal_secondary_key)
 
-            # Count the messages
-            queryset = queryset.annotate(value=models.Count('id'))
-
             # We may need to remap some fields
             mapping = {}
             if internal_primary_key != self.primary_dimension.key:
@@ -181,10 +259,20 @@ class DataTable(object):
             if internal_secondary_key != self.secondary_dimension.key:
                 mapping[internal_secondary_key] = self.secondary_dimension.key
 
-            if len(mapping) > 0:
-                return MappedValuesQuerySet.create_from(queryset, mapping)
-            else:
-                return queryset
+            # and convert grouped values back into dimension values
+            converters = {}
+            primary_converter = self.primary_dimension.get_grouping_converter(primary_group)
+            if primary_converter is not None:
+                converters[self.primary_dimension.key] = primary_converter
+            secondary_converter = self.secondary_dimension.get_grouping_converter(secondary_group)
+            if secondary_converter is not None:
+                converters[self.secondary_dimension.key] = secondary_converter
+
+            if len(mapping) > 0 or len(converters) > 0:
+                queryset = MappedValuesQuerySet.create_from(queryset, mapping, converters=converters)
+
+            # Count the messages
+            return self.measure.aggregate(queryset)
 
 
 
@@ -211,7 +299,7 @@ class DataTable(object):
             queryset = queryset.exclude(utils.levels_or(self.primary_dimension.field_name, domains[self.primary_dimension.key]))
             domains[self.primary_dimension.key].append(u'Other ' + self.primary_dimension.name)
 
-            return [{self.primary_dimension.key: u'Other ' + self.primary_dimension.name, 'value': queryset.count()}]
+            return [{self.primary_dimension.key: u'Other ' + self.primary_dimension.name, 'value': self.measure.aggregate_all(queryset)}]
 
         elif self.secondary_dimension:
 
@@ -231,7 +319,7 @@ class DataTable(object):
 
                     others_results.append({self.primary_dimension.key: u'Other ' + self.primary_dimension.name,
                                            self.secondary_dimension.key: u'Other ' + self.secondary_dimension.name,
-                                           'value': queryset.count()})
+                                           'value': self.measure.aggregate_all(queryset)})
 
                 # primary top ones x secondary others
                 if secondary_flag:
@@ -242,7 +330,7 @@ class DataTable(object):
                     queryset = self.primary_dimension.group_by(queryset,
                                                                           grouping_key=self.primary_dimension.key)
 
-                    queryset = queryset.annotate(value=models.Count('id'))
+                    queryset = self.measure.aggregate(queryset)
                     results = list(queryset)
                     for r in results:
                         r[self.secondary_dimension.key] = u'Other ' + self.secondary_dimension.name
@@ -257,7 +345,7 @@ class DataTable(object):
                     queryset = self.secondary_dimension.group_by(queryset,
                                                                             grouping_key=self.secondary_dimension.key)
 
-                    queryset = queryset.annotate(value=models.Count('id'))
+                    queryset = self.measure.aggregate(queryset)
                     results = list(queryset)
                     for r in results:
                         r[self.primary_dimension.key] = u'Other ' + self.primary_dimension.name
@@ -272,7 +360,7 @@ class DataTable(object):
                 queryset = self.secondary_dimension.group_by(queryset,
                                                                         grouping_key=self.secondary_dimension.key,
                                                                         bins=desired_secondary_bins)
-                queryset = queryset.annotate(value=models.Count('id'))
+                queryset = self.measure.aggregate(queryset)
                 results = list(queryset)
                 for r in results:
                     r[self.primary_dimension.key] = u'Other ' + self.primary_dimension.name
@@ -285,7 +373,7 @@ class DataTable(object):
                 queryset = self.primary_dimension.group_by(queryset,
                                                                       grouping_key=self.primary_dimension.key,
                                                                       bins=desired_primary_bins)
-                queryset = queryset.annotate(value=models.Count('id'))
+                queryset = self.measure.aggregate(queryset)
                 results = list(queryset)
                 for r in results:
                     r[self.secondary_dimension.key] = u'Other ' + self.secondary_dimension.name
@@ -305,15 +393,61 @@ class DataTable(object):
 
         return domain, labels
 
+    def domain_page(self, dimension, queryset, page, page_size, search_key=None, exclude=None):
+        """
+        Return one page of the sorted levels in this dimension, their labels,
+        the total number of levels, and a table of the message counts on the page.
+        """
+        if exclude is not None:
+            queryset = dimension.exclude(queryset, **exclude)
+
+        rows, total = dimension.get_domain_page(queryset, page, page_size, search_key=search_key)
+
+        domain = [level for level, count in rows]
+        labels = dimension.get_domain_labels(domain)
+        table = [{dimension.key: level, 'value': count} for level, count in rows]
+
+        return domain, labels, total, table
+
+    def sketched_domain(self, dataset, dimension, queryset, k=MAX_CATEGORICAL_LEVELS):
+        """
+        Return the k most frequent levels of a high-cardinality dimension
+        (plus one more if there are any others) using its heavy-hitter sketch,
+        so that the domain does not have to be counted and sorted in full.
+
+        The candidate levels are recounted exactly in the queryset unless
+        ``settings.HEAVY_HITTER_EXACT_RECOUNT`` is False.
+        Returns None if the domain should be calculated normally.
+        """
+        if dimension.key not in HEAVY_HITTER_DIMENSIONS or self.sample is not None:
+            return None
+        if self.mode != 'enable_others' and self.mode != 'omit_others':
+            return None
+
+        sketch = enhance_models.HeavyHitterSketch.get_for_dataset(dataset, dimension.key)
+        if sketch is None or len(sketch) == 0:
+            return None
+        if sketch.capacity <= k:
+            # too few counters to tell the top levels apart
+            return None
+
+        if getattr(settings, 'HEAVY_HITTER_EXACT_RECOUNT', True):
+            candidates = sketch.candidates(k + 1)
+            queryset = queryset.filter(utils.levels_or(dimension.field_name, candidates))
+            queryset = dimension.group_by(queryset, grouping_key='value')
+            queryset = queryset.annotate(count=models.Count('id')).order_by('-count')
+            domain = [row['value'] for row in queryset[:k + 1]]
+        else:
+            domain = [row[0] for row in sketch.top(k + 1)]
+
+        labels = dimension.get_domain_labels(domain)
+        return domain, labels
+
     def groups_domain(self, dimension, queryset_all, group_querysets, desired_bins=None):
         """Return the sorted levels in the union of groups in this dimension"""
         if dimension.is_related_categorical():
-            query = ""
-            for idx, queryset in enumerate(group_querysets):
-                if idx > 0:
-                    query += " UNION "
-                query += "(%s)" %(utils.quote(str(queryset.query)))
-            domain = group_messages_by_dimension_with_raw_query(query, dimension, fetchall)
+            query, params = sql.union(group_querysets)
+            domain = group_messages_by_dimension_with_raw_query(query, params, dimension, sql.fetch_column)
 
         else:
             queryset = queryset_all
@@ -335,6 +469,140 @@ class DataTable(object):
 
         return match_domain, match_labels
 
+    def render_from_time_prefix_sums(self, dataset, filters=None, exclude=None):
+        """
+        Generate the data table response for one low-cardinality categorical
+        dimension within a time range, from the precalculated cumulative time counts.
+
+        Returns None if the counts have not been built or cannot answer the request exactly.
+        """
+        from msgvis.apps.enhance.prefix_sums import TimePrefixSums
+
+        if exclude or self.secondary_dimension is not None or not self.primary_dimension.is_categorical():
+            return None
+
+        time_range = time_filter_range(filters, lambda dimension: isinstance(dimension, TimeDimension))
+        if time_range is None:
+            return None
+        min_time, max_time = time_range
+
+        dimension = self.primary_dimension
+        prefix_sums = TimePrefixSums.load(dataset.id, dimension.key)
+        if prefix_sums is None or not prefix_sums.is_exact(min_time, max_time):
+            return None
+
+        distribution = prefix_sums.distribution(min_time, max_time)
+        domain = dimension.domain if hasattr(dimension, 'domain') else list(prefix_sums.levels)
+        labels = dimension.get_domain_labels(domain)
+
+        others = False
+        if (self.mode == 'enable_others' or self.mode == 'omit_others') and len(domain) > MAX_CATEGORICAL_LEVELS:
+            others = True
+            domain = list(domain[:MAX_CATEGORICAL_LEVELS])
+            if labels is not None:
+                labels = labels[:MAX_CATEGORICAL_LEVELS]
+
+        table = [{dimension.key: level, 'value': count}
+                 for level, count in distribution if count > 0 and level in domain]
+
+        if self.mode == 'enable_others' and others:
+            other_level = u'Other ' + dimension.name
+            other_count = sum(count for level, count in distribution if level not in domain)
+            domain.append(other_level)
+            table.append({dimension.key: other_level, 'value': other_count})
+
+        domains = {dimension.key: domain}
+        domain_labels = {}
+        if labels is not None:
+            domain_labels[dimension.key] = labels
+
+        return {
+            'table': table,
+            'domains': domains,
+            'domain_labels': domain_labels
+        }
+
+    def render_from_time_rollups(self, dataset, filters=None, exclude=None):
+        """
+        Generate the data table response from the precalculated time rollups.
+        This works when one dimension is time, the other (if any) has been crossed with
+        time in the rollups, and the only filters are bin-aligned time ranges.
+
+        Returns None if the rollups cannot answer the request.
+        """
+        if exclude:
+            return None
+
+        if isinstance(self.primary_dimension, TimeDimension):
+            time_dimension, other_dimension = self.primary_dimension, self.secondary_dimension
+        elif isinstance(self.secondary_dimension, TimeDimension):
+            time_dimension, other_dimension = self.secondary_dimension, self.primary_dimension
+        else:
+            return None
+
+        if other_dimension is not None and other_dimension.key not in TIME_ROLLUP_DIMENSIONS:
+            return None
+
+        time_range = time_filter_range(filters, lambda dimension: dimension == time_dimension)
+        if time_range is None:
+            return None
+        min_time, max_time = time_range
+
+        rollup = time_dimension.group_by_rollups(dataset, grouping_key=time_dimension.key,
+                                                 min_time=min_time, max_time=max_time,
+                                                 secondary_dimension=other_dimension)
+        if rollup is None:
+            return None
+
+        domains = {}
+        domain_labels = {}
+        domains[time_dimension.key], table = rollup
+
+        if other_dimension is not None:
+            domain = time_dimension.get_rollup_levels(dataset, other_dimension)
+            if (self.mode == 'enable_others' or self.mode == 'omit_others') and len(domain) > MAX_CATEGORICAL_LEVELS:
+                return None
+
+            domains[other_dimension.key] = domain
+            labels = other_dimension.get_domain_labels(domain)
+            if labels is not None:
+                domain_labels[other_dimension.key] = labels
+
+        return {
+            'table': table,
+            'domains': domains,
+            'domain_labels': domain_labels
+        }
+
+    def render_from_distinct_sketches(self, dataset, filters=None, exclude=None):
+        """
+        Generate the data table response for an approximate distinct count measure over time
+        by merging the precalculated per-bin sketches.
+        This works when time is the only dimension and the only filters are bin-aligned time ranges.
+
+        Returns None if the sketches cannot answer the request.
+        """
+        if exclude or self.secondary_dimension is not None or not isinstance(self.primary_dimension, TimeDimension):
+            return None
+
+        time_range = time_filter_range(filters, lambda dimension: dimension == self.primary_dimension)
+        if time_range is None:
+            return None
+        min_time, max_time = time_range
+
+        merged = self.primary_dimension.group_by_distinct_sketches(dataset, self.measure,
+                                                                   grouping_key=self.primary_dimension.key,
+                                                                   min_time=min_time, max_time=max_time)
+        if merged is None:
+            return None
+
+        domain, table = merged
+        return {
+            'table': table,
+            'domains': {self.primary_dimension.key: domain},
+            'domain_labels': {}
+        }
+
     def generate(self, dataset, filters=None, exclude=None, page_size=100, page=None, search_key=None, groups=None):
         """
         Generate a complete data group table response.
@@ -352,12 +620,10 @@ class DataTable(object):
             queryset = dataset.message_set.all()
 
             # Filter out null time
-            queryset = queryset.exclude(time__isnull=True)
-            if dataset.start_time and dataset.end_time:
-                range = dataset.end_time - dataset.start_time
-                buffer = timedelta(seconds=range.total_seconds() * 0.1)
-                queryset = queryset.filter(time__gte=dataset.start_time - buffer,
-                                           time__lte=dataset.end_time + buffer)
+            queryset = exclude_outlier_times(dataset, queryset)
+
+            if self.sample is not None:
+                queryset = queryset.filter(samples=self.sample)
 
             unfiltered_queryset = queryset
 
@@ -367,8 +633,6 @@ class DataTable(object):
             if filters is not None:
                 for filter in filters:
                     dimension = filter['dimension']
-                    queryset = dimension.filter(queryset, **filter)
-
                     if dimension == self.primary_dimension:
                         primary_filter = filter
                     if dimension == self.secondary_dimension:
@@ -379,13 +643,13 @@ class DataTable(object):
             if exclude is not None:
                 for exclude_filter in exclude:
                     dimension = exclude_filter['dimension']
-                    queryset = dimension.exclude(queryset, **exclude_filter)
-
                     if dimension == self.primary_dimension:
                         primary_exclude = exclude_filter
                     if dimension == self.secondary_dimension:
                         secondary_exclude = exclude_filter
 
+            queryset = apply_filters(queryset, filters, exclude, join_dimensions=self.get_join_dimensions())
+
             domains = {}
             domain_labels = {}
             max_page = None
@@ -396,29 +660,62 @@ class DataTable(object):
             secondary_flag = False
 
             # Include the domains for primary and (secondary) dimensions
-            domain, labels = self.domain(self.primary_dimension,
-                                         unfiltered_queryset,
-                                         primary_filter, primary_exclude)
-
-            # paging the first dimension, this is for the filter distribution
+            page_table = None
             if primary_filter is None and self.secondary_dimension is None and page is not None:
+                # paging the first dimension, this is for the filter distribution
 
-                if search_key is not None:
-                    domain, labels = self.filter_search_key(domain, labels, search_key)
-                start = (page - 1) * page_size
-                end = min(start + page_size, len(domain))
-                max_page = (len(domain) / page_size) + 1
+                if self.primary_dimension.is_categorical() and not hasattr(self.primary_dimension, 'domain'):
+                    # page and search in the database
+                    domain, labels, total, page_table = self.domain_page(self.primary_dimension,
+                                                                         unfiltered_queryset,
+                                                                         page, page_size, search_key,
+                                                                         primary_exclude)
+                    max_page = (total / page_size) + 1
 
-                # no level left
-                if len(domain) == 0 or start > len(domain):
-                    return None
+                    # no level left
+                    if len(domain) == 0:
+                        return None
 
-                domain = domain[start:end]
-                if labels is not None:
-                    labels = labels[start:end]
+                else:
+                    domain, labels = self.domain(self.primary_dimension,
+                                                 unfiltered_queryset,
+                                                 primary_filter, primary_exclude)
+
+                    if search_key is not None:
+                        domain, labels = self.filter_search_key(domain, labels, search_key)
+                    start = (page - 1) * page_size
+                    end = min(start + page_size, len(domain))
+                    max_page = (len(domain) / page_size) + 1
+
+                    # no level left
+                    if len(domain) == 0 or start > len(domain):
+                        return None
+
+                    domain = domain[start:end]
+                    if labels is not None:
+                        labels = labels[start:end]
 
-                queryset = queryset.filter(utils.levels_or(self.primary_dimension.field_name, domain))
+                # The counts for the page can be used as the table
+                # unless other dimensions have been filtered or something else is measured
+                other_filters = [f for f in (filters or []) + (exclude or [])
+                                 if f['dimension'] != self.primary_dimension]
+                if len(other_filters) > 0 or self.measure.key != 'count':
+                    page_table = None
+
+                if page_table is None:
+                    queryset = queryset.filter(utils.levels_or(self.primary_dimension.field_name, domain))
             else:
+                sketched = None
+                if primary_filter is None and primary_exclude is None:
+                    sketched = self.sketched_domain(dataset, self.primary_dimension, unfiltered_queryset)
+
+                if sketched is not None:
+                    domain, labels = sketched
+                else:
+                    domain, labels = self.domain(self.primary_dimension,
+                                                 unfiltered_queryset,
+                                                 primary_filter, primary_exclude)
+
                 if (self.mode == 'enable_others' or self.mode == 'omit_others') and \
                     self.primary_dimension.is_categorical() and len(domain) > MAX_CATEGORICAL_LEVELS:
                     primary_flag = True
@@ -435,9 +732,16 @@ class DataTable(object):
                 domain_labels[self.primary_dimension.key] = labels
 
             if self.secondary_dimension:
-                domain, labels = self.domain(self.secondary_dimension,
-                                             unfiltered_queryset,
-                                             secondary_filter, secondary_exclude)
+                sketched = None
+                if secondary_filter is None and secondary_exclude is None:
+                    sketched = self.sketched_domain(dataset, self.secondary_dimension, unfiltered_queryset)
+
+                if sketched is not None:
+                    domain, labels = sketched
+                else:
+                    domain, labels = self.domain(self.secondary_dimension,
+                                                 unfiltered_queryset,
+                                                 secondary_filter, secondary_exclude)
 
                 if (self.mode == 'enable_others' or self.mode == 'omit_others') and \
                     self.secondary_dimension.is_categorical() and \
@@ -458,7 +762,10 @@ class DataTable(object):
                     domain_labels[self.secondary_dimension.key] = labels
 
             # Render a table
-            table = self.render(queryset)
+            if page_table is not None:
+                table = page_table
+            else:
+                table = self.render(queryset)
 
             if self.mode == "enable_others" and queryset_for_others is not None:
                 # adding others to the results
@@ -466,6 +773,9 @@ class DataTable(object):
                 table = list(table)
                 table.extend(table_for_others)
 
+            if self.sample is not None:
+                table = self.scale_to_sample(table)
+
             results = {
                 'table': table,
                 'domains': domains,
@@ -473,6 +783,11 @@ class DataTable(object):
             }
             if max_page is not None:
                 results['max_page'] = max_page
+            if self.sample is not None:
+                results['approximate'] = True
+                results['sample_rate'] = self.sample.rate
+            elif self.measure.is_approximate():
+                results['approximate'] = True
 
         else:
             domains = {}
@@ -489,17 +804,10 @@ class DataTable(object):
             secondary_exclude = None
 
             queryset = dataset.message_set.all()
-            queryset = queryset.exclude(time__isnull=True)
-            if dataset.start_time and dataset.end_time:
-                range = dataset.end_time - dataset.start_time
-                buffer = timedelta(seconds=range.total_seconds() * 0.1)
-                queryset = queryset.filter(time__gte=dataset.start_time - buffer,
-                                           time__lte=dataset.end_time + buffer)
+            queryset = exclude_outlier_times(dataset, queryset)
             if filters is not None:
                 for filter in filters:
                     dimension = filter['dimension']
-                    queryset = dimension.filter(queryset, **filter)
-
                     if dimension == self.primary_dimension:
                         primary_filter = filter
                     if dimension == self.secondary_dimension:
@@ -508,13 +816,13 @@ class DataTable(object):
             if exclude is not None:
                 for exclude_filter in exclude:
                     dimension = exclude_filter['dimension']
-                    queryset = dimension.exclude(queryset, **exclude_filter)
-
                     if dimension == self.primary_dimension:
                         primary_exclude = exclude_filter
                     if dimension == self.secondary_dimension:
                         secondary_exclude = exclude_filter
 
+            queryset = apply_filters(queryset, filters, exclude, join_dimensions=self.get_join_dimensions())
+
             queryset_all = queryset
 
             #queryset = corpus_models.Message.objects.none()
@@ -533,27 +841,12 @@ class DataTable(object):
 
 
                 # Filter out null time
-                queryset = queryset.exclude(time__isnull=True)
-                if dataset.start_time and dataset.end_time:
-                    range = dataset.end_time - dataset.start_time
-                    buffer = timedelta(seconds=range.total_seconds() * 0.1)
-                    queryset = queryset.filter(time__gte=dataset.start_time - buffer,
-                                               time__lte=dataset.end_time + buffer)
+                queryset = exclude_outlier_times(dataset, queryset)
 
                 unfiltered_queryset = queryset
 
-                # Filter the data (look for filters on the primary/secondary dimensions at the same time
-
-                if filters is not None:
-                    for filter in filters:
-                        dimension = filter['dimension']
-                        queryset = dimension.filter(queryset, **filter)
-
-
-                if exclude is not None:
-                    for exclude_filter in exclude:
-                        dimension = exclude_filter['dimension']
-                        queryset = dimension.exclude(queryset, **exclude_filter)
+                # Filter the data
+                queryset = apply_filters(queryset, filters, exclude, join_dimensions=self.get_join_dimensions())
 
 
                 group_querysets.append(queryset)
@@ -633,7 +926,7 @@ class DataTable(object):
 
                 # Render a table
                 if self.primary_dimension.key == "words":
-                    table = group_messages_by_words_with_raw_query(utils.quote(str(queryset.query)), fetchall_table)
+                    table = group_messages_by_words_with_raw_query(queryset, sql.fetch_dicts)
                 else:
                     table = self.render(queryset)
 
@@ -680,3 +973,55 @@ class DataTable(object):
                 results['max_page'] = max_page
 
         return results
+
+
+def generate_facets(dataset, dimensions, filters=None, exclude=None, limit=MAX_CATEGORICAL_LEVELS):
+    """
+    Calculate the distribution of several dimensions over the same filtered messages,
+    e.g. for every dimension in the filter panel.
+
+    The filters are applied once: the ids of the matching messages are copied into
+    a temporary table, and each distribution is counted against that table.
+    Categorical dimensions only include their ``limit`` most frequent levels,
+    along with the total number of levels under ``levels``.
+
+    Returns a dictionary from dimension key to a result like :meth:`DataTable.generate`'s.
+    """
+    dimensions = [registry.get_dimension(d) if isinstance(d, basestring) else d for d in dimensions]
+
+    queryset = exclude_outlier_times(dataset, dataset.message_set.all())
+    queryset = apply_filters(queryset, filters, exclude)
+
+    table_name = None
+    if len(dimensions) > 1:
+        table_name = utils.messages_in_temp_table(queryset)
+        queryset = corpus_models.Message.objects.filter(pk__in_temporary_table=table_name)
+
+    try:
+        facets = {}
+        for dimension in dimensions:
+            if dimension.is_categorical():
+                rows, total = dimension.get_domain_page(queryset, 1, limit)
+                domain = [level for level, count in rows]
+                table = [{dimension.key: level, 'value': count} for level, count in rows]
+            else:
+                table = list(DataTable(dimension).render(queryset))
+                domain = [row[dimension.key] for row in table]
+                total = len(domain)
+
+            result = {
+                'table': table,
+                'domains': {dimension.key: domain},
+                'domain_labels': {},
+                'levels': total,
+            }
+            labels = dimension.get_domain_labels(domain)
+            if labels is not None:
+                result['domain_labels'][dimension.key] = labels
+
+            facets[dimension.key] = result
+    finally:
+        if table_name is not None:
+            utils.drop_temp_table(table_name)
+
+    return facets
@@ -0,0 +1,438 @@
+"""
+Choose how to answer a data table request.
+
+The same table can often be calculated in several ways: read from the precalculated
+distributions, merged from the time rollups, taken from the result cache, counted live
+in the database, or estimated from a random sample of the messages. The planner estimates
+the cost of each strategy that could answer a request, in rows read, from a few
+statistics about the dataset (the number of messages, the selectivity of the filters
+and the cardinality of the dimensions), and runs the cheapest one that is accurate
+enough. A strategy that turns out not to have the data falls back to the next one.
+
+.. code-block:: python
+
+    request = TableRequest(serializer.validated_data)
+    result, plan = generate(request)
+
+    plan
+    # {'strategy': 'rollup', 'cost': 100, 'exact': True,
+    #  'candidates': [{'strategy': 'rollup', 'cost': 100, 'exact': True},
+    #                 {'strategy': 'live', 'cost': 52310, 'exact': True}]}
+
+Only exact strategies are used unless the request is ``approximate``. Approximate
+requests allow estimates but do not require them: an exact strategy that is cheaper
+than counting the sample (such as the precalculated distributions) is still chosen.
+"""
+import hashlib
+import json
+import math
+import types
+
+from django.conf import settings
+from django.core.cache import cache
+
+from msgvis.apps.dimensions.models import TimeDimension
+from msgvis.apps.dimensions.filters import get_multi_valued_relation
+from msgvis.apps.enhance import models as enhance_models
+from msgvis.apps.datatable import models as datatable_models
+from msgvis.apps.datatable import diagnostics
+
+RELATED_FANOUT = 3
+"""The estimated number of related rows per message for many-to-many dimensions"""
+
+TIME_ROLLUP_BINS = 100
+"""The estimated number of bins read from the time rollups"""
+
+
+class StrategyUnavailable(Exception):
+    """Raised by a strategy that cannot answer the request after all"""
+    pass
+
+
+class TableRequest(object):
+    """The parameters of a validated data table request"""
+
+    def __init__(self, data):
+        self.dataset = data['dataset']
+        self.dimensions = data['dimensions']
+        self.filters = data.get('filters', [])
+        self.exclude = data.get('exclude', [])
+        self.search_key = data.get('search_key')
+        self.mode = data.get('mode')
+        self.groups = data.get('groups') or None
+        self.approximate = data.get('approximate', False)
+        self.sample_rate = data.get('sample_rate')
+        self.measure = data.get('measure')
+
+        self.page_size = 100
+        self.page = None
+        if data.get('page_size'):
+            self.page_size = max(1, int(data.get('page_size')))
+        if data.get('page'):
+            self.page = max(1, int(data.get('page')))
+
+        self.unfiltered = type(self.filters) == types.ListType and len(self.filters) == 0 and \
+                          type(self.exclude) == types.ListType and len(self.exclude) == 0
+
+        # the precalculated distributions and rollups only count messages
+        self.counting = self.measure is None or self.measure.key == 'count'
+
+        self._cached = None
+        self._sample = None
+
+    def make_datatable(self):
+        """A DataTable for the request's dimensions, mode and measure"""
+        datatable = datatable_models.DataTable(*self.dimensions)
+        if self.mode is not None:
+            datatable.set_mode(self.mode)
+        if self.measure is not None:
+            datatable.set_measure(self.measure)
+        return datatable
+
+    def get_cache_key(self):
+        """
+        A key identifying the request, for the result cache. It includes the dataset's
+        newest message and the definitions of the groups, so imports and edits are not
+        answered from the cache.
+        """
+        from msgvis.apps.groups.models import Group
+        from msgvis.apps.groups import bitmaps
+
+        def describe(filters):
+            if type(filters) != types.ListType:
+                return unicode(filters)
+            return [dict((key, getattr(value, 'key', value)) for key, value in filter.iteritems())
+                    for filter in filters]
+
+        description = json.dumps({
+            'dataset': self.dataset.pk,
+            'dimensions': [getattr(d, 'key', d) for d in self.dimensions],
+            'filters': describe(self.filters),
+            'exclude': describe(self.exclude),
+            'search_key': self.search_key,
+            'mode': self.mode,
+            'groups': self.groups,
+            'group_versions': [bitmaps.definition_version(group)
+                               for group in Group.objects.filter(id__in=self.groups or []).order_by('id')],
+            'data_version': self.dataset.get_data_version(),
+            'measure': getattr(self.measure, 'key', None),
+            'page': self.page,
+            'page_size': self.page_size,
+        }, sort_keys=True, default=unicode)
+        return 'datatable:%s' % hashlib.sha1(description).hexdigest()
+
+    def get_cached(self):
+        """The cached result entry for the request, or None"""
+        if self._cached is None:
+            self._cached = cache.get(self.get_cache_key()) or False
+        return self._cached or None
+
+    def get_sample(self):
+        """The message sample to count, or None"""
+        if self._sample is None:
+            self._sample = enhance_models.MessageSample.get_for_dataset(self.dataset, self.sample_rate) or False
+        return self._sample or None
+
+
+class DatasetStatistics(object):
+    """
+    Cheap estimates about a dataset's messages, cached for
+    ``settings.DATASET_STATISTICS_SECONDS``.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.timeout = getattr(settings, 'DATASET_STATISTICS_SECONDS', 300)
+
+    def _get(self, name, calculate):
+        key = 'dataset_statistics:%d:%s' % (self.dataset.pk, name)
+        value = cache.get(key)
+        if value is None:
+            value = calculate()
+            cache.set(key, value, self.timeout)
+        return value
+
+    @property
+    def message_count(self):
+        return self._get('message_count', lambda: self.dataset.message_set.count())
+
+    def cardinality(self, dimension):
+        """The estimated number of levels of a dimension"""
+        if hasattr(dimension, 'domain'):
+            return len(dimension.domain)
+        if not dimension.is_categorical():
+            return dimension.default_bins
+
+        def count_levels():
+            levels = self.dataset.distributions.filter(dimension_key=dimension.key).count()
+            if levels == 0:
+                # nothing precalculated, assume the worst
+                levels = self.message_count
+            return levels
+
+        return max(1, self._get('cardinality:%s' % dimension.key, count_levels))
+
+    def filter_selectivity(self, filter):
+        """The estimated fraction of messages that match a filter"""
+        dimension = filter['dimension']
+        if filter.get('levels') is not None:
+            return min(1.0, float(len(filter['levels'])) / self.cardinality(dimension))
+        if 'value' in filter:
+            return 1.0 / max(2, self.cardinality(dimension))
+
+        if filter.get('min_time') or filter.get('max_time'):
+            start, end = self.dataset.start_time, self.dataset.end_time
+            if start is None or end is None or end <= start:
+                return 0.5
+            min_time = max(filter.get('min_time') or start, start)
+            max_time = min(filter.get('max_time') or end, end)
+            return max(0.0, (max_time - min_time).total_seconds() / (end - start).total_seconds())
+
+        bounds = len([key for key in ('min', 'max') if filter.get(key) is not None])
+        return 0.5 ** bounds
+
+    def selectivity(self, filters, exclude):
+        """The estimated fraction of messages that match all of the filters and excludes"""
+        if type(filters) != types.ListType or type(exclude) != types.ListType:
+            return 1.0
+
+        selectivity = 1.0
+        for filter in filters:
+            selectivity *= self.filter_selectivity(filter)
+        for filter in exclude:
+            selectivity *= 1.0 - self.filter_selectivity(filter)
+
+        # at least one message
+        return max(selectivity, 1.0 / max(1, self.message_count))
+
+
+class Strategy(object):
+    """A way of answering a data table request"""
+
+    key = None
+
+    exact = True
+    """False if the strategy may estimate the values"""
+
+    cacheable = False
+    """True if the strategy's results should be put in the result cache"""
+
+    def applies(self, request):
+        """True if the strategy could answer the request"""
+        return False
+
+    def estimate_cost(self, request, stats):
+        """The estimated number of rows read to answer the request"""
+        return stats.message_count
+
+    def run(self, request):
+        """Answer the request, or raise StrategyUnavailable"""
+        raise StrategyUnavailable()
+
+
+class CachedStrategy(Strategy):
+    """Return the result of an earlier identical request"""
+    key = 'cached'
+
+    def applies(self, request):
+        entry = request.get_cached()
+        return entry is not None and (entry['exact'] or request.approximate)
+
+    def estimate_cost(self, request, stats):
+        return 1
+
+    def run(self, request):
+        return request.get_cached()['result']
+
+
+class PrecalcStrategy(Strategy):
+    """Read the precalculated distributions of unfiltered categorical dimensions"""
+    key = 'precalc'
+
+    def applies(self, request):
+        dimensions = request.dimensions
+        if not request.counting or not request.unfiltered:
+            return False
+        if len(dimensions) == 1:
+            return dimensions[0].is_categorical()
+        return len(dimensions) == 2 and request.groups is None and request.page is None and \
+            request.search_key is None and \
+            dimensions[0].is_categorical() and dimensions[1].is_categorical() and \
+            dimensions[0].key != "groups" and dimensions[1].key != "groups"
+
+    def estimate_cost(self, request, stats):
+        cost = 1
+        for dimension in request.dimensions:
+            cost *= stats.cardinality(dimension)
+        return min(cost, stats.message_count)
+
+    def run(self, request):
+        dimensions = request.dimensions
+        if len(dimensions) == 1:
+            return request.dataset.get_precalc_distribution(dimension=dimensions[0], search_key=request.search_key,
+                                                            page=request.page, page_size=request.page_size,
+                                                            mode=request.mode)
+
+        result = request.dataset.get_precalc_pair_distribution(primary_dimension=dimensions[0],
+                                                               secondary_dimension=dimensions[1],
+                                                               mode=request.mode)
+        if result is None:
+            # the pair was not precalculated
+            raise StrategyUnavailable()
+        return result
+
+
+class RollupStrategy(Strategy):
+    """Merge the precalculated time counts, rollups or distinct count sketches"""
+    key = 'rollup'
+
+    def applies(self, request):
+        if request.groups is not None or request.page is not None or request.search_key:
+            return False
+        if request.exclude or type(request.filters) != types.ListType:
+            return False
+        if not request.counting and not request.measure.is_approximate():
+            return False
+
+        # the time prefix sums hold single categorical dimensions, the rollups need time
+        has_time = any(isinstance(dimension, TimeDimension) for dimension in request.dimensions)
+        if not has_time and not (request.counting and len(request.dimensions) == 1):
+            return False
+
+        for filter in request.filters:
+            if not isinstance(filter['dimension'], TimeDimension):
+                return False
+            if 'value' in filter or filter.get('levels') or filter.get('min') or filter.get('max'):
+                return False
+        return True
+
+    def estimate_cost(self, request, stats):
+        cost = TIME_ROLLUP_BINS
+        for dimension in request.dimensions:
+            if not isinstance(dimension, TimeDimension):
+                cost *= stats.cardinality(dimension)
+        return cost
+
+    def run(self, request):
+        datatable = request.make_datatable()
+        filters, exclude = request.filters, request.exclude
+
+        result = None
+        if request.counting:
+            result = datatable.render_from_time_prefix_sums(request.dataset, filters, exclude)
+            if result is None:
+                result = datatable.render_from_time_rollups(request.dataset, filters, exclude)
+        else:
+            result = datatable.render_from_distinct_sketches(request.dataset, filters, exclude)
+            if result is not None:
+                result['approximate'] = True
+
+        if result is None:
+            raise StrategyUnavailable()
+        return result
+
+
+class LiveStrategy(Strategy):
+    """Count the messages in the database"""
+    key = 'live'
+    cacheable = True
+
+    def applies(self, request):
+        return True
+
+    def estimate_cost(self, request, stats):
+        rows = stats.message_count * stats.selectivity(request.filters, request.exclude)
+
+        for dimension in request.dimensions:
+            if get_multi_valued_relation(dimension) is not None:
+                rows *= RELATED_FANOUT
+
+        if request.groups is not None:
+            rows *= len(request.groups)
+
+        # sorting the levels
+        sorting = 0
+        for dimension in request.dimensions:
+            levels = stats.cardinality(dimension)
+            sorting += levels * math.log(max(2, levels), 2)
+
+        return int(math.ceil(rows + sorting))
+
+    def run(self, request):
+        return request.make_datatable().generate(request.dataset, request.filters, request.exclude,
+                                                 request.page_size, request.page, request.search_key,
+                                                 request.groups)
+
+
+class SampleStrategy(LiveStrategy):
+    """Count a random sample of the messages and scale the counts up"""
+    key = 'sample'
+    exact = False
+
+    # the cache key does not describe the sample
+    cacheable = False
+
+    def applies(self, request):
+        return request.approximate and request.groups is None and request.get_sample() is not None
+
+    def estimate_cost(self, request, stats):
+        return int(math.ceil(super(SampleStrategy, self).estimate_cost(request, stats) * request.get_sample().rate))
+
+    def run(self, request):
+        datatable = request.make_datatable()
+        datatable.set_sample(request.get_sample())
+        return datatable.generate(request.dataset, request.filters, request.exclude,
+                                  request.page_size, request.page, request.search_key,
+                                  request.groups)
+
+
+STRATEGIES = [CachedStrategy(), PrecalcStrategy(), RollupStrategy(), SampleStrategy(), LiveStrategy()]
+"""The strategies, in order of preference when their costs are equal"""
+
+
+def plan(request, stats=None):
+    """
+    Return the strategies that could answer the request accurately enough,
+    as a list of (strategy, estimated cost), cheapest first.
+    """
+    if stats is None:
+        stats = DatasetStatistics(request.dataset)
+
+    candidates = []
+    for preference, strategy in enumerate(STRATEGIES):
+        if not strategy.exact and not request.approximate:
+            continue
+        if strategy.applies(request):
+            candidates.append((strategy.estimate_cost(request, stats), preference, strategy))
+
+    candidates.sort()
+    return [(strategy, cost) for cost, preference, strategy in candidates]
+
+
+def generate(request, stats=None):
+    """
+    Answer a data table request with the cheapest strategy that works.
+    Returns the result and a description of the plan for the response.
+    """
+    candidates = plan(request, stats)
+
+    for strategy, cost in candidates:
+        try:
+            result = strategy.run(request)
+        except StrategyUnavailable:
+            continue
+
+        if strategy.cacheable and cost >= getattr(settings, 'DATATABLE_RESULT_CACHE_MIN_COST', 100000):
+            cache.set(request.get_cache_key(), {
+                'result': diagnostics.evaluate_result(result),
+                'exact': strategy.exact,
+            }, getattr(settings, 'DATATABLE_RESULT_CACHE_SECONDS', 600))
+
+        return result, {
+            'strategy': strategy.key,
+            'cost': cost,
+            'exact': strategy.exact,
+            'candidates': [{'strategy': s.key, 'cost': c, 'exact': s.exact} for s, c in candidates],
+        }
+
+    raise StrategyUnavailable("No strategy could answer the request.")
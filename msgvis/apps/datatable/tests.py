@@ -1,11 +1,16 @@
 from django.test import TestCase
+from django.db import connection
 from django.conf import settings
 from django.utils import timezone as tz
 from django.utils import dateparse
 import mock
 
 from msgvis.apps.datatable import models
+from msgvis.apps.datatable import diagnostics
+from msgvis.apps.datatable import planner
 from msgvis.apps.corpus import models as corpus_models
+from msgvis.apps.corpus import utils as corpus_utils
+from msgvis.apps.base import sql
 from msgvis.apps.dimensions.models import CategoricalDimension
 from msgvis.apps.dimensions import registry
 from msgvis.apps.base.tests import DistributionTestCaseMixins
@@ -575,3 +580,322 @@ class GenerateDataTableTest(DistributionTestCaseMixins, TestCase):
         datatable = MockDataTable(primary_dimension='time')
         datatable.generate(dataset)
         self.assertEquals(len(render_calls), 1)
+
+
+class PagedDataTableTest(DistributionTestCaseMixins, TestCase):
+    """Test paging through the levels of a dimension"""
+
+    def setUp(self):
+        self.dataset = self.create_authors_with_values('username', ['anna', 'bob', 'carol', 'dave'])
+        authors = dict(self.dataset.person_set.values_list('username', 'id'))
+        self.generate_messages_for_distribution('sender_id', {
+            authors['anna']: 4,
+            authors['bob']: 3,
+            authors['carol']: 2,
+            authors['dave']: 1,
+        }, dataset=self.dataset)
+
+    def test_pages(self):
+        """It should return the most frequent levels a page at a time, with their counts"""
+        datatable = models.DataTable('sender')
+
+        result = datatable.generate(self.dataset, page_size=2, page=1)
+        self.assertEquals(result['domains']['sender'], ['anna', 'bob'])
+        self.assertEquals(list(result['table']), [{'sender': 'anna', 'value': 4},
+                                                  {'sender': 'bob', 'value': 3}])
+        self.assertEquals(result['max_page'], 3)
+
+        result = datatable.generate(self.dataset, page_size=2, page=2)
+        self.assertEquals(result['domains']['sender'], ['carol', 'dave'])
+
+        self.assertIsNone(datatable.generate(self.dataset, page_size=2, page=3))
+
+    def test_search(self):
+        """It should only page through the levels that contain the search key"""
+        datatable = models.DataTable('sender')
+
+        result = datatable.generate(self.dataset, page_size=2, page=1, search_key='A')
+        self.assertEquals(result['domains']['sender'], ['anna', 'carol'])
+        self.assertEquals(result['max_page'], 2)
+
+    def test_filtered_page(self):
+        """Filters on other dimensions should still apply to the counts"""
+        datatable = models.DataTable('sender')
+        filters = [{'dimension': registry.get_dimension('contains_url'), 'value': True}]
+
+        result = datatable.generate(self.dataset, filters=filters, page_size=2, page=1)
+        self.assertEquals(result['domains']['sender'], ['anna', 'bob'])
+        self.assertEquals(list(result['table']), [])
+
+
+class RawGroupingQueryTest(TestCase):
+    """Test the raw SQL grouping queries used for groups"""
+
+    def setUp(self):
+        from msgvis.apps.enhance import models as enhance_models
+
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        hashtags = dict((text, corpus_models.Hashtag.objects.create(text=text)) for text in ['nfl', 'ads'])
+        words = dict((text, enhance_models.TweetWord.objects.create(dataset=self.dataset, text=text))
+                     for text in ['super', 'bowl'])
+
+        for text, tags, shared_count in [("super bowl #nfl", ['nfl'], 1),
+                                         ("o'brien's bowl #nfl #ads", ['nfl', 'ads'], 2),
+                                         ("bowl", [], 3)]:
+            msg = self.dataset.message_set.create(text=text, shared_count=shared_count, contains_hashtag=bool(tags))
+            for tag in tags:
+                msg.hashtags.add(hashtags[tag])
+            for word in text.split(' '):
+                if word in words:
+                    words[word].messages.add(msg)
+        enhance_models.Lemma.rebuild(connection, self.dataset.id)
+
+    def test_group_by_dimension_over_union(self):
+        """It should count the levels in a union of querysets, binding the parameters"""
+        querysets = [self.dataset.message_set.filter(contains_hashtag=True, shared_count=1),
+                     self.dataset.message_set.filter(text="o'brien's bowl #nfl #ads")]
+        query, params = sql.union(querysets)
+
+        domain = models.group_messages_by_dimension_with_raw_query(query, params, registry.get_dimension('hashtags'),
+                                                                   sql.fetch_column)
+        self.assertEquals(domain, ['nfl', 'ads'])
+
+    def test_group_by_words(self):
+        """It should count the words, restricted to the words filtered on"""
+        queryset = self.dataset.message_set.filter(corpus_utils.levels_or('lemmas__text', ['bowl']))
+        table = models.group_messages_by_words_with_raw_query(queryset, sql.fetch_dicts)
+        self.assertEquals(table, [{'words': 'bowl', 'value': 3}])
+
+        table = models.group_messages_by_words_with_raw_query(self.dataset.message_set.filter(shared_count=1),
+                                                              sql.fetch_dicts)
+        self.assertEquals(sorted(table), sorted([{'words': 'super', 'value': 1}, {'words': 'bowl', 'value': 1}]))
+
+
+class FacetsTest(DistributionTestCaseMixins, TestCase):
+    """Test counting several dimensions against the same filtered messages"""
+
+    def setUp(self):
+        self.dataset = self.create_authors_with_values('username', ['anna', 'bob', 'carol', 'dave'])
+        authors = dict(self.dataset.person_set.values_list('username', 'id'))
+        self.generate_messages_for_distribution('sender_id', {
+            authors['anna']: 4,
+            authors['bob']: 3,
+            authors['carol']: 2,
+            authors['dave']: 1,
+        }, dataset=self.dataset)
+
+    def test_facets(self):
+        """Each dimension should be counted over the filtered messages"""
+        filters = [{'dimension': registry.get_dimension('sender'), 'levels': ['anna', 'bob', 'dave']}]
+
+        facets = models.generate_facets(self.dataset, ['sender', 'contains_url', 'shares'],
+                                        filters=filters, limit=2)
+
+        self.assertEquals(facets['sender']['table'], [{'sender': 'anna', 'value': 4},
+                                                      {'sender': 'bob', 'value': 3}])
+        self.assertEquals(facets['sender']['levels'], 3)
+        self.assertEquals(facets['contains_url']['table'], [{'contains_url': False, 'value': 8}])
+        self.assertEquals(sum(row['value'] for row in facets['shares']['table']), 8)
+
+    def test_drops_temp_table(self):
+        """The materialized message ids should not outlive the request"""
+        with mock.patch.object(corpus_utils, 'drop_temp_table', wraps=corpus_utils.drop_temp_table) as drop:
+            models.generate_facets(self.dataset, ['sender', 'contains_url'])
+        self.assertEquals(drop.call_count, 1)
+
+
+class PlannerTest(DistributionTestCaseMixins, TestCase):
+    """Test choosing how to calculate a data table"""
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+
+        self.dataset = self.create_authors_with_values('username', ['anna', 'bob'])
+        authors = dict(self.dataset.person_set.values_list('username', 'id'))
+        self.generate_messages_for_distribution('sender_id', {
+            authors['anna']: 3,
+            authors['bob']: 1,
+        }, dataset=self.dataset)
+
+    def tearDown(self):
+        from django.core.cache import cache
+        cache.clear()
+
+    def make_request(self, dimensions, **kwargs):
+        data = dict(kwargs, dataset=self.dataset, dimensions=[registry.get_dimension(d) for d in dimensions])
+        return planner.TableRequest(data)
+
+    def test_precalc_is_cheapest(self):
+        """An unfiltered categorical distribution should be read from the precalculated counts"""
+        self.dataset.distributions.create(dimension_key='sender', level='anna', count=3)
+        self.dataset.distributions.create(dimension_key='sender', level='bob', count=1)
+
+        result, plan = planner.generate(self.make_request(['sender']))
+        self.assertEquals(plan['strategy'], 'precalc')
+        self.assertIn('live', [c['strategy'] for c in plan['candidates']])
+        self.assertEquals(result['domains']['sender'], ['anna', 'bob'])
+
+    def test_falls_back(self):
+        """A pair that was not precalculated should be counted live"""
+        result, plan = planner.generate(self.make_request(['sender', 'contains_url']))
+        self.assertEquals(plan['strategy'], 'live')
+        self.assertEquals(plan['candidates'][0]['strategy'], 'precalc')
+        self.assertEquals(sorted(row['value'] for row in result['table']), [1, 3])
+
+    def test_live_counts_messages(self):
+        """The live strategy should count the messages rather than read the precalculated counts"""
+        from msgvis.apps.enhance import tasks
+        tasks.precalc_time_rollups(dataset_id=self.dataset.id)
+
+        with mock.patch.object(models.DataTable, 'render_from_time_rollups') as render:
+            result = planner.LiveStrategy().run(self.make_request(['time']))
+        self.assertFalse(render.called)
+        self.assertEquals(sum(row['value'] for row in result['table']), 4)
+
+    def test_exact_unless_approximate(self):
+        """The sample should only be counted for approximate requests"""
+        from msgvis.apps.enhance import models as enhance_models
+        enhance_models.MessageSample.draw(self.dataset, self.dataset.message_set.all(), rate=0.5)
+        filters = [{'dimension': registry.get_dimension('contains_url'), 'value': False}]
+
+        candidates = planner.plan(self.make_request(['sender'], filters=filters))
+        self.assertEquals([s.key for s, cost in candidates], ['live'])
+
+        candidates = planner.plan(self.make_request(['sender'], filters=filters, approximate=True))
+        self.assertEquals([s.key for s, cost in candidates], ['sample', 'live'])
+
+    def test_precalc_over_sample(self):
+        """Approximate requests should still read exact precalculated counts first"""
+        from msgvis.apps.enhance import models as enhance_models
+        enhance_models.MessageSample.draw(self.dataset, self.dataset.message_set.all(), rate=0.5)
+        self.dataset.distributions.create(dimension_key='sender', level='anna', count=3)
+        self.dataset.distributions.create(dimension_key='sender', level='bob', count=1)
+
+        result, plan = planner.generate(self.make_request(['sender'], approximate=True))
+        self.assertEquals(plan['strategy'], 'precalc')
+        self.assertTrue(plan['exact'])
+        self.assertNotIn('approximate', result)
+
+    def test_result_cache(self):
+        """Expensive live results should be reused by identical requests"""
+        filters = [{'dimension': registry.get_dimension('contains_url'), 'value': False}]
+
+        with self.settings(DATATABLE_RESULT_CACHE_MIN_COST=0):
+            first, plan = planner.generate(self.make_request(['sender'], filters=filters))
+            self.assertEquals(plan['strategy'], 'live')
+
+            second, plan = planner.generate(self.make_request(['sender'], filters=filters))
+            self.assertEquals(plan['strategy'], 'cached')
+            self.assertEquals(second, first)
+
+    def test_sample_not_cached(self):
+        """Estimates from a sample should not be reused by later requests"""
+        from msgvis.apps.enhance import models as enhance_models
+        enhance_models.MessageSample.draw(self.dataset, self.dataset.message_set.all(), rate=0.5)
+        filters = [{'dimension': registry.get_dimension('contains_url'), 'value': False}]
+
+        with self.settings(DATATABLE_RESULT_CACHE_MIN_COST=0):
+            result, plan = planner.generate(self.make_request(['sender'], filters=filters, approximate=True))
+            self.assertEquals(plan['strategy'], 'sample')
+
+            result, plan = planner.generate(self.make_request(['sender'], filters=filters, approximate=True))
+            self.assertEquals(plan['strategy'], 'sample')
+
+    def test_rollups_not_searched(self):
+        """The time counts cannot filter levels by a search key"""
+        self.assertFalse(planner.RollupStrategy().applies(self.make_request(['contains_url'], search_key='tr')))
+        self.assertTrue(planner.RollupStrategy().applies(self.make_request(['contains_url'])))
+        self.assertFalse(planner.Strategy().applies(self.make_request(['contains_url'])))
+
+    def test_cache_key_versions(self):
+        """New messages and edited groups should not be answered from the cache"""
+        from msgvis.apps.groups.models import Group
+        group = Group.objects.create(dataset=self.dataset, name="anna", keywords="message")
+
+        key = self.make_request(['sender'], groups=[group.id]).get_cache_key()
+        self.assertEquals(self.make_request(['sender'], groups=[group.id]).get_cache_key(), key)
+
+        group.keywords = "message 1"
+        group.save()
+        edited = self.make_request(['sender'], groups=[group.id]).get_cache_key()
+        self.assertNotEquals(edited, key)
+
+        self.dataset.message_set.create(text="new")
+        self.assertNotEquals(self.make_request(['sender'], groups=[group.id]).get_cache_key(), edited)
+
+    def test_selectivity(self):
+        """Filters on a few levels should be estimated to match few messages"""
+        stats = planner.DatasetStatistics(self.dataset)
+        sender = registry.get_dimension('sender')
+        self.assertEquals(stats.message_count, 4)
+
+        self.assertEquals(stats.selectivity([{'dimension': sender, 'levels': ['anna']}], []), 0.25)
+        self.assertEquals(stats.selectivity([], [{'dimension': sender, 'levels': ['anna']}]), 0.75)
+
+
+class DiagnosticsTest(DistributionTestCaseMixins, TestCase):
+    """Test capturing the SQL run for a data table"""
+
+    def test_capture_and_explain(self):
+        """It should record each statement with its rows and query plan"""
+        dataset = self.generate_messages_for_distribution('shared_count', {1: 2, 3: 1})
+
+        with diagnostics.QueryCapture() as capture:
+            result = diagnostics.evaluate_result(models.DataTable('shares').generate(dataset))
+        capture.explain()
+
+        queries = capture.get_report()
+        self.assertGreater(len(queries), 0)
+        grouping = [q for q in queries if 'GROUP BY' in q['sql']]
+        self.assertEquals(len(grouping), 1)
+        self.assertEquals(grouping[0]['rows'], len(result['table']))
+        self.assertGreater(len(grouping[0]['explain']), 0)
+
+        # the connection should be back to normal
+        with diagnostics.QueryCapture() as other:
+            pass
+        self.assertEquals(len(capture.queries), len(queries))
+        self.assertEquals(other.queries, [])
+
+    def test_log_slow_request(self):
+        """Only requests over the threshold should be logged, as canonical JSON"""
+        data = {'dimensions': ['time'], 'dataset': 1}
+        with self.settings(DATATABLE_SLOW_REQUEST_SECONDS=1.0):
+            with mock.patch.object(diagnostics.slow_request_logger, 'warning') as warning:
+                self.assertFalse(diagnostics.log_slow_request(data, 0.5))
+                self.assertTrue(diagnostics.log_slow_request(data, 2.0))
+
+        warning.assert_called_once_with('{"duration": 2.0, "request": {"dataset": 1, "dimensions": ["time"]}}')
+
+
+class MeasuresDataTableTest(DistributionTestCaseMixins, TestCase):
+    """Test summarizing the messages with measures other than count"""
+
+    def test_sum_measure(self):
+        """It should add up a field in each cell"""
+        dataset = self.generate_messages_for_distribution('shared_count', {1: 5, 3: 6})
+
+        datatable = models.DataTable('contains_url')
+        datatable.set_measure('share_count')
+        result = datatable.generate(dataset)
+
+        self.assertEquals(list(result['table']), [{'contains_url': False, 'value': 23}])
+
+    def test_distinct_count_measures(self):
+        """The approximate distinct counts should match the exact ones in each cell"""
+        dataset = self.create_authors_with_values('username', ['anna', 'bob', 'carol'])
+        self.distibute_messages_to_authors(dataset)
+
+        datatable = models.DataTable('time')
+        datatable.set_measure('sender_count')
+        exact = datatable.generate(dataset)
+        self.assertNotIn('approximate', exact)
+
+        datatable.set_measure('sender_count_approx')
+        approximate = datatable.generate(dataset)
+        self.assertTrue(approximate['approximate'])
+
+        self.assertEquals(dict((row['time'], row['value']) for row in approximate['table']),
+                          dict((row['time'], row['value']) for row in exact['table']))
+        self.assertEquals(datatable.measure.aggregate_all(dataset.message_set.all()), 3)
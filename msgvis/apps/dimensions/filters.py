@@ -0,0 +1,83 @@
+"""
+Apply a list of dimension filters to a set of messages.
+
+Filtering on a many-to-many dimension (hashtags, mentions, words, topics, ...)
+with ``dimension.filter()`` joins the related table, so a message appears once
+for every matching related row. Counts over the filtered messages are inflated
+and listing them needs ``DISTINCT``.
+
+:func:`apply_filters` instead turns the filters on each multi-valued relation into
+a single ``IN (subquery)`` semi-join, which matches each message at most once.
+
+.. code-block:: python
+
+    filters = [
+        {'dimension': registry.get_dimension('hashtags'), 'levels': ['nfl', 'superbowl']},
+        {'dimension': registry.get_dimension('time'), 'min_time': ..., 'max_time': ...},
+    ]
+    messages = apply_filters(dataset.message_set.all(), filters)
+    # WHERE time BETWEEN ... AND id IN (SELECT ... WHERE hashtags.text IN ('nfl', 'superbowl'))
+"""
+
+from django.db.models.fields import FieldDoesNotExist
+
+from msgvis.apps.corpus import models as corpus_models
+
+
+def get_multi_valued_relation(dimension):
+    """
+    The name of the many-to-many or reverse relation of Message
+    that the dimension's field goes through, or None.
+    """
+    relation = dimension.field_name.split('__')[0]
+    try:
+        field, model, direct, m2m = corpus_models.Message._meta.get_field_by_name(relation)
+    except FieldDoesNotExist:
+        return None
+
+    if m2m or not direct:
+        return relation
+    return None
+
+
+def _get_params(filter):
+    """The filter params without the dimension"""
+    return {key: value for key, value in filter.iteritems() if key != "dimension"}
+
+
+def apply_filters(queryset, filters=None, excludes=None, join_dimensions=()):
+    """
+    Filter a set of messages with lists of filters and excludes (dictionaries
+    containing dimensions and filter params).
+
+    Filters on multi-valued relations are combined into one semi-join per relation.
+    Filters on the join_dimensions are joined as usual, e.g. when the messages will be
+    grouped by that dimension and the filter should also restrict the groups.
+    """
+
+    # relation name -> messages matching the filters on that relation
+    semi_joins = {}
+    relations = []
+
+    for filter in filters or []:
+        dimension = filter["dimension"]
+        params = _get_params(filter)
+
+        relation = get_multi_valued_relation(dimension)
+        if relation is None or dimension in join_dimensions:
+            queryset = dimension.filter(queryset, **params)
+        else:
+            if relation not in semi_joins:
+                semi_joins[relation] = corpus_models.Message.objects.all()
+                relations.append(relation)
+            semi_joins[relation] = dimension.filter(semi_joins[relation], **params)
+
+    for relation in relations:
+        queryset = queryset.filter(pk__in=semi_joins[relation].values('pk'))
+
+    # Excludes on multi-valued relations already become subqueries
+    for exclude in excludes or []:
+        dimension = exclude["dimension"]
+        queryset = dimension.exclude(queryset, **_get_params(exclude))
+
+    return queryset
@@ -1,4 +1,3 @@
-import operator
 import math
 from datetime import datetime, timedelta
 
@@ -9,9 +8,11 @@ from django.utils import dateformat, timezone
 
 from msgvis.apps.base.models import MappedValuesQuerySet
 from msgvis.apps.corpus import models as corpus_models
+from msgvis.apps.corpus import utils as corpus_utils
 
 
 QUANTITATIVE_DIMENSION_BINS = getattr(settings, 'QUANTITATIVE_DIMENSION_BINS', 50)
+TIME_ROLLUP_DIMENSIONS = getattr(settings, 'TIME_ROLLUP_DIMENSIONS', ('type', 'sentiment', 'language'))
 
 
 def db_vendor():
@@ -20,6 +21,13 @@ def db_vendor():
     return connection.vendor
 
 
+def _from_epoch_seconds(value):
+    """Convert epoch seconds from a time bucket grouping back into a datetime"""
+    if value is None:
+        return None
+    return corpus_utils.from_epoch_seconds(value)
+
+
 def find_messages(queryset):
     """If the given queryset is actually a :class:`.Dataset` model, get its messages queryset."""
     if isinstance(queryset, corpus_models.Dataset):
@@ -89,16 +97,8 @@ class CategoricalDimension(object):
         queryset = self._exact_filter(queryset, **kwargs)
 
         if kwargs.get('levels'):
-            filter_ors = []
-            for level in kwargs.get('levels'):
-                if level is None or str(level).strip() == "":
-                    filter_ors.append((self.field_name + "__isnull", True))
-                else:
-                    if level == "false":
-                        level = False
-                    filter_ors.append((self.field_name, level))
-
-            queryset = queryset.filter(reduce(operator.or_, [Q(x) for x in filter_ors]))
+            levels = [False if level == "false" else level for level in kwargs.get('levels')]
+            queryset = queryset.filter(corpus_utils.levels_or(self.field_name, levels))
 
         return queryset
 
@@ -110,11 +110,8 @@ class CategoricalDimension(object):
 
         queryset = self._exact_exclude(queryset, **kwargs)
 
-        for level in kwargs.get('levels'):
-            if level is None or str(level).strip() == "":
-                queryset = queryset.exclude(Q((self.field_name + "__isnull", True)))
-            else:
-                queryset = queryset.exclude(Q((self.field_name, level)))
+        if kwargs.get('levels'):
+            queryset = queryset.exclude(corpus_utils.levels_or(self.field_name, kwargs.get('levels')))
 
         return queryset
 
@@ -190,6 +187,34 @@ class CategoricalDimension(object):
 
         return [row['value'] for row in queryset]
 
+    def get_domain_page(self, queryset, page, page_size, search_key=None):
+        """
+        Get one page of the values of the dimension, most frequent first,
+        along with their message counts. The paging is done in the database.
+        If a search key is given, only values that contain it (ignoring case) are included.
+
+        Returns a list of (value, count) tuples and the total number of matching values.
+        """
+
+        # Type checking
+        queryset = find_messages(queryset)
+
+        if search_key is not None:
+            queryset = queryset.filter(Q((self.field_name + "__icontains", search_key)))
+
+        total = queryset.values(self.field_name).distinct().count()
+
+        queryset = queryset.values(self.field_name)
+        queryset = queryset.annotate(count=models.Count('id'))
+
+        # Break ties by value so the pages do not overlap
+        queryset = queryset.order_by('-count', self.field_name)
+
+        start = (page - 1) * page_size
+        rows = queryset[start:start + page_size]
+
+        return [(row[self.field_name], row['count']) for row in rows], total
+
 
     def get_domain_labels(self, domain):
         """Return a list of labels corresponding to the domain values"""
@@ -206,6 +231,13 @@ class CategoricalDimension(object):
         """
         return self.field_name
 
+    def get_grouping_converter(self, expression):
+        """
+        Return a function that turns the values of a grouping expression
+        back into values of this dimension, or None if no conversion is needed.
+        """
+        return None
+
 
 class ChoicesCategoricalDimension(CategoricalDimension):
     """
@@ -405,6 +437,12 @@ class QuantitativeDimension(CategoricalDimension):
             # Then use values to group by the grouping key.
             queryset = queryset.values(internal_key)
 
+            converter = self.get_grouping_converter(expression)
+            if converter is not None:
+                return MappedValuesQuerySet.create_from(queryset, {
+                    internal_key: grouping_key,
+                }, converters={grouping_key: converter})
+
             return MappedValuesQuerySet.create_from(queryset, {
                 internal_key: grouping_key,
             })
@@ -529,6 +567,51 @@ class TimeDimension(QuantitativeDimension):
         'sqlite': r"DATETIME({bin_size} * CAST(STRFTIME('%%s', `{field_name}`) / {bin_size} AS INTEGER), 'unixepoch')"
     }
 
+    # Messages also store their time in epoch seconds and in minute, hour and day buckets.
+    # Bins that are a multiple of a bucket are grouped on the (indexed) bucket integers
+    # and only converted back to datetimes after grouping.
+    bucket_grouping_expressions = QuantitativeDimension.grouping_expressions
+
+    def _get_time_bucket(self, bin_size):
+        """The coarsest time bucket field on Message that the bin size is a multiple of, and its size"""
+        if self.field_name == 'time' and bin_size == int(bin_size):
+            for field_name, bucket_size in corpus_models.Message.TIME_BUCKETS:
+                if int(bin_size) % bucket_size == 0:
+                    return field_name, bucket_size
+        return None, None
+
+    def _is_bucket_expression(self, expression):
+        """True if the grouping expression gives epoch seconds rather than datetimes"""
+        for field_name, bucket_size in corpus_models.Message.TIME_BUCKETS:
+            if expression == field_name or ('`%s`' % field_name) in expression:
+                return True
+        return False
+
+    def _render_grouping_expression(self, bin_size):
+        field_name, bucket_size = self._get_time_bucket(bin_size)
+        if field_name is None:
+            return super(TimeDimension, self)._render_grouping_expression(bin_size)
+
+        if int(bin_size) == bucket_size:
+            # the bucket is the bin
+            return field_name
+
+        return self.bucket_grouping_expressions[db_vendor()].format(
+            field_name=field_name,
+            bin_size=int(bin_size)
+        )
+
+    def select_grouping_expression(self, queryset, expression):
+        if expression in [field_name for field_name, bucket_size in corpus_models.Message.TIME_BUCKETS]:
+            # a plain column
+            return queryset, expression
+        return super(TimeDimension, self).select_grouping_expression(queryset, expression)
+
+    def get_grouping_converter(self, expression):
+        if expression is not None and self._is_bucket_expression(expression):
+            return _from_epoch_seconds
+        return None
+
     # A range of human-friendly time bin sizes
     # https://github.com/mbostock/d3/blob/master/src/time/scale.js
     # NOTE: these are in milliseconds! (JS uses millis)
@@ -597,13 +680,165 @@ class TimeDimension(QuantitativeDimension):
 
     def _bin_value(self, value, bin_size):
         """Bin the given value"""
-        timestamp = long(dateformat.format(value, 'U'))
+        timestamp = corpus_utils.epoch_seconds(value)
         timestamp = bin_size * math.floor(timestamp / bin_size)
-        dt = datetime.utcfromtimestamp(timestamp)
-        if settings.USE_TZ:
-            return dt.replace(tzinfo=timezone.utc)
-        else:
-            return dt
+        return corpus_utils.from_epoch_seconds(timestamp)
+
+    def get_rollup_bin_sizes(self):
+        """The bin sizes (in seconds) that are precalculated in the time rollups, finest first."""
+        return [int(step / 1000) for step in self.d3_time_scaleSteps]
+
+    def _get_rollups(self, dataset, bin_size, dimension_key=""):
+        from msgvis.apps.enhance.models import PrecalcTimeRollup
+
+        return PrecalcTimeRollup.objects.filter(dataset=dataset, bin_size=bin_size, dimension_key=dimension_key)
+
+    def has_rollups(self, dataset, dimension_key=""):
+        """Return True if the time rollups have been calculated for the dataset (split by the dimension)"""
+        return self._get_rollups(dataset, self.get_rollup_bin_sizes()[0], dimension_key).exists()
+
+    def get_rollup_range(self, dataset, min_time=None, max_time=None):
+        """
+        Find a min and max time from the finest time rollup, as a tuple.
+        If there isn't one, (None, None) is returned.
+        """
+        rollups = self._get_rollups(dataset, self.get_rollup_bin_sizes()[0])
+        if min_time:
+            rollups = rollups.filter(time__gte=min_time)
+        if max_time:
+            rollups = rollups.filter(time__lte=max_time)
+
+        time_range = rollups.aggregate(min=models.Min('time'), max=models.Max('time'))
+        return time_range['min'], time_range['max']
+
+    def get_rollup_levels(self, dataset, dimension):
+        """Get the domain of a dimension that has been crossed with time in the rollups."""
+        if hasattr(dimension, 'domain'):
+            return dimension.domain
+
+        # the coarsest bins have the fewest rows
+        rollups = self._get_rollups(dataset, self.get_rollup_bin_sizes()[-1], dimension.key)
+        rollups = rollups.values('level').annotate(total=models.Sum('count')).order_by('-total')
+        return [self._rollup_level_value(dimension, row['level']) for row in rollups]
+
+    def _rollup_level_value(self, dimension, level):
+        """Recover a dimension value from the string level stored in a rollup"""
+        if level == "":
+            return None
+        for value in getattr(dimension, 'domain', ()):
+            if unicode(value) == level:
+                return value
+        return level
+
+    def _is_rollup_aligned(self, bin_size, min_time=None, max_time=None):
+        """True if the time filter does not cut through any bins"""
+        if min_time and long(dateformat.format(min_time, 'U')) % bin_size != 0:
+            return False
+        if max_time and (long(dateformat.format(max_time, 'U')) + 1) % bin_size != 0:
+            return False
+        return True
+
+    def group_by_rollups(self, dataset, grouping_key=None, bins=None, min_time=None, max_time=None,
+                         secondary_dimension=None):
+        """
+        Count the messages in each time bin, optionally split by a secondary
+        dimension, using the precalculated time rollups instead of grouping the messages.
+
+        The bin size is chosen the same way as :meth:`group_by` would for messages
+        between min_time and max_time.
+
+        Returns a (domain, table) tuple, or None if the rollups cannot answer the request.
+        """
+        if grouping_key is None:
+            grouping_key = self.key
+
+        dimension_key = secondary_dimension.key if secondary_dimension is not None else ""
+        if not self.has_rollups(dataset) or not self.has_rollups(dataset, dimension_key):
+            return None
+
+        min_val, max_val = self.get_rollup_range(dataset, min_time, max_time)
+        if min_val is None:
+            return [], []
+
+        if bins is None:
+            bins = self.default_bins
+
+        bin_size = self._get_bin_size(min_val, max_val, bins)
+        if int(bin_size) not in self.get_rollup_bin_sizes() or \
+           not self._is_rollup_aligned(bin_size, min_time, max_time):
+            return None
+
+        min_bin = self._bin_value(min_val, bin_size)
+        max_bin = self._bin_value(max_val, bin_size)
+        domain = list(self._iter_xrange(min_bin, max_bin, bin_size))
+
+        rollups = self._get_rollups(dataset, int(bin_size), dimension_key)
+        if min_time:
+            rollups = rollups.filter(time__gte=min_time)
+        if max_time:
+            rollups = rollups.filter(time__lte=max_time)
+
+        table = []
+        for rollup in rollups.order_by('time'):
+            row = {grouping_key: rollup.time, 'value': rollup.count}
+            if secondary_dimension is not None:
+                row[secondary_dimension.key] = self._rollup_level_value(secondary_dimension, rollup.level)
+            table.append(row)
+
+        return domain, table
+
+    def group_by_distinct_sketches(self, dataset, measure, grouping_key=None, bins=None,
+                                   min_time=None, max_time=None):
+        """
+        Estimate an approximate distinct count measure in each time bin by merging
+        the precalculated HyperLogLog sketches of the finer bins inside it.
+
+        Returns a (domain, table) tuple, or None if the sketches cannot answer the request.
+        """
+        from msgvis.apps.enhance.models import PrecalcTimeDistinctSketch
+
+        if grouping_key is None:
+            grouping_key = self.key
+
+        sketches = PrecalcTimeDistinctSketch.objects.filter(dataset=dataset, measure_key=measure.key)
+        if min_time:
+            sketches = sketches.filter(time__gte=min_time)
+        if max_time:
+            sketches = sketches.filter(time__lte=max_time)
+
+        base_bin_size = sketches.values_list('bin_size', flat=True).first()
+        if base_bin_size is None:
+            if PrecalcTimeDistinctSketch.objects.filter(dataset=dataset, measure_key=measure.key).exists():
+                return [], []
+            return None
+
+        time_range = sketches.aggregate(min=models.Min('time'), max=models.Max('time'))
+        min_val, max_val = time_range['min'], time_range['max']
+
+        if bins is None:
+            bins = self.default_bins
+
+        bin_size = int(self._get_bin_size(min_val, max_val, bins))
+        if bin_size % base_bin_size != 0 or \
+           not self._is_rollup_aligned(base_bin_size, min_time, max_time):
+            return None
+
+        min_bin = self._bin_value(min_val, bin_size)
+        max_bin = self._bin_value(max_val, bin_size)
+        domain = list(self._iter_xrange(min_bin, max_bin, bin_size))
+
+        merged = {}
+        for precalc in sketches.order_by('time'):
+            bin_time = self._bin_value(precalc.time, bin_size)
+            if bin_time in merged:
+                merged[bin_time].merge(precalc.get_sketch())
+            else:
+                merged[bin_time] = precalc.get_sketch()
+
+        table = [{grouping_key: bin_time, 'value': merged[bin_time].cardinality()}
+                 for bin_time in sorted(merged.keys())]
+
+        return domain, table
 
     def _iter_xrange(self, min, max, step):
         step = timedelta(seconds=step)
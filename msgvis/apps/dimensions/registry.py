@@ -84,7 +84,7 @@ register(models.TextDimension, dict(
     key='words',
     name='Keywords',
     description='The words found in the message',
-    field_name='tweet_words__text',
+    field_name='lemmas__text',
 ))
 
 register(models.RelatedCategoricalDimension, dict(
@@ -190,6 +190,7 @@ register(models.CategoricalDimension, dict(
 # END INTERACTIONS DIMENSIONS
 
 # BEGIN SENDER DIMENSIONS
+# The sender counters are binned on the snapshot copied onto each message, see Message.SENDER_COUNTERS
 register(models.RelatedCategoricalDimension, dict(
     key='sender',
     name='Author Name',
@@ -197,46 +198,46 @@ register(models.RelatedCategoricalDimension, dict(
     field_name='sender__username',
 ))
 
-register(models.RelatedQuantitativeDimension, dict(
+register(models.QuantitativeDimension, dict(
     key='sender_message_count',
     name='Num. Messages',
     description="The author's total number of messages",
-    field_name='sender__message_count',
+    field_name='sender_message_count',
 ))
 
-register(models.RelatedQuantitativeDimension, dict(
+register(models.QuantitativeDimension, dict(
     key='sender_reply_count',
     name='Num. Replies',
     description="The total replies the author has received",
-    field_name='sender__replied_to_count',
+    field_name='sender_replied_to_count',
 ))
 
-register(models.RelatedQuantitativeDimension, dict(
+register(models.QuantitativeDimension, dict(
     key='sender_mention_count',
     name='Num. Mentions',
     description="The total times the author has been mentioned",
-    field_name='sender__mentioned_count',
+    field_name='sender_mentioned_count',
 ))
 
-register(models.RelatedQuantitativeDimension, dict(
+register(models.QuantitativeDimension, dict(
     key='sender_share_count',
     name='Num. Shares',
     description="The total shares or retweets the author has received",
-    field_name='sender__shared_count',
+    field_name='sender_shared_count',
 ))
 
-register(models.RelatedQuantitativeDimension, dict(
+register(models.QuantitativeDimension, dict(
     key='sender_friend_count',
     name='Num. Friends',
     description="The number of people the author has connected to",
-    field_name='sender__friend_count',
+    field_name='sender_friend_count',
 ))
 
-register(models.RelatedQuantitativeDimension, dict(
+register(models.QuantitativeDimension, dict(
     key='sender_follower_count',
     name='Num. Followers',
     description="The number of people who have connected to the author",
-    field_name='sender__follower_count',
+    field_name='sender_follower_count',
 ))
 # END SENDER DIMENSIONS
 
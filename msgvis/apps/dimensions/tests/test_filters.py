@@ -0,0 +1,67 @@
+"""Test applying lists of dimension filters to messages"""
+
+from django.test import TestCase
+from django.db.models import Count
+
+from msgvis.apps.dimensions import registry
+from msgvis.apps.dimensions.filters import apply_filters, get_multi_valued_relation
+from msgvis.apps.corpus import models as corpus_models
+
+
+class ApplyFiltersTest(TestCase):
+    def setUp(self):
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+
+        hashtags = dict((text, corpus_models.Hashtag.objects.create(text=text))
+                        for text in ['nfl', 'superbowl', 'ads'])
+
+        for text, tags, shared_count in [("#nfl #superbowl", ['nfl', 'superbowl'], 1),
+                                         ("#superbowl #ads", ['superbowl', 'ads'], 2),
+                                         ("#ads", ['ads'], 3),
+                                         ("nothing", [], 4)]:
+            msg = self.dataset.message_set.create(text=text, shared_count=shared_count)
+            for tag in tags:
+                msg.hashtags.add(hashtags[tag])
+
+        self.hashtags = registry.get_dimension('hashtags')
+        self.shares = registry.get_dimension('shares')
+
+    def test_multi_valued_relation(self):
+        """Only dimensions through many-to-many or reverse relations are multi-valued"""
+        self.assertEquals(get_multi_valued_relation(self.hashtags), 'hashtags')
+        self.assertEquals(get_multi_valued_relation(registry.get_dimension('words')), 'lemmas')
+        self.assertIsNone(get_multi_valued_relation(self.shares))
+        self.assertIsNone(get_multi_valued_relation(registry.get_dimension('sender')))
+
+    def test_messages_not_repeated(self):
+        """A message matching several levels should be counted once"""
+        filters = [{'dimension': self.hashtags, 'levels': ['nfl', 'superbowl']}]
+        messages = apply_filters(self.dataset.message_set.all(), filters)
+
+        self.assertEquals(sorted(messages.values_list('text', flat=True)),
+                          ["#nfl #superbowl", "#superbowl #ads"])
+        self.assertEquals(messages.aggregate(count=Count('id'))['count'], 2)
+
+    def test_filters_on_same_relation(self):
+        """Each filter on the same relation should still have to match"""
+        filters = [
+            {'dimension': self.hashtags, 'levels': ['superbowl']},
+            {'dimension': self.hashtags, 'levels': ['ads']},
+            {'dimension': self.shares, 'min': 0, 'max': 5},
+        ]
+        messages = apply_filters(self.dataset.message_set.all(), filters)
+        self.assertEquals(list(messages.values_list('text', flat=True)), ["#superbowl #ads"])
+
+    def test_excludes(self):
+        """Excluded levels should remove every message with them"""
+        excludes = [{'dimension': self.hashtags, 'levels': ['superbowl']}]
+        messages = apply_filters(self.dataset.message_set.all(), excludes=excludes)
+        self.assertEquals(sorted(messages.values_list('text', flat=True)), ["#ads", "nothing"])
+
+    def test_join_dimensions(self):
+        """Filters on join dimensions should also restrict the grouped levels"""
+        filters = [{'dimension': self.hashtags, 'levels': ['superbowl']}]
+        messages = apply_filters(self.dataset.message_set.all(), filters, join_dimensions=[self.hashtags])
+
+        grouped = messages.values('hashtags__text').annotate(count=Count('id'))
+        self.assertEquals(list(grouped), [{'hashtags__text': 'superbowl', 'count': 2}])
@@ -0,0 +1,203 @@
+"""
+Keyword completions for the search box, answered without the database.
+
+The words of a dataset and their message counts (from the precalculated ``words``
+distribution) are saved in sorted order under ``settings.PRECALC_ROOT``. The words
+are a fixed-width array of UTF-8 bytes, so the completions of a prefix are the
+range found by binary search, and both arrays are memory-mapped when loaded,
+so every worker process shares the same pages. Rebuilt files are renamed into
+place (the metadata last), so workers never read a partly written array.
+
+.. code-block:: python
+
+    completions = Completions.load(dataset.id)
+    if completions is not None:
+        completions.complete("sup")
+        # [(u'super', 1520), (u'superbowl', 731), (u'support', 52)]
+        completions.complete_phrase("super b")
+        # [u'super bowl', u'super bowls', u'super big']
+
+Very short prefixes match most of the vocabulary, so their top words are saved
+with the rest. A phrase of several words completes its last word, ranked by how
+many messages contain it together with the earlier words
+(using the :class:`msgvis.apps.enhance.word_index.WordIndex` if it has been built).
+"""
+import os
+import json
+import logging
+
+from django.conf import settings
+
+from msgvis.apps.base.utils import save_atomically
+
+logger = logging.getLogger(__name__)
+
+_loaded = {}
+
+CACHED_PREFIX_LENGTH = 2
+"""The top words of prefixes up to this many characters are saved"""
+
+MAX_COMPLETIONS = 20
+
+PHRASE_CANDIDATES = 200
+"""How many of the most frequent completions of the last word are re-ranked by co-occurrence"""
+
+
+def split_phrase(q):
+    """
+    Split a phrase into the text kept before its completions (the earlier words
+    and a space, or nothing for a single word) and the last word to complete.
+    """
+    strings = q.split(' ')
+    prefix = " ".join(strings[:-1]) + " " if len(strings) > 1 else ""
+    return prefix, strings[-1]
+
+
+class Completions(object):
+    """The sorted words of one dataset with their counts"""
+
+    def __init__(self, dataset_id, words, counts, top):
+        self.dataset_id = dataset_id
+
+        self.words = words
+        """Sorted array of UTF-8 encoded, lower-cased words"""
+
+        self.counts = counts
+        """The number of messages containing each word"""
+
+        self.top = top
+        """Maps each short prefix to the positions of its most frequent words"""
+
+    def __len__(self):
+        return len(self.words)
+
+    @classmethod
+    def get_path(cls, dataset_id):
+        """The path of the completion files, without an extension"""
+        return os.path.join(settings.PRECALC_ROOT, 'dataset_%d' % dataset_id, 'completions')
+
+    @classmethod
+    def load(cls, dataset_id):
+        """Memory-map the saved completions, or return None if they have not been built."""
+        import numpy
+
+        path = cls.get_path(dataset_id)
+        if not all(os.path.exists(path + suffix) for suffix in ('.json', '_words.npy', '_counts.npy')):
+            return None
+
+        # reload if the files were rebuilt since we last looked
+        mtime = tuple(os.path.getmtime(path + suffix) for suffix in ('.json', '_words.npy', '_counts.npy'))
+        cached = _loaded.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with open(path + '.json', 'rb') as fp:
+            meta = json.load(fp)
+
+        words = numpy.load(path + '_words.npy', mmap_mode='r')
+        counts = numpy.load(path + '_counts.npy', mmap_mode='r')
+        if not len(words) == len(counts) == meta.get('num_words'):
+            # caught between the renames of a rebuild
+            return None
+        completions = cls(dataset_id, words, counts, meta['top'])
+        _loaded[path] = (mtime, completions)
+        return completions
+
+    @classmethod
+    def build(cls, dataset, levels):
+        """Save the completions for (word, count) pairs"""
+        import numpy
+
+        merged = {}
+        for level, count in levels:
+            if not level:
+                continue
+            word = level.lower().encode('utf-8')
+            merged[word] = merged.get(word, 0) + count
+
+        sorted_words = sorted(merged)
+        words = numpy.array(sorted_words, dtype='S%d' % max([len(w) for w in sorted_words] + [1]))
+        counts = numpy.array([merged[word] for word in sorted_words], dtype=numpy.int64)
+
+        completions = cls(dataset.id, words, counts, {})
+        top = {}
+        prefixes = set(word.decode('utf-8')[:length] for word in sorted_words
+                       for length in range(CACHED_PREFIX_LENGTH + 1))
+        for prefix in prefixes:
+            top[prefix] = completions._top_positions(prefix.encode('utf-8'), MAX_COMPLETIONS)
+
+        path = cls.get_path(dataset.id)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        save_atomically(path + '_words.npy', lambda fp: numpy.save(fp, words))
+        save_atomically(path + '_counts.npy', lambda fp: numpy.save(fp, counts))
+        save_atomically(path + '.json', lambda fp: json.dump({'top': top, 'num_words': len(words)}, fp))
+        _loaded.pop(path, None)
+
+        logger.info("Saved the completions of %d words for dataset %d" % (len(words), dataset.id))
+
+        return cls.load(dataset.id)
+
+    def _range(self, prefix):
+        """The positions [start, end) of the words starting with the encoded prefix"""
+        start = int(self.words.searchsorted(prefix, side='left'))
+        # no UTF-8 byte is \xff, so this sorts after every word with the prefix
+        end = int(self.words.searchsorted(prefix + '\xff', side='left'))
+        return start, end
+
+    def _top_positions(self, prefix, limit):
+        """The positions of the most frequent words starting with the encoded prefix"""
+        import numpy
+
+        start, end = self._range(prefix)
+        counts = numpy.asarray(self.counts[start:end])
+        if len(counts) > limit:
+            best = numpy.argpartition(-counts, limit - 1)[:limit]
+        else:
+            best = numpy.arange(len(counts))
+        # most frequent first, then alphabetical
+        best = sorted(best, key=lambda i: (-counts[i], i))
+        return [start + int(i) for i in best]
+
+    def complete(self, prefix, limit=MAX_COMPLETIONS):
+        """The most frequent words starting with the prefix, as (word, count) pairs"""
+        prefix = prefix.lower()
+        if len(prefix) <= CACHED_PREFIX_LENGTH and limit <= MAX_COMPLETIONS:
+            positions = self.top.get(prefix, [])[:limit]
+        else:
+            positions = self._top_positions(prefix.encode('utf-8'), limit)
+        return [(self.words[i].decode('utf-8'), int(self.counts[i])) for i in positions]
+
+    def complete_phrase(self, q, limit=MAX_COMPLETIONS):
+        """
+        Complete the last word of a phrase. If there are earlier words, the completions
+        found in the most messages together with them come first.
+        """
+        from msgvis.apps.enhance.word_index import WordIndex
+
+        prefix, last = split_phrase(q)
+        context = [word for word in prefix.split(' ') if word]
+
+        index = WordIndex.load(self.dataset_id) if context else None
+        if index is None:
+            return [prefix + word for word, count in self.complete(last, limit)]
+
+        import numpy
+
+        candidates = self.complete(last, PHRASE_CANDIDATES)
+        ids = None
+        for word in context:
+            word_ids = index.lookup(word)
+            if word_ids is None:
+                word_ids = numpy.array([], dtype=numpy.int64)
+            ids = word_ids if ids is None else numpy.intersect1d(ids, word_ids, assume_unique=True)
+
+        scored = []
+        for rank, (word, count) in enumerate(candidates):
+            together = 0
+            if len(ids) > 0:
+                together = len(numpy.intersect1d(ids, index.postings(word), assume_unique=True))
+            scored.append((-together, rank, word))
+        scored.sort()
+        return [prefix + word for together, rank, word in scored[:limit]]
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, make_option, CommandError
+from django.conf import settings
+from django.db import transaction
+
+class Command(BaseCommand):
+    help = "Draw a random sample of a dataset's messages for approximate data tables."
+    args = "<dataset id>"
+    option_list = BaseCommand.option_list + (
+        make_option('--rate',
+                    dest='rate',
+                    default=None,
+                    help='The fraction of messages to sample'),
+        make_option('--stratified',
+                    action='store_true',
+                    dest='stratified',
+                    default=False,
+                    help='Sample the same fraction of messages within each time bin'),
+        make_option('--bin-size',
+                    dest='bin_size',
+                    default=86400,
+                    help='The time bin size in seconds for stratified samples'),
+    )
+
+    def handle(self, dataset_id, *args, **options):
+        rate = options.get('rate') or settings.APPROXIMATE_SAMPLE_RATE
+
+        if not dataset_id:
+            raise CommandError("Dataset id is required.")
+        try:
+            dataset_id = int(dataset_id)
+        except ValueError:
+            raise CommandError("Dataset id must be a number.")
+
+        from msgvis.apps.enhance.tasks import build_message_sample
+
+        with transaction.atomic(savepoint=False):
+            sample = build_message_sample(dataset_id, rate=float(rate),
+                                          stratified=options.get('stratified'),
+                                          bin_size=int(options.get('bin_size')))
+
+        print "Sampled %.4f of the messages in dataset %d" % (sample.rate, dataset_id)
@@ -23,7 +23,7 @@ class Command(BaseCommand):
             if not path.path(f).exists():
                 raise CommandError("Filename %s does not exist" % f)
 
-        from msgvis.apps.enhance.tasks import import_from_tweet_parser_results
+        from msgvis.apps.enhance.tasks import import_from_tweet_parser_results, build_word_index
         start = time()
         for i, parsed_tweet_filename in enumerate(filenames):
             if len(filenames) > 1:
@@ -34,4 +34,8 @@ class Command(BaseCommand):
             with transaction.atomic(savepoint=False):
                 import_from_tweet_parser_results(dataset_id, parsed_tweet_filename)
 
+        print "Building the word index..."
+        index = build_word_index(dataset_id)
+        print "Indexed %d words" % len(index)
+
         print "Time: %.2fs" % (time() - start)
\ No newline at end of file
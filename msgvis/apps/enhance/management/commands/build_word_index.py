@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from time import time
+
+
+class Command(BaseCommand):
+    help = "Build the inverted word index used for keyword search and groups."
+    args = "<dataset id>"
+
+    def handle(self, dataset_id, *args, **options):
+
+        if not dataset_id:
+            raise CommandError("Dataset id is required.")
+        try:
+            dataset_id = int(dataset_id)
+        except ValueError:
+            raise CommandError("Dataset id must be a number.")
+
+        from msgvis.apps.enhance.tasks import build_word_index
+
+        start = time()
+        index = build_word_index(dataset_id)
+
+        print "Indexed %d words in dataset %d" % (len(index), dataset_id)
+        print "Time: %.2fs" % (time() - start)
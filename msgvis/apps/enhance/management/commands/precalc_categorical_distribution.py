@@ -1,10 +1,32 @@
 from django.core.management.base import BaseCommand, make_option, CommandError
+from django.conf import settings
 import sys
 from django.db import transaction
 
+from msgvis.apps.corpus.utils import dropping_temp_tables
+
 class Command(BaseCommand):
     help = "Extract topics for a dataset."
     args = "<dataset id> [categorical_dimensions...]"
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--pairs',
+                    default=None,
+                    dest='pairs',
+                    help='Comma-separated dimension pairs to precalculate, e.g. hashtags:type,sender:sentiment'
+        ),
+        make_option('-t', '--time-rollups',
+                    action='store_true',
+                    default=False,
+                    dest='time_rollups',
+                    help='Also precalculate the time rollups, cumulative time counts and distinct count sketches'
+        ),
+        make_option('-s', '--sketches',
+                    action='store_true',
+                    default=False,
+                    dest='sketches',
+                    help='Also rebuild the heavy-hitter sketches'
+        ),
+    )
 
     def handle(self, dataset_id, *dimensions, **options):
 
@@ -15,18 +37,61 @@ class Command(BaseCommand):
         except ValueError:
             raise CommandError("Dataset id must be a number.")
 
-        from msgvis.apps.enhance.tasks import precalc_categorical_dimension
+        from msgvis.apps.enhance.tasks import precalc_categorical_dimension, precalc_categorical_dimension_pair, \
+            precalc_time_rollups, precalc_time_prefix_sums, build_heavy_hitter_sketches, \
+            precalc_distinct_sketches
 
         categorical_dimensions = []
+        dimension_pairs = []
+        time_rollups = options.get('time_rollups')
+        sketches = options.get('sketches')
         if len(dimensions) == 0:
             categorical_dimensions = ["hashtags", "words", "urls", "timezone", "contains_media", "sentiment", "type", "sender", "mentions"]
+            dimension_pairs = getattr(settings, 'PRECALC_DIMENSION_PAIRS', ())
+            time_rollups = True
+            sketches = True
         else:
             categorical_dimensions = dimensions
+
+        if options.get('pairs'):
+            dimension_pairs = []
+            for pair in options.get('pairs').split(','):
+                keys = pair.split(':')
+                if len(keys) != 2:
+                    raise CommandError("Dimension pairs must look like primary:secondary.")
+                dimension_pairs.append(tuple(keys))
+
         #categorical_dimensions = ["hashtags", "urls", "timezone", "contains_media", "sentiment", "type", "sender", "mentions"]
         #categorical_dimensions = ["words"]
         for dimension_key in categorical_dimensions:
             print >>sys.stderr, "Precalculating %s..." %(dimension_key)
-            with transaction.atomic(savepoint=False):
+            with transaction.atomic(savepoint=False), dropping_temp_tables():
                 precalc_categorical_dimension(dataset_id=dataset_id, dimension_key=dimension_key)
 
+        for primary_dimension_key, secondary_dimension_key in dimension_pairs:
+            print >>sys.stderr, "Precalculating %s x %s..." %(primary_dimension_key, secondary_dimension_key)
+            with transaction.atomic(savepoint=False), dropping_temp_tables():
+                precalc_categorical_dimension_pair(dataset_id=dataset_id,
+                                                   primary_dimension_key=primary_dimension_key,
+                                                   secondary_dimension_key=secondary_dimension_key)
+
+        if time_rollups:
+            from msgvis.apps.dimensions.models import TIME_ROLLUP_DIMENSIONS
+            print >>sys.stderr, "Precalculating time rollups..."
+            with transaction.atomic(savepoint=False):
+                precalc_time_rollups(dataset_id=dataset_id, dimension_keys=TIME_ROLLUP_DIMENSIONS)
+
+            print >>sys.stderr, "Precalculating cumulative time counts..."
+            precalc_time_prefix_sums(dataset_id=dataset_id,
+                                     dimension_keys=getattr(settings, 'TIME_PREFIX_SUM_DIMENSIONS', ()))
 
+            print >>sys.stderr, "Precalculating distinct count sketches..."
+            with transaction.atomic(savepoint=False):
+                precalc_distinct_sketches(dataset_id=dataset_id,
+                                          measure_keys=getattr(settings, 'DISTINCT_SKETCH_MEASURES', ()))
+
+        if sketches:
+            print >>sys.stderr, "Building heavy-hitter sketches..."
+            with transaction.atomic(savepoint=False):
+                build_heavy_hitter_sketches(dataset_id=dataset_id,
+                                            dimension_keys=getattr(settings, 'HEAVY_HITTER_DIMENSIONS', ()))
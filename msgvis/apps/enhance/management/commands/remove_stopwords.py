@@ -43,6 +43,7 @@ queryset = corpus_models.Dataset.objects.get(id=1).message_set.all()
             queryset = enhance_models.TweetWord.objects.filter(text=stopword)
             print "stopword = %s, count = %d" %(stopword, queryset.count())
             queryset.delete()
+            enhance_models.Lemma.objects.filter(text=stopword).delete()
 
 
         pdb.set_trace()
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import msgvis.apps.base.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0021_dataset_has_prefetched_images'),
+        ('enhance', '0015_auto_20150906_0752'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrecalcCategoricalPairDistribution',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('primary_dimension_key', models.CharField(default=b'', max_length=64, blank=True)),
+                ('primary_level', msgvis.apps.base.models.Utf8CharField(default=b'', max_length=128, blank=True)),
+                ('primary_rank', models.IntegerField(default=0)),
+                ('secondary_dimension_key', models.CharField(default=b'', max_length=64, blank=True)),
+                ('secondary_level', msgvis.apps.base.models.Utf8CharField(default=b'', max_length=128, blank=True)),
+                ('secondary_rank', models.IntegerField(default=0)),
+                ('count', models.IntegerField()),
+                ('dataset', models.ForeignKey(related_name='pair_distributions', default=None, blank=True, to='corpus.Dataset', null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='precalccategoricalpairdistribution',
+            index_together=set([('dataset', 'primary_dimension_key', 'secondary_dimension_key')]),
+        ),
+    ]
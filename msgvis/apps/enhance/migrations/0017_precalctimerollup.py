@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import msgvis.apps.base.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0021_dataset_has_prefetched_images'),
+        ('enhance', '0016_precalccategoricalpairdistribution'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrecalcTimeRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('bin_size', models.IntegerField()),
+                ('time', models.DateTimeField()),
+                ('dimension_key', models.CharField(default=b'', max_length=64, blank=True)),
+                ('level', msgvis.apps.base.models.Utf8CharField(default=b'', max_length=128, blank=True)),
+                ('count', models.IntegerField()),
+                ('dataset', models.ForeignKey(related_name='time_rollups', default=None, blank=True, to='corpus.Dataset', null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='precalctimerollup',
+            index_together=set([('dataset', 'bin_size', 'dimension_key', 'time')]),
+        ),
+    ]
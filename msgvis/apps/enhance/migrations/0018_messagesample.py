@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0021_dataset_has_prefetched_images'),
+        ('enhance', '0017_precalctimerollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSample',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('rate', models.FloatField()),
+                ('stratified', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('dataset', models.ForeignKey(related_name='samples', to='corpus.Dataset')),
+                ('messages', models.ManyToManyField(related_name='samples', to='corpus.Message')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
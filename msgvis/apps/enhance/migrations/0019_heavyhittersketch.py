@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0021_dataset_has_prefetched_images'),
+        ('enhance', '0018_messagesample'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HeavyHitterSketch',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('dimension_key', models.CharField(max_length=64)),
+                ('data', models.TextField(default=b'')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('dataset', models.ForeignKey(related_name='sketches', to='corpus.Dataset')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='heavyhittersketch',
+            unique_together=set([('dataset', 'dimension_key')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0021_dataset_has_prefetched_images'),
+        ('enhance', '0019_heavyhittersketch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrecalcTimeDistinctSketch',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('measure_key', models.CharField(max_length=64)),
+                ('bin_size', models.IntegerField()),
+                ('time', models.DateTimeField()),
+                ('registers', models.TextField()),
+                ('dataset', models.ForeignKey(related_name='distinct_sketches', to='corpus.Dataset')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='precalctimedistinctsketch',
+            index_together=set([('dataset', 'measure_key', 'time')]),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import msgvis.apps.base.models
+
+
+def rebuild_lemmas(apps, schema_editor):
+    from msgvis.apps.enhance.models import rebuild_lemmas
+    rebuild_lemmas(schema_editor.connection, apps.get_model('enhance', 'Lemma'), apps.get_model('enhance', 'TweetWord'))
+
+
+def noop(apps, schema_editor):
+    # the lemma table is dropped when unapplying, so there is nothing to undo
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0023_message_sender_counters'),
+        ('enhance', '0020_precalctimedistinctsketch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Lemma',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('text', msgvis.apps.base.models.Utf8CharField(max_length=100, db_index=True)),
+                ('dataset', models.ForeignKey(related_name='lemmas', to='corpus.Dataset')),
+                ('messages', models.ManyToManyField(related_name='lemmas', to='corpus.Message')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='lemma',
+            unique_together=set([('dataset', 'text')]),
+        ),
+        migrations.AddField(
+            model_name='tweetword',
+            name='lemma',
+            field=models.ForeignKey(related_name='spellings', default=None, blank=True, to='enhance.Lemma', null=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(rebuild_lemmas, reverse_code=noop),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('enhance', '0021_lemma'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagesample',
+            name='bin_size',
+            field=models.IntegerField(default=None, null=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='messagesample',
+            name='requested_rate',
+            field=models.FloatField(default=None, null=True),
+            preserve_default=True,
+        ),
+    ]
@@ -1,6 +1,7 @@
 from django.db import models
 from django.conf import settings
 import textblob
+import json
 
 from fields import PositiveBigIntegerField
 from msgvis.apps.corpus.models import Message, Dataset
@@ -410,11 +411,76 @@ def set_message_sentiment(message, save=True):
     if save:
         message.save()
 
+class Lemma(models.Model):
+    """
+    A normalized word in a dataset, shared by all of its spellings (:class:`TweetWord`),
+    with a direct link to the messages that contain it.
+    """
+    dataset = models.ForeignKey(Dataset, related_name="lemmas")
+    text = base_models.Utf8CharField(max_length=100, db_index=True)
+    messages = models.ManyToManyField(Message, related_name='lemmas')
+
+    class Meta:
+        unique_together = ('dataset', 'text')
+
+    def __repr__(self):
+        return self.text
+
+    def __unicode__(self):
+        return self.__repr__()
+
+    @classmethod
+    def rebuild(cls, connection, dataset_id=None):
+        """
+        Create the lemmas of the existing words and link them to the messages
+        of all of their spellings, e.g. for words loaded before there were lemmas.
+        """
+        rebuild_lemmas(connection, cls, TweetWord, dataset_id)
+
+
+def rebuild_lemmas(connection, lemma_model, word_model, dataset_id=None):
+    """
+    The queries of :meth:`Lemma.rebuild`, given the models so that migrations
+    can run them with their historical models.
+    """
+    qn = connection.ops.quote_name
+    names = {
+        'lemmas': qn(lemma_model._meta.db_table),
+        'words': qn(word_model._meta.db_table),
+        'links': qn(lemma_model.messages.through._meta.db_table),
+        'word_links': qn(word_model.messages.through._meta.db_table),
+        'condition': "IS NOT NULL",
+    }
+    for column in ('id', 'dataset_id', 'text', 'lemma_id', 'message_id', 'tweetword_id'):
+        names[column] = qn(column)
+
+    params = []
+    if dataset_id is not None:
+        names['condition'] = "= %s"
+        params = [dataset_id]
+
+    cursor = connection.cursor()
+    cursor.execute(("INSERT INTO %(lemmas)s (%(dataset_id)s, %(text)s) "
+                    "SELECT DISTINCT W.%(dataset_id)s, W.%(text)s FROM %(words)s AS W "
+                    "WHERE W.%(dataset_id)s %(condition)s AND NOT EXISTS (SELECT 1 FROM %(lemmas)s AS L "
+                    "WHERE L.%(dataset_id)s = W.%(dataset_id)s AND L.%(text)s = W.%(text)s)") % names, params)
+    cursor.execute(("UPDATE %(words)s SET %(lemma_id)s = (SELECT L.%(id)s FROM %(lemmas)s AS L "
+                    "WHERE L.%(dataset_id)s = %(words)s.%(dataset_id)s AND L.%(text)s = %(words)s.%(text)s) "
+                    "WHERE %(dataset_id)s %(condition)s") % names, params)
+    cursor.execute(("INSERT INTO %(links)s (%(lemma_id)s, %(message_id)s) "
+                    "SELECT DISTINCT W.%(lemma_id)s, WM.%(message_id)s FROM %(word_links)s AS WM, %(words)s AS W "
+                    "WHERE WM.%(tweetword_id)s = W.%(id)s AND W.%(dataset_id)s %(condition)s AND NOT EXISTS ("
+                    "SELECT 1 FROM %(links)s AS LM "
+                    "WHERE LM.%(lemma_id)s = W.%(lemma_id)s AND LM.%(message_id)s = WM.%(message_id)s)") % names,
+                   params)
+
+
 class TweetWord(models.Model):
     dataset = models.ForeignKey(Dataset, related_name="tweet_words", null=True, blank=True, default=None)
     original_text = base_models.Utf8CharField(max_length=100, db_index=True, blank=True, default="")
     pos = models.CharField(max_length=4, null=True, blank=True, default="")
     text = base_models.Utf8CharField(max_length=100, db_index=True, blank=True, default="")
+    lemma = models.ForeignKey(Lemma, related_name="spellings", null=True, blank=True, default=None)
     messages = models.ManyToManyField(Message, related_name='tweet_words')
 
     def __repr__(self):
@@ -429,9 +495,7 @@ class TweetWord(models.Model):
 
     @property
     def all_messages(self):
-        queryset = self.dataset.message_set.all()
-        queryset = queryset.filter(utils.levels_or("tweet_words__id", map(lambda x: x.id, self.related_words)))
-        return queryset
+        return self.dataset.message_set.filter(lemmas=self.lemma_id)
 
 
 
@@ -444,4 +508,212 @@ class PrecalcCategoricalDistribution(models.Model):
     class Meta:
         index_together = [
             ["dimension_key", "level"],
-        ]
\ No newline at end of file
+        ]
+
+class PrecalcCategoricalPairDistribution(models.Model):
+    """
+    A precalculated two-dimensional distribution over a pair of categorical
+    dimensions, limited to the top levels of each dimension plus an 'Other' level.
+
+    The ranks record the position of each level in its dimension's domain.
+    """
+    dataset = models.ForeignKey(Dataset, related_name="pair_distributions", null=True, blank=True, default=None)
+    primary_dimension_key = models.CharField(max_length=64, blank=True, default="")
+    primary_level = base_models.Utf8CharField(max_length=128, blank=True, default="")
+    primary_rank = models.IntegerField(default=0)
+    secondary_dimension_key = models.CharField(max_length=64, blank=True, default="")
+    secondary_level = base_models.Utf8CharField(max_length=128, blank=True, default="")
+    secondary_rank = models.IntegerField(default=0)
+    count = models.IntegerField()
+
+    class Meta:
+        index_together = [
+            ["dataset", "primary_dimension_key", "secondary_dimension_key"],
+        ]
+
+
+class PrecalcTimeRollup(models.Model):
+    """
+    Precalculated message counts per time bin, at one of the
+    :class:`msgvis.apps.dimensions.models.TimeDimension` bin sizes.
+
+    Rows with an empty dimension_key count all messages in the bin.
+    Otherwise the counts are split by the levels of that dimension.
+    """
+    dataset = models.ForeignKey(Dataset, related_name="time_rollups", null=True, blank=True, default=None)
+    bin_size = models.IntegerField()
+    """The bin size in seconds"""
+
+    time = models.DateTimeField()
+    """The start of the bin"""
+
+    dimension_key = models.CharField(max_length=64, blank=True, default="")
+    level = base_models.Utf8CharField(max_length=128, blank=True, default="")
+    count = models.IntegerField()
+
+    class Meta:
+        index_together = [
+            ["dataset", "bin_size", "dimension_key", "time"],
+        ]
+
+
+class PrecalcTimeDistinctSketch(models.Model):
+    """
+    A precalculated :class:`msgvis.apps.enhance.sketches.HyperLogLog` of the values
+    counted by an approximate distinct count measure in one time bin.
+    The sketches of fine bins are merged to answer coarser bins.
+    """
+    dataset = models.ForeignKey(Dataset, related_name="distinct_sketches")
+    measure_key = models.CharField(max_length=64)
+    bin_size = models.IntegerField()
+    """The bin size in seconds"""
+
+    time = models.DateTimeField()
+    """The start of the bin"""
+
+    registers = models.TextField()
+    """The base64-encoded sketch registers"""
+
+    class Meta:
+        index_together = [
+            ["dataset", "measure_key", "time"],
+        ]
+
+    def get_sketch(self):
+        from msgvis.apps.enhance.sketches import HyperLogLog
+        return HyperLogLog.from_string(self.registers)
+
+
+class HeavyHitterSketch(models.Model):
+    """
+    A :class:`msgvis.apps.enhance.sketches.SpaceSaving` sketch of the most frequent
+    levels of a high-cardinality dimension in a dataset, saved as json.
+    """
+    dataset = models.ForeignKey(Dataset, related_name="sketches")
+    dimension_key = models.CharField(max_length=64)
+    data = models.TextField(default="")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('dataset', 'dimension_key')
+
+    def get_sketch(self):
+        from msgvis.apps.enhance.sketches import SpaceSaving
+        if not self.data:
+            return SpaceSaving(settings.HEAVY_HITTER_CAPACITY)
+        return SpaceSaving.from_dict(json.loads(self.data))
+
+    def set_sketch(self, sketch):
+        self.data = json.dumps(sketch.to_dict())
+
+    @classmethod
+    def get_for_dataset(cls, dataset, dimension_key):
+        """Get the saved sketch for the dimension, or None"""
+        try:
+            return cls.objects.get(dataset=dataset, dimension_key=dimension_key).get_sketch()
+        except cls.DoesNotExist:
+            return None
+
+    @classmethod
+    def count_messages(cls, messages, sketches):
+        """
+        Count the levels of the messages in each sketch.
+        sketches is a dictionary from dimension keys to sketches.
+        """
+        from msgvis.apps.dimensions import registry
+
+        for dimension_key, sketch in sketches.iteritems():
+            dimension = registry.get_dimension(dimension_key)
+            # messages without any level are counted under None, like in get_domain
+            levels = messages.values_list(dimension.field_name, flat=True)
+            sketch.update_all(levels.iterator())
+
+    @classmethod
+    def save_counts(cls, dataset, sketches, replace=False):
+        """Add the counts in each sketch to the dataset's saved sketches, or replace them."""
+        for dimension_key, sketch in sketches.iteritems():
+            saved, created = cls.objects.get_or_create(dataset=dataset, dimension_key=dimension_key)
+            if not created and not replace:
+                merged = saved.get_sketch()
+                merged.merge(sketch)
+                sketch = merged
+            saved.set_sketch(sketch)
+            saved.save()
+
+
+class MessageSample(models.Model):
+    """
+    A persisted random sample of the messages in a dataset,
+    used to approximate data tables on very large datasets.
+    """
+    dataset = models.ForeignKey(Dataset, related_name="samples")
+
+    rate = models.FloatField()
+    """The fraction of the dataset's messages that are in the sample"""
+
+    requested_rate = models.FloatField(default=None, null=True)
+    """The rate the sample was drawn at, which it is drawn at again after imports"""
+
+    stratified = models.BooleanField(default=False)
+    """True if the sample was drawn separately within each time bin"""
+
+    bin_size = models.IntegerField(default=None, null=True)
+    """The length in seconds of the time bins of a stratified sample"""
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    messages = models.ManyToManyField(Message, related_name="samples")
+
+    @classmethod
+    def get_for_dataset(cls, dataset, rate=None):
+        """Get the sample of the dataset whose rate is closest to the given rate, or None"""
+        if rate is None:
+            rate = settings.APPROXIMATE_SAMPLE_RATE
+
+        samples = list(cls.objects.filter(dataset=dataset).order_by('-created_at'))
+        if len(samples) == 0:
+            return None
+        return min(samples, key=lambda x: abs(x.rate - rate))
+
+    @classmethod
+    def draw(cls, dataset, queryset, rate, stratified=False, bin_size=None):
+        """
+        Draw and save a sample of the messages in the queryset.
+        A stratified sample takes the same fraction of the messages in every time bin of bin_size seconds,
+        rounded up or down at random so that each message is taken with probability rate.
+        """
+        import random
+        import math
+        from django.utils import dateformat
+
+        if stratified:
+            strata = {}
+            for message_id, time in queryset.values_list('id', 'time').iterator():
+                key = long(dateformat.format(time, 'U')) // bin_size if time is not None else None
+                strata.setdefault(key, []).append(message_id)
+
+            message_ids = []
+            for ids in strata.itervalues():
+                share = rate * len(ids)
+                count = int(math.floor(share))
+                if random.random() < share - count:
+                    count += 1
+                message_ids.extend(random.sample(ids, count))
+        else:
+            message_ids = [message_id for message_id in queryset.values_list('id', flat=True).iterator()
+                           if random.random() < rate]
+
+        total_count = queryset.count()
+        sample = cls.objects.create(dataset=dataset,
+                                    rate=float(len(message_ids)) / total_count if total_count else rate,
+                                    requested_rate=rate,
+                                    stratified=stratified,
+                                    bin_size=bin_size if stratified else None)
+
+        logger.info("Saving a sample of %d / %d messages" % (len(message_ids), total_count))
+
+        through = cls.messages.through
+        batch = [through(messagesample_id=sample.id, message_id=message_id) for message_id in message_ids]
+        through.objects.bulk_create(batch, batch_size=10000)
+
+        return sample
@@ -0,0 +1,207 @@
+"""
+Cumulative message counts over fine time bins, for answering
+"how many messages of each level between t0 and t1" without touching the database.
+
+For every level of a low-cardinality categorical dimension we keep a row of
+cumulative counts, so the number of messages in a range of bins is the
+difference of two entries. The arrays are saved as ``.npy`` files under
+``settings.PRECALC_ROOT`` and memory-mapped when loaded, so every worker
+process shares the same pages. Rebuilt files are renamed into place (the metadata
+last), so workers never read a partly written array.
+
+.. code-block:: python
+
+    sums = TimePrefixSums.load(dataset.id, 'type')
+    if sums is not None and sums.is_exact(min_time, max_time):
+        sums.distribution(min_time, max_time)
+        # [('tweet', 523), ('retweet', 311), ('reply', 12)]
+"""
+import os
+import glob
+import json
+import math
+import logging
+
+from django.conf import settings
+from django.db.models import Count, Min, Max
+from django.utils import dateformat, dateparse, timezone
+
+from msgvis.apps.base.utils import save_atomically
+
+logger = logging.getLogger(__name__)
+
+TIME_PREFIX_SUM_MAX_BINS = getattr(settings, 'TIME_PREFIX_SUM_MAX_BINS', 2 ** 18)
+
+_loaded = {}
+
+
+def _timestamp(value):
+    """Seconds since the epoch, including any fraction"""
+    return long(dateformat.format(value, 'U')) + value.microsecond / 1e6
+
+
+def _time_value_timestamp(time):
+    """The timestamp of a time read from the database, which sqlite returns as a string"""
+    if isinstance(time, basestring):
+        time = dateparse.parse_datetime(time)
+    if timezone.is_naive(time):
+        time = timezone.make_aware(time, timezone.utc)
+    return _timestamp(time)
+
+
+class TimePrefixSums(object):
+    """Cumulative counts for each level of one dimension in one dataset"""
+
+    def __init__(self, dataset_id, dimension_key, origin, bin_size, levels, counts):
+        self.dataset_id = dataset_id
+        self.dimension_key = dimension_key
+
+        self.origin = origin
+        """The timestamp at the left edge of the first bin"""
+
+        self.bin_size = bin_size
+        """The bin size in seconds"""
+
+        self.levels = levels
+        """The dimension levels, most frequent first"""
+
+        self.counts = counts
+        """A (levels x bins + 1) array. counts[i, j] is the number of messages with level i in the first j bins."""
+
+    @property
+    def num_bins(self):
+        return self.counts.shape[1] - 1
+
+    @classmethod
+    def get_path(cls, dataset_id, dimension_key):
+        """The path of the array file, without an extension"""
+        return os.path.join(settings.PRECALC_ROOT, 'dataset_%d' % dataset_id, 'time_counts_%s' % dimension_key)
+
+    @classmethod
+    def load(cls, dataset_id, dimension_key):
+        """Memory-map the saved counts, or return None if they have not been built."""
+        import numpy
+
+        path = cls.get_path(dataset_id, dimension_key)
+        if not os.path.exists(path + '.npy') or not os.path.exists(path + '.json'):
+            return None
+
+        # reload if the files were rebuilt since we last looked
+        mtime = (os.path.getmtime(path + '.npy'), os.path.getmtime(path + '.json'))
+        cached = _loaded.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with open(path + '.json', 'rb') as fp:
+            meta = json.load(fp)
+
+        counts = numpy.load(path + '.npy', mmap_mode='r')
+        if list(counts.shape) != meta.get('shape'):
+            # caught between the renames of a rebuild
+            return None
+        prefix_sums = cls(dataset_id, dimension_key, meta['origin'], meta['bin_size'], meta['levels'], counts)
+        _loaded[path] = (mtime, prefix_sums)
+        return prefix_sums
+
+    @classmethod
+    def build(cls, dataset, dimension, queryset, bin_sizes):
+        """
+        Count the messages in the queryset for each level of the dimension
+        and save the cumulative counts for the dataset.
+
+        The bin size is the smallest of the given bin sizes (in seconds)
+        that needs no more than ``TIME_PREFIX_SUM_MAX_BINS`` bins.
+        """
+        import numpy
+
+        # size the bins from the time range of the messages
+        time_range = queryset.aggregate(min_time=Min('time'), max_time=Max('time'))
+        if time_range['min_time'] is not None:
+            min_ts = _time_value_timestamp(time_range['min_time'])
+            max_ts = _time_value_timestamp(time_range['max_time'])
+        else:
+            min_ts = max_ts = 0
+
+        for bin_size in bin_sizes:
+            if (max_ts - min_ts) / bin_size < TIME_PREFIX_SUM_MAX_BINS:
+                break
+
+        # line the bins up with the time dimension's bins
+        origin = long(bin_size * math.floor(min_ts / bin_size))
+        num_bins = int((max_ts - origin) // bin_size) + 1
+
+        if hasattr(dimension, 'domain'):
+            levels = list(dimension.domain)
+        else:
+            totals = queryset.values(dimension.field_name).annotate(count=Count('id')).order_by('-count')
+            levels = [row[dimension.field_name] for row in totals]
+
+        level_index = dict((level, i) for i, level in enumerate(levels))
+        counts = numpy.zeros((len(levels), num_bins + 1), dtype=numpy.int64)
+        rows = queryset.values('time', dimension.field_name).annotate(count=Count('id'))
+        for row in rows.iterator():
+            i = level_index.get(row[dimension.field_name])
+            if i is not None:
+                counts[i, int((_time_value_timestamp(row['time']) - origin) // bin_size) + 1] += row['count']
+        counts = numpy.cumsum(counts, axis=1)
+
+        path = cls.get_path(dataset.id, dimension.key)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        save_atomically(path + '.npy', lambda fp: numpy.save(fp, counts))
+        save_atomically(path + '.json', lambda fp: json.dump({
+            'origin': origin,
+            'bin_size': bin_size,
+            'levels': levels,
+            'shape': list(counts.shape),
+        }, fp))
+        _loaded.pop(path, None)
+
+        logger.info("Saved %d x %d time counts for %s" % (len(levels), num_bins, dimension.key))
+
+        return cls(dataset.id, dimension.key, origin, bin_size, levels, counts)
+
+    @classmethod
+    def built_dimension_keys(cls, dataset_id):
+        """The keys of the dimensions whose counts have been saved for the dataset"""
+        pattern = cls.get_path(dataset_id, '*') + '.npy'
+        prefix = len(cls.get_path(dataset_id, ''))
+        return sorted(path[prefix:-len('.npy')] for path in glob.glob(pattern))
+
+    def is_exact(self, min_time=None, max_time=None):
+        """
+        True if the counts between min_time and max_time (inclusive) are exact.
+        With bins larger than a second, the limits must fall on bin edges.
+        """
+        if self.bin_size <= 1:
+            return True
+        if min_time is not None and (_timestamp(min_time) - self.origin) % self.bin_size != 0:
+            return False
+        if max_time is not None and (_timestamp(max_time) + 1 - self.origin) % self.bin_size != 0:
+            return False
+        return True
+
+    def _bin_range(self, min_time=None, max_time=None):
+        """The first bin and one past the last bin inside the time range"""
+        start = 0
+        end = self.num_bins
+        if min_time is not None:
+            start = int(math.ceil((_timestamp(min_time) - self.origin) / self.bin_size))
+        if max_time is not None:
+            end = int(math.floor((_timestamp(max_time) - self.origin) / self.bin_size)) + 1
+        start = min(max(start, 0), self.num_bins)
+        end = min(max(end, start), self.num_bins)
+        return start, end
+
+    def count(self, level, min_time=None, max_time=None):
+        """The number of messages with the level between min_time and max_time (inclusive)"""
+        start, end = self._bin_range(min_time, max_time)
+        i = self.levels.index(level)
+        return int(self.counts[i, end] - self.counts[i, start])
+
+    def distribution(self, min_time=None, max_time=None):
+        """A list of (level, count) for every level, in the order of the levels"""
+        start, end = self._bin_range(min_time, max_time)
+        totals = self.counts[:, end] - self.counts[:, start]
+        return [(level, int(totals[i])) for i, level in enumerate(self.levels)]
@@ -0,0 +1,230 @@
+"""
+Streaming sketches that summarize large numbers of messages in a small,
+mergeable amount of memory.
+
+Heavy hitters
+-------------
+
+:class:`SpaceSaving` finds the most frequent levels of a
+high-cardinality dimension (words, hashtags, senders, ...) without grouping
+and sorting every level in the database.
+
+:class:`SpaceSaving` keeps at most ``capacity`` counters. A level that is
+not being counted replaces the smallest counter and inherits its count as
+an over-estimate, so every counter is an upper bound on the true count
+and ``count - error`` is a lower bound. Any level that occurs more than
+``total / capacity`` times is guaranteed to have a counter.
+
+.. code-block:: python
+
+    sketch = SpaceSaving(capacity=1000)
+    for hashtag in hashtags:
+        sketch.update(hashtag)
+
+    sketch.top(3)
+    # [(u'superbowl', 5231, 0), (u'nfl', 3120, 0), (u'ads', 817, 12)]
+
+Distinct counts
+---------------
+
+:class:`HyperLogLog` estimates the number of distinct values (e.g. senders)
+with a few thousand one-byte registers. The relative error is about
+``1.04 / sqrt(2 ** precision)``. Sketches of different sets of messages, such
+as consecutive time bins, can be merged to estimate the distinct count of the union.
+
+.. code-block:: python
+
+    senders = HyperLogLog()
+    for sender_id in sender_ids:
+        senders.add(sender_id)
+
+    senders.cardinality()
+    # 10214
+"""
+import heapq
+import hashlib
+import base64
+import math
+
+
+class SpaceSaving(object):
+    """The SpaceSaving algorithm of Metwally, Agrawal and El Abbadi"""
+
+    def __init__(self, capacity, total=0, counters=None):
+        self.capacity = capacity
+
+        self.total = total
+        """The number of items that have been counted"""
+
+        self.counters = counters if counters is not None else {}
+        """Maps levels to [count, error]. count is an upper bound and count - error a lower bound."""
+
+        self._heap = None
+        """
+        A min-heap with one (count, level) entry per counter. Counts only grow, so an entry
+        may be lower than its counter; stale entries are refreshed when they reach the top.
+        """
+
+    def __len__(self):
+        return len(self.counters)
+
+    def update(self, level, count=1):
+        """Count one or more occurrences of a level"""
+        self.total += count
+
+        counter = self.counters.get(level)
+        if counter is not None:
+            counter[0] += count
+        elif len(self.counters) < self.capacity:
+            self.counters[level] = [count, 0]
+            if self._heap is not None:
+                heapq.heappush(self._heap, (count, level))
+        else:
+            # evict the smallest counter; the new level may have been counted before
+            floor = self._pop_smallest()
+            self.counters[level] = [floor + count, floor]
+            heapq.heappush(self._heap, (floor + count, level))
+
+    def _pop_smallest(self):
+        """Remove the smallest counter and return its count, in O(log capacity) amortized time"""
+        if self._heap is None:
+            self._heap = [(c[0], level) for level, c in self.counters.iteritems()]
+            heapq.heapify(self._heap)
+
+        while True:
+            count, level = self._heap[0]
+            current = self.counters[level][0]
+            if current == count:
+                heapq.heappop(self._heap)
+                del self.counters[level]
+                return count
+            # counted since the entry was pushed
+            heapq.heapreplace(self._heap, (current, level))
+
+    def update_all(self, levels):
+        """Count a sequence of levels"""
+        for level in levels:
+            self.update(level)
+
+    def merge(self, other):
+        """
+        Add the counts from another sketch, keeping the largest counters.
+        Levels missing from a full sketch could have been counted up to its smallest counter.
+        """
+        def floor(sketch):
+            if len(sketch.counters) < sketch.capacity:
+                return 0
+            return min(c[0] for c in sketch.counters.itervalues())
+
+        self_floor = floor(self)
+        other_floor = floor(other)
+
+        merged = {}
+        for level in set(self.counters) | set(other.counters):
+            count_a, error_a = self.counters.get(level, (self_floor, self_floor))
+            count_b, error_b = other.counters.get(level, (other_floor, other_floor))
+            merged[level] = [count_a + count_b, error_a + error_b]
+
+        largest = heapq.nlargest(self.capacity, merged.iteritems(), key=lambda x: x[1][0])
+        self.counters = dict(largest)
+        self._heap = None
+        self.total += other.total
+
+    def top(self, k=None):
+        """The k largest counters as a list of (level, count, error), largest first"""
+        rows = sorted(((level, c[0], c[1]) for level, c in self.counters.iteritems()),
+                      key=lambda x: x[1], reverse=True)
+        if k is not None:
+            rows = rows[:k]
+        return rows
+
+    def candidates(self, k):
+        """
+        The levels that could be among the true top k: every level whose
+        upper bound reaches the k-th largest lower bound.
+        """
+        if len(self.counters) <= k:
+            return [row[0] for row in self.top()]
+
+        kth_lower_bound = heapq.nlargest(k, (c[0] - c[1] for c in self.counters.itervalues()))[-1]
+        return [row[0] for row in self.top() if row[1] >= kth_lower_bound]
+
+    def to_dict(self):
+        return {
+            'capacity': self.capacity,
+            'total': self.total,
+            'counters': [[level, c[0], c[1]] for level, c in self.counters.iteritems()],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        counters = dict((row[0], [row[1], row[2]]) for row in data['counters'])
+        return cls(data['capacity'], total=data['total'], counters=counters)
+
+
+class HyperLogLog(object):
+    """The HyperLogLog distinct counter of Flajolet et al."""
+
+    def __init__(self, precision=11, registers=None):
+        self.precision = precision
+        self.num_registers = 1 << precision
+
+        self.registers = registers if registers is not None else bytearray(self.num_registers)
+        """The longest run of leading zeros seen in each bucket, plus one"""
+
+    def add(self, value):
+        """Count a value. Values are compared by their unicode representation."""
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        else:
+            value = str(value)
+
+        # the first bits choose the register, the rest give the rank
+        hashed = long(hashlib.sha1(value).hexdigest()[:16], 16)
+        index = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update_all(self, values):
+        """Count a sequence of values"""
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        """Add all of the values counted by another sketch with the same precision"""
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLogs with different precisions.")
+
+        for i, rank in enumerate(other.registers):
+            if rank > self.registers[i]:
+                self.registers[i] = rank
+
+    def cardinality(self):
+        """Estimate the number of distinct values"""
+        m = self.num_registers
+        alpha = 0.7213 / (1 + 1.079 / m)
+
+        zeros = 0
+        harmonic_sum = 0.0
+        for rank in self.registers:
+            if rank == 0:
+                zeros += 1
+            harmonic_sum += 2.0 ** -rank
+
+        estimate = alpha * m * m / harmonic_sum
+        if estimate <= 2.5 * m and zeros > 0:
+            # linear counting is more accurate for small sets
+            estimate = m * math.log(float(m) / zeros)
+
+        return int(round(estimate))
+
+    def to_string(self):
+        return base64.b64encode(str(self.registers))
+
+    @classmethod
+    def from_string(cls, data):
+        registers = bytearray(base64.b64decode(data))
+        return cls(len(registers).bit_length() - 1, registers=registers)
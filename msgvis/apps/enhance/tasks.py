@@ -1,15 +1,23 @@
 import logging
 
-from models import Dictionary, MessageWord, Word, MessageTopic, TweetWord, PrecalcCategoricalDistribution
+from models import Dictionary, MessageWord, Word, MessageTopic, TweetWord, Lemma, PrecalcCategoricalDistribution, \
+    PrecalcCategoricalPairDistribution, PrecalcTimeRollup, MessageSample, \
+    HeavyHitterSketch, PrecalcTimeDistinctSketch
+from sketches import SpaceSaving
 from msgvis.apps.corpus.models import Dataset, Message
 from msgvis.apps.dimensions import registry
 from msgvis.apps.datatable import models as datatable_models
+from msgvis.apps.datatable import measures
+from msgvis.apps.groups.models import Group
 import codecs
 import re
 from time import time
 import subprocess
 import os
 import glob
+from django.db.models import Count
+from django.utils import dateparse, timezone
+from django.conf import settings
 from nltk.stem import WordNetLemmatizer
 
 logger = logging.getLogger(__name__)
@@ -280,7 +288,9 @@ def import_from_tweet_parser_results(dataset_id, filename):
     current_msg_id = -1
     current_msg = None
     word_list = []
+    lemmas = {}
     count = 0
+    word_sketch = SpaceSaving(settings.HEAVY_HITTER_CAPACITY)
     with codecs.open(filename, encoding='utf-8', mode='r') as f:
         print "Reading file %s" % filename
 
@@ -290,6 +300,8 @@ def import_from_tweet_parser_results(dataset_id, filename):
                 # save the previous word list
                 if len(word_list) > 0:
                     current_msg.tweet_words.add(*word_list)
+                    current_msg.lemmas.add(*set(word.lemma_id for word in word_list))
+                    word_sketch.update_all(set(word.text for word in word_list))
                     word_list = []
                     count += 1
                     if count % 1000 == 0:
@@ -313,13 +325,28 @@ def import_from_tweet_parser_results(dataset_id, filename):
                 if re.search('[,~U]', pos):
                     continue
                 else:
-                    word_obj, created = TweetWord.objects.get_or_create(dataset_id=dataset_id, original_text=original_text, pos=pos, text=text)
+                    lemma = lemmas.get(text)
+                    if lemma is None:
+                        lemma, created = Lemma.objects.get_or_create(dataset_id=dataset_id, text=text)
+                        lemmas[text] = lemma
+                    word_obj, created = TweetWord.objects.get_or_create(dataset_id=dataset_id, original_text=original_text,
+                                                                        pos=pos, text=text, defaults={'lemma': lemma})
+                    if word_obj.lemma_id is None:
+                        word_obj.lemma = lemma
+                        word_obj.save()
                     word_list.append(word_obj)
         # save the previous word list
         if len(word_list) > 0:
             current_msg.tweet_words.add(*word_list)
+            current_msg.lemmas.add(*set(word.lemma_id for word in word_list))
+            word_sketch.update_all(set(word.text for word in word_list))
             word_list = []
         print "Processed %d messages" % count
+
+        HeavyHitterSketch.save_counts(Dataset.objects.get(id=dataset_id), {'words': word_sketch})
+
+        # keyword groups match the new words
+        Group.invalidate_message_counts(dataset_id)
         print "Time: %.2fs" % (time() - start)
 
 def precalc_categorical_dimension(dataset_id=1, dimension_key=None):
@@ -341,6 +368,203 @@ def precalc_categorical_dimension(dataset_id=1, dimension_key=None):
 
     PrecalcCategoricalDistribution.objects.bulk_create(objs=bulk, batch_size=10000)
 
+    if dimension_key == 'words':
+        build_completions(dataset_id)
+
+
+def precalc_categorical_dimension_pair(dataset_id=1, primary_dimension_key=None, secondary_dimension_key=None):
+    datatable = datatable_models.DataTable(primary_dimension=primary_dimension_key,
+                                           secondary_dimension=secondary_dimension_key)
+    datatable.set_mode("enable_others")
+    dataset = Dataset.objects.get(id=dataset_id)
+
+    # remove existing calculation
+    PrecalcCategoricalPairDistribution.objects.filter(dataset=dataset,
+                                                      primary_dimension_key=primary_dimension_key,
+                                                      secondary_dimension_key=secondary_dimension_key).delete()
+
+    result = datatable.generate(dataset)
+
+    # the rank of a level is its position in the domain (the others level comes last)
+    primary_ranks = dict((level, rank) for rank, level in enumerate(result["domains"][primary_dimension_key]))
+    secondary_ranks = dict((level, rank) for rank, level in enumerate(result["domains"][secondary_dimension_key]))
+
+    bulk = []
+    for bucket in result["table"]:
+        primary_level = bucket[primary_dimension_key]
+        secondary_level = bucket[secondary_dimension_key]
+        obj = PrecalcCategoricalPairDistribution(dataset=dataset,
+                                                 primary_dimension_key=primary_dimension_key,
+                                                 primary_level=primary_level if primary_level is not None else "",
+                                                 primary_rank=primary_ranks.get(primary_level, len(primary_ranks)),
+                                                 secondary_dimension_key=secondary_dimension_key,
+                                                 secondary_level=secondary_level if secondary_level is not None else "",
+                                                 secondary_rank=secondary_ranks.get(secondary_level, len(secondary_ranks)),
+                                                 count=bucket["value"])
+        bulk.append(obj)
+
+    PrecalcCategoricalPairDistribution.objects.bulk_create(objs=bulk, batch_size=10000)
+
+
+def precalc_time_rollups(dataset_id=1, dimension_keys=()):
+    """Count the messages in every time bin size, alone and split by each of the given dimensions"""
+    time_dimension = registry.get_dimension('time')
+    dataset = Dataset.objects.get(id=dataset_id)
+
+    # remove existing calculation
+    PrecalcTimeRollup.objects.filter(dataset=dataset).delete()
+
+    messages = datatable_models.exclude_outlier_times(dataset, dataset.message_set.all())
+
+    for bin_size in time_dimension.get_rollup_bin_sizes():
+        for dimension_key in [""] + list(dimension_keys):
+            queryset = messages
+            expression = time_dimension.get_grouping_expression(queryset, bin_size=bin_size)
+            queryset, time_key = time_dimension.select_grouping_expression(queryset, expression)
+            time_converter = time_dimension.get_grouping_converter(expression)
+            grouping_keys = [time_key]
+
+            if dimension_key:
+                dimension = registry.get_dimension(dimension_key)
+                expression = dimension.get_grouping_expression(queryset)
+                queryset, level_key = dimension.select_grouping_expression(queryset, expression)
+                grouping_keys.append(level_key)
+
+            queryset = queryset.values(*grouping_keys).annotate(count=Count('id'))
+
+            bulk = []
+            for bucket in queryset:
+                bin_time = bucket[time_key]
+                if time_converter is not None:
+                    bin_time = time_converter(bin_time)
+                elif isinstance(bin_time, basestring):
+                    # sqlite returns the grouping expression as a string
+                    bin_time = dateparse.parse_datetime(bin_time)
+                if timezone.is_naive(bin_time):
+                    bin_time = timezone.make_aware(bin_time, timezone.utc)
+
+                level = bucket[level_key] if dimension_key else ""
+                obj = PrecalcTimeRollup(dataset=dataset, bin_size=bin_size, time=bin_time,
+                                        dimension_key=dimension_key,
+                                        level=level if level is not None else "",
+                                        count=bucket["count"])
+                bulk.append(obj)
+
+                if len(bulk) >= 10000:
+                    PrecalcTimeRollup.objects.bulk_create(objs=bulk)
+                    bulk = []
+
+            PrecalcTimeRollup.objects.bulk_create(objs=bulk)
+
+
+def refresh_time_rollups(dataset_id):
+    """Recount the time rollups that were saved for the dataset, with the same dimensions, e.g. after an import"""
+    dimension_keys = set(PrecalcTimeRollup.objects.filter(dataset_id=dataset_id)
+                         .values_list('dimension_key', flat=True).distinct())
+    if dimension_keys:
+        precalc_time_rollups(dataset_id=dataset_id, dimension_keys=sorted(key for key in dimension_keys if key))
+
+
+def precalc_time_prefix_sums(dataset_id=1, dimension_keys=()):
+    """Save cumulative time counts for each level of the given dimensions"""
+    from msgvis.apps.enhance.prefix_sums import TimePrefixSums
+
+    time_dimension = registry.get_dimension('time')
+    dataset = Dataset.objects.get(id=dataset_id)
+    messages = datatable_models.exclude_outlier_times(dataset, dataset.message_set.all())
+
+    for dimension_key in dimension_keys:
+        TimePrefixSums.build(dataset, registry.get_dimension(dimension_key), messages,
+                             bin_sizes=time_dimension.get_rollup_bin_sizes())
+
+
+def refresh_time_prefix_sums(dataset_id):
+    """Rebuild the cumulative time counts that were saved for the dataset, e.g. after an import"""
+    from msgvis.apps.enhance.prefix_sums import TimePrefixSums
+
+    dimension_keys = TimePrefixSums.built_dimension_keys(dataset_id)
+    if dimension_keys:
+        precalc_time_prefix_sums(dataset_id=dataset_id, dimension_keys=dimension_keys)
+
+
+def precalc_distinct_sketches(dataset_id=1, measure_keys=()):
+    """Save a HyperLogLog sketch of each approximate distinct count measure for every time bin"""
+    time_dimension = registry.get_dimension('time')
+    dataset = Dataset.objects.get(id=dataset_id)
+    bin_size = settings.DISTINCT_SKETCH_BIN_SIZE
+
+    # remove existing calculation
+    PrecalcTimeDistinctSketch.objects.filter(dataset=dataset).delete()
+
+    messages = datatable_models.exclude_outlier_times(dataset, dataset.message_set.all())
+
+    for measure_key in measure_keys:
+        measure = measures.get_measure(measure_key)
+        queryset = time_dimension.group_by(messages, grouping_key='time', bin_size=bin_size)
+
+        bulk = []
+        for row, sketch in measure.aggregate_sketches(queryset):
+            bin_time = row['time']
+            if isinstance(bin_time, basestring):
+                # sqlite returns the grouping expression as a string
+                bin_time = dateparse.parse_datetime(bin_time)
+            if timezone.is_naive(bin_time):
+                bin_time = timezone.make_aware(bin_time, timezone.utc)
+
+            bulk.append(PrecalcTimeDistinctSketch(dataset=dataset, measure_key=measure_key,
+                                                  bin_size=bin_size, time=bin_time,
+                                                  registers=sketch.to_string()))
+
+        PrecalcTimeDistinctSketch.objects.bulk_create(objs=bulk, batch_size=1000)
+
+
+def refresh_distinct_sketches(dataset_id):
+    """Rebuild the distinct count sketches that were saved for the dataset, e.g. after an import"""
+    measure_keys = set(PrecalcTimeDistinctSketch.objects.filter(dataset_id=dataset_id)
+                       .values_list('measure_key', flat=True).distinct())
+    if measure_keys:
+        precalc_distinct_sketches(dataset_id=dataset_id, measure_keys=sorted(measure_keys))
+
+
+def build_heavy_hitter_sketches(dataset_id=1, dimension_keys=()):
+    """Rebuild the heavy-hitter sketches for the dimensions from all of the dataset's messages"""
+    dataset = Dataset.objects.get(id=dataset_id)
+    sketches = dict((key, SpaceSaving(settings.HEAVY_HITTER_CAPACITY)) for key in dimension_keys)
+    HeavyHitterSketch.count_messages(dataset.message_set.all(), sketches)
+    HeavyHitterSketch.save_counts(dataset, sketches, replace=True)
+
+
+def build_word_index(dataset_id):
+    """Save the posting lists of the dataset's words for keyword search"""
+    from msgvis.apps.enhance.word_index import WordIndex
+    return WordIndex.build(Dataset.objects.get(id=dataset_id))
+
+
+def build_completions(dataset_id):
+    """Save the keyword completions from the dataset's words distribution"""
+    from msgvis.apps.enhance.completions import Completions
+    dataset = Dataset.objects.get(id=dataset_id)
+    levels = PrecalcCategoricalDistribution.objects.filter(dataset=dataset, dimension_key='words')
+    return Completions.build(dataset, levels.values_list('level', 'count').iterator())
+
+
+def build_message_sample(dataset_id, rate, stratified=False, bin_size=86400):
+    dataset = Dataset.objects.get(id=dataset_id)
+    messages = datatable_models.exclude_outlier_times(dataset, dataset.message_set.all())
+    return MessageSample.draw(dataset, messages, rate, stratified=stratified, bin_size=bin_size)
+
+
+def refresh_message_samples(dataset_id):
+    """Draw the dataset's samples again at the same rates and time bins, e.g. after an import"""
+    for sample in list(MessageSample.objects.filter(dataset_id=dataset_id)):
+        # samples saved before the requested rate was kept only know their realized rate
+        rate = sample.requested_rate if sample.requested_rate is not None else sample.rate
+        if sample.stratified and sample.bin_size is not None:
+            build_message_sample(dataset_id, rate, stratified=True, bin_size=sample.bin_size)
+        else:
+            build_message_sample(dataset_id, rate, stratified=sample.stratified)
+        sample.delete()
+
 
 def dump_tweets(dataset_id, save_path):
     dataset = Dataset.objects.get(id=dataset_id)
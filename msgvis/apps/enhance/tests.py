@@ -1,7 +1,10 @@
 from django.test import TestCase
+from django.db import connection
+import mock
 
 from msgvis.apps.enhance import models, tasks
 from msgvis.apps.corpus import models as corpus_models
+from msgvis.apps.base.tests import PrecalcTestCaseMixins
 
 
 class MessageSentimentTest(TestCase):
@@ -138,3 +141,559 @@ class TopicsTest(TestCase):
             self.assertTrue(word in topic_a.name or word in topic_b.name)
             
 
+
+
+class PrecalcPairDistributionTest(TestCase):
+    def setUp(self):
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+
+        from django.utils import timezone as tz
+        now = tz.now()
+        self.distribution = {
+            (True, True): 3,
+            (True, False): 1,
+            (False, False): 2,
+        }
+        for (contains_url, contains_mention), count in self.distribution.iteritems():
+            for i in range(count):
+                self.dataset.message_set.create(text="Message", time=now,
+                                                contains_url=contains_url,
+                                                contains_mention=contains_mention)
+
+    def test_precalc_pair(self):
+        """The precalculated pair distribution should match the message counts"""
+        from msgvis.apps.dimensions import registry
+
+        tasks.precalc_categorical_dimension_pair(dataset_id=self.dataset.id,
+                                                 primary_dimension_key='contains_url',
+                                                 secondary_dimension_key='contains_mention')
+
+        result = self.dataset.get_precalc_pair_distribution(registry.get_dimension('contains_url'),
+                                                            registry.get_dimension('contains_mention'))
+
+        counts = dict(((row['contains_url'], row['contains_mention']), row['value']) for row in result['table'])
+        self.assertEquals(counts, dict(((str(k[0]), str(k[1])), v) for k, v in self.distribution.iteritems()))
+        self.assertEquals(result['domains']['contains_url'], ['False', 'True'])
+
+    def test_missing_pair(self):
+        """Pairs that were not precalculated return None"""
+        from msgvis.apps.dimensions import registry
+
+        result = self.dataset.get_precalc_pair_distribution(registry.get_dimension('contains_url'),
+                                                            registry.get_dimension('contains_mention'))
+        self.assertIsNone(result)
+
+
+class PrecalcTimeRollupTest(TestCase):
+    def setUp(self):
+        from datetime import datetime, timedelta
+        from django.utils import timezone as tz
+
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        tweet = corpus_models.MessageType.objects.create(name="tweet")
+        retweet = corpus_models.MessageType.objects.create(name="retweet")
+
+        start = datetime(2015, 2, 2, 1, 0, 0, tzinfo=tz.utc)
+        for i in range(30):
+            self.dataset.message_set.create(text="Message %d" % i,
+                                            time=start + timedelta(minutes=7 * i),
+                                            type=tweet if i % 3 else retweet)
+
+    def test_time_rollups_match_messages(self):
+        """The rollups should produce the same counts as grouping the messages"""
+        from msgvis.apps.datatable import models as datatable_models
+
+        tasks.precalc_time_rollups(dataset_id=self.dataset.id, dimension_keys=('type',))
+
+        datatable = datatable_models.DataTable('time')
+        result = datatable.render_from_time_rollups(self.dataset)
+        live = list(datatable.render(self.dataset.message_set.all()))
+
+        self.assertEquals(len(result['table']), len(live))
+        self.assertEquals(sum(row['value'] for row in result['table']), 30)
+
+        time_dimension = datatable.primary_dimension
+        self.assertEquals(result['domains']['time'], time_dimension.get_domain(self.dataset.message_set.all()))
+
+        datatable = datatable_models.DataTable('time', 'type')
+        result = datatable.render_from_time_rollups(self.dataset)
+        type_counts = {}
+        for row in result['table']:
+            type_counts[row['type']] = type_counts.get(row['type'], 0) + row['value']
+
+        self.assertEquals(type_counts, {'tweet': 20, 'retweet': 10})
+        self.assertEquals(result['domains']['type'], ['tweet', 'retweet'])
+
+    def test_refresh(self):
+        """Refreshing should recount the saved dimensions with the new messages"""
+        from msgvis.apps.datatable import models as datatable_models
+
+        tasks.precalc_time_rollups(dataset_id=self.dataset.id, dimension_keys=('type',))
+        self.dataset.message_set.create(text="Later", time=self.dataset.message_set.latest('time').time,
+                                        type=corpus_models.MessageType.objects.get(name="tweet"))
+        tasks.refresh_time_rollups(self.dataset.id)
+
+        result = datatable_models.DataTable('time').render_from_time_rollups(self.dataset)
+        self.assertEquals(sum(row['value'] for row in result['table']), 31)
+        keys = models.PrecalcTimeRollup.objects.filter(dataset=self.dataset).values_list('dimension_key', flat=True)
+        self.assertEquals(set(keys), {'', 'type'})
+
+    def test_unaligned_filter_falls_back(self):
+        """Time filters that cut through a bin cannot be answered from the rollups"""
+        from datetime import datetime
+        from django.utils import timezone as tz
+        from msgvis.apps.datatable import models as datatable_models
+        from msgvis.apps.dimensions import registry
+
+        tasks.precalc_time_rollups(dataset_id=self.dataset.id)
+
+        datatable = datatable_models.DataTable('time')
+        filters = [{
+            'dimension': registry.get_dimension('time'),
+            'min_time': datetime(2015, 2, 2, 1, 3, 17, tzinfo=tz.utc),
+        }]
+        self.assertIsNone(datatable.render_from_time_rollups(self.dataset, filters))
+
+
+class TimePrefixSumsTest(PrecalcTestCaseMixins, TestCase):
+    def setUp(self):
+        from datetime import datetime, timedelta
+        from django.utils import timezone as tz
+
+        super(TimePrefixSumsTest, self).setUp()
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        self.start = datetime(2015, 2, 2, 1, 0, 0, tzinfo=tz.utc)
+        for i in range(30):
+            self.dataset.message_set.create(text="Message %d" % i,
+                                            time=self.start + timedelta(minutes=7 * i),
+                                            contains_url=(i % 3 == 0))
+
+    def test_time_range_counts(self):
+        """Counts in a time range should match the filtered messages"""
+        from datetime import timedelta
+        from msgvis.apps.datatable import models as datatable_models
+        from msgvis.apps.dimensions import registry
+
+        tasks.precalc_time_prefix_sums(dataset_id=self.dataset.id, dimension_keys=('contains_url',))
+
+        min_time = self.start + timedelta(minutes=20)
+        max_time = self.start + timedelta(minutes=100)
+        filters = [{
+            'dimension': registry.get_dimension('time'),
+            'min_time': min_time,
+            'max_time': max_time,
+        }]
+
+        datatable = datatable_models.DataTable('contains_url')
+        result = datatable.render_from_time_prefix_sums(self.dataset, filters)
+
+        messages = self.dataset.message_set.filter(time__gte=min_time, time__lte=max_time)
+        counts = dict((row['contains_url'], row['value']) for row in result['table'])
+        self.assertEquals(counts, {
+            True: messages.filter(contains_url=True).count(),
+            False: messages.filter(contains_url=False).count(),
+        })
+
+    def test_several_time_filters(self):
+        """Every time filter should apply, not just the last one"""
+        from datetime import timedelta
+        from msgvis.apps.datatable import models as datatable_models
+        from msgvis.apps.dimensions import registry
+
+        time = registry.get_dimension('time')
+        min_time = self.start + timedelta(minutes=20)
+        max_time = self.start + timedelta(minutes=100)
+        filters = [
+            {'dimension': time, 'min_time': min_time, 'max_time': self.start + timedelta(minutes=150)},
+            {'dimension': time, 'min_time': self.start, 'max_time': max_time},
+        ]
+        self.assertEquals(datatable_models.time_filter_range(filters, lambda dimension: True), (min_time, max_time))
+
+        tasks.precalc_time_prefix_sums(dataset_id=self.dataset.id, dimension_keys=('contains_url',))
+        datatable = datatable_models.DataTable('contains_url')
+        result = datatable.render_from_time_prefix_sums(self.dataset, filters)
+
+        # ranges that do not overlap are left to the database
+        filters[1]['max_time'] = self.start + timedelta(minutes=10)
+        self.assertIsNone(datatable.render_from_time_prefix_sums(self.dataset, filters))
+
+        messages = self.dataset.message_set.filter(time__gte=min_time, time__lte=max_time)
+        self.assertEquals(sum(row['value'] for row in result['table']), messages.count())
+
+    def test_refresh(self):
+        """Refreshing should rebuild the saved dimensions with the new messages"""
+        from datetime import timedelta
+        from msgvis.apps.enhance.prefix_sums import TimePrefixSums
+
+        tasks.precalc_time_prefix_sums(dataset_id=self.dataset.id, dimension_keys=('contains_url',))
+        self.assertEquals(TimePrefixSums.built_dimension_keys(self.dataset.id), ['contains_url'])
+
+        self.dataset.message_set.create(text="Later", time=self.start + timedelta(days=2), contains_url=True)
+        tasks.refresh_time_prefix_sums(self.dataset.id)
+        prefix_sums = TimePrefixSums.load(self.dataset.id, 'contains_url')
+
+        self.assertEquals(prefix_sums.count(True), 11)
+        self.assertEquals(prefix_sums.count(True, min_time=self.start + timedelta(days=1)), 1)
+
+    def test_rebuild_keeps_loaded_counts(self):
+        """Rebuilding should replace the files, so counts already loaded stay readable"""
+        import os
+        from datetime import timedelta
+        from msgvis.apps.enhance.prefix_sums import TimePrefixSums
+
+        tasks.precalc_time_prefix_sums(dataset_id=self.dataset.id, dimension_keys=('contains_url',))
+        old = TimePrefixSums.load(self.dataset.id, 'contains_url')
+
+        self.dataset.message_set.create(text="Later", time=self.start + timedelta(days=2), contains_url=True)
+        tasks.refresh_time_prefix_sums(self.dataset.id)
+
+        self.assertEquals(old.count(True), 10)
+        self.assertEquals(TimePrefixSums.load(self.dataset.id, 'contains_url').count(True), 11)
+        directory = os.path.dirname(TimePrefixSums.get_path(self.dataset.id, 'contains_url'))
+        self.assertEquals([name for name in os.listdir(directory) if name.endswith('.tmp')], [])
+
+    def test_not_built(self):
+        """Without precalculated counts the data table falls back on the database"""
+        from msgvis.apps.datatable import models as datatable_models
+
+        datatable = datatable_models.DataTable('contains_url')
+        self.assertIsNone(datatable.render_from_time_prefix_sums(self.dataset))
+
+
+class MessageSampleTest(TestCase):
+    def setUp(self):
+        from datetime import datetime, timedelta
+        from django.utils import timezone as tz
+
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        start = datetime(2015, 2, 2, 0, 0, 0, tzinfo=tz.utc)
+        for i in range(40):
+            self.dataset.message_set.create(text="Message %d" % i,
+                                            time=start + timedelta(hours=i),
+                                            contains_url=(i % 4 == 0))
+
+    def test_full_sample_is_exact(self):
+        """A sample of every message should give the exact counts with no error"""
+        from msgvis.apps.datatable import models as datatable_models
+
+        sample = tasks.build_message_sample(self.dataset.id, rate=1.0)
+        self.assertEquals(sample.messages.count(), 40)
+
+        datatable = datatable_models.DataTable('contains_url')
+        datatable.set_sample(models.MessageSample.get_for_dataset(self.dataset))
+        result = datatable.generate(self.dataset)
+
+        self.assertTrue(result['approximate'])
+        self.assertEquals(result['sample_rate'], 1.0)
+        counts = dict((row['contains_url'], row['value']) for row in result['table'])
+        self.assertEquals(counts, {True: 10, False: 30})
+        for row in result['table']:
+            self.assertEquals(row['error'], 0)
+
+    def test_stratified_sample(self):
+        """A stratified sample should take the same fraction of each time bin"""
+        sample = tasks.build_message_sample(self.dataset.id, rate=0.5, stratified=True, bin_size=4 * 3600)
+        self.assertEquals(sample.messages.count(), 20)
+        self.assertEquals(sample.rate, 0.5)
+
+    def test_stratified_sample_small_bins(self):
+        """Time bins smaller than 1 / rate should not all be rounded up"""
+        sample = tasks.build_message_sample(self.dataset.id, rate=0.25, stratified=True, bin_size=3600)
+        self.assertLess(sample.messages.count(), 25)
+        self.assertEquals(sample.rate, sample.messages.count() / 40.0)
+
+    def test_refresh(self):
+        """Refreshing should replace each sample with one drawn from the current messages"""
+        tasks.build_message_sample(self.dataset.id, rate=1.0)
+        self.dataset.message_set.create(text="Later", time=self.dataset.message_set.latest('time').time)
+
+        tasks.refresh_message_samples(self.dataset.id)
+        samples = models.MessageSample.objects.filter(dataset=self.dataset)
+        self.assertEquals(samples.count(), 1)
+        self.assertEquals(samples[0].messages.count(), 41)
+
+    def test_refresh_keeps_parameters(self):
+        """Refreshing should draw again at the requested rate and with the same time bins"""
+        sample = tasks.build_message_sample(self.dataset.id, rate=0.3, stratified=True, bin_size=10 * 3600)
+        self.assertEquals(sample.requested_rate, 0.3)
+        self.assertEquals(sample.bin_size, 10 * 3600)
+
+        with mock.patch.object(tasks, 'build_message_sample', wraps=tasks.build_message_sample) as build:
+            tasks.refresh_message_samples(self.dataset.id)
+        build.assert_called_once_with(self.dataset.id, 0.3, stratified=True, bin_size=10 * 3600)
+
+        refreshed = models.MessageSample.objects.get(dataset=self.dataset)
+        self.assertEquals((refreshed.requested_rate, refreshed.bin_size), (0.3, 10 * 3600))
+
+
+class HeavyHitterSketchTest(TestCase):
+    def setUp(self):
+        from django.utils import timezone as tz
+
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+
+        # hashtag i is used by i + 1 messages
+        for i in range(15):
+            hashtag = corpus_models.Hashtag.objects.create(text="tag%d" % i)
+            for j in range(i + 1):
+                message = self.dataset.message_set.create(text="Message %d %d" % (i, j), time=tz.now())
+                message.hashtags.add(hashtag)
+
+    def test_space_saving(self):
+        """The sketch should find the frequent levels with a few counters"""
+        from msgvis.apps.enhance.sketches import SpaceSaving
+
+        sketch = SpaceSaving(capacity=3)
+        sketch.update_all(['a'] * 10 + ['b', 'c', 'd'] + ['e'] * 5)
+        top = sketch.top(2)
+        self.assertEquals([row[0] for row in top], ['a', 'e'])
+        self.assertEquals(top[0][1:], (10, 0))
+        for level, count, error in sketch.top():
+            self.assertLessEqual(count - error, 10 if level == 'a' else 5)
+        self.assertIn('e', sketch.candidates(2))
+
+        copy = SpaceSaving.from_dict(sketch.to_dict())
+        copy.merge(sketch)
+        self.assertEquals(copy.total, 36)
+        self.assertEquals(copy.top(1)[0][:2], ('a', 20))
+
+    def test_space_saving_bounds(self):
+        """On a long-tailed stream every counter should bound the true count"""
+        import random
+        from msgvis.apps.enhance.sketches import SpaceSaving
+
+        rng = random.Random(3)
+        stream = [int(rng.paretovariate(1.2)) for i in range(5000)]
+        sketch = SpaceSaving(capacity=20)
+        sketch.update_all(stream)
+
+        self.assertEquals(len(sketch), 20)
+        self.assertEquals(sum(c[0] for c in sketch.counters.itervalues()), len(stream))
+        for level, count, error in sketch.top():
+            self.assertLessEqual(count - error, stream.count(level))
+            self.assertGreaterEqual(count, stream.count(level))
+        for level in set(stream):
+            if stream.count(level) > len(stream) / 20:
+                self.assertIn(level, sketch.counters)
+
+    def test_sketched_domain(self):
+        """The domain from the sketch should match the counted domain"""
+        from django.test.utils import override_settings
+        from msgvis.apps.datatable import models as datatable_models
+
+        with override_settings(HEAVY_HITTER_CAPACITY=12):
+            tasks.build_heavy_hitter_sketches(dataset_id=self.dataset.id, dimension_keys=('hashtags',))
+
+        datatable = datatable_models.DataTable('hashtags')
+        datatable.set_mode('enable_others')
+        expected = datatable.generate(self.dataset)
+
+        with mock.patch.object(datatable_models, 'HEAVY_HITTER_DIMENSIONS', ('hashtags',)):
+            self.assertIsNotNone(datatable.sketched_domain(self.dataset, datatable.primary_dimension,
+                                                           self.dataset.message_set.all()))
+            result = datatable.generate(self.dataset)
+
+        self.assertEquals(result['domains']['hashtags'][:10], ['tag%d' % i for i in range(14, 4, -1)])
+        self.assertEquals(result['domains'], expected['domains'])
+        self.assertEquals(sorted(result['table']), sorted(expected['table']))
+
+
+class DistinctSketchTest(TestCase):
+    def setUp(self):
+        from datetime import datetime, timedelta
+        from django.utils import timezone as tz
+
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        self.start = datetime(2015, 2, 2, 0, 0, 0, tzinfo=tz.utc)
+
+        senders = [self.dataset.person_set.create(username="person%d" % i) for i in range(12)]
+        for i in range(72):
+            self.dataset.message_set.create(text="Message %d" % i,
+                                            time=self.start + timedelta(hours=2 * i),
+                                            sender=senders[i % 5 + (i // 24) * 3])
+
+    def test_hyperloglog(self):
+        """The estimates should be close and merging should count the union"""
+        from msgvis.apps.enhance.sketches import HyperLogLog
+
+        a = HyperLogLog()
+        a.update_all(xrange(10000))
+        self.assertAlmostEqual(a.cardinality(), 10000, delta=500)
+
+        b = HyperLogLog.from_string(a.to_string())
+        b.update_all(xrange(5000, 15000))
+        b.merge(a)
+        self.assertAlmostEqual(b.cardinality(), 15000, delta=750)
+
+    def test_merged_sketches(self):
+        """Merging the precalculated sketches should give the same answer as the messages"""
+        from django.test.utils import override_settings
+        from msgvis.apps.datatable import models as datatable_models
+
+        with override_settings(DISTINCT_SKETCH_BIN_SIZE=3600):
+            tasks.precalc_distinct_sketches(dataset_id=self.dataset.id, measure_keys=('sender_count_approx',))
+        self.assertEquals(models.PrecalcTimeDistinctSketch.objects.filter(dataset=self.dataset).count(), 72)
+
+        datatable = datatable_models.DataTable('time')
+        datatable.set_measure('sender_count_approx')
+        result = datatable.render_from_distinct_sketches(self.dataset)
+
+        # the hourly sketches are merged into coarser bins
+        self.assertLess(len(result['table']), 72)
+
+        # the same bins, counted exactly from the messages
+        datatable.set_measure('sender_count')
+        exact = datatable.generate(self.dataset)
+
+        self.assertEquals([row['value'] for row in result['table']],
+                          [row['value'] for row in exact['table']])
+
+    def test_refresh(self):
+        """Refreshing should rebuild the saved measures with the new messages"""
+        from datetime import timedelta
+        from django.test.utils import override_settings
+        from msgvis.apps.datatable import models as datatable_models
+
+        with override_settings(DISTINCT_SKETCH_BIN_SIZE=3600):
+            tasks.precalc_distinct_sketches(dataset_id=self.dataset.id, measure_keys=('sender_count_approx',))
+            sender = self.dataset.person_set.create(username="newcomer")
+            self.dataset.message_set.create(text="Late", time=self.start + timedelta(hours=143), sender=sender)
+            tasks.refresh_distinct_sketches(self.dataset.id)
+        self.assertEquals(models.PrecalcTimeDistinctSketch.objects.filter(dataset=self.dataset).count(), 73)
+
+        datatable = datatable_models.DataTable('time')
+        datatable.set_measure('sender_count_approx')
+        result = datatable.render_from_distinct_sketches(self.dataset)
+
+        datatable.set_measure('sender_count')
+        exact = datatable.generate(self.dataset)
+
+        self.assertEquals([row['value'] for row in result['table']],
+                          [row['value'] for row in exact['table']])
+
+
+class WordIndexTest(PrecalcTestCaseMixins, TestCase):
+    def setUp(self):
+        super(WordIndexTest, self).setUp()
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        self.create_word_messages(self.dataset, {'bowl': 'bowl', 'bowls': 'bowl', 'super': 'super', 'ads': 'ad'},
+                                  ["super bowl", "super bowls ads", "bowl ads", "super", "nothing"])
+
+    def test_matches_database_search(self):
+        """Searches over the posting lists should find the same messages as the database"""
+        searches = ["bowl", "super bowl", "super,ads", "bowl,NOT ads", "super missing,ads", "missing", "bowl,NOT bowls ads"]
+        expected = [sorted(self.dataset.get_advanced_search_results(search, []).values_list('id', flat=True))
+                    for search in searches]
+
+        index = tasks.build_word_index(self.dataset.id)
+        self.assertEquals(len(index), 3)
+
+        for search, ids in zip(searches, expected):
+            self.assertEquals(index.search(search).tolist(), ids)
+            self.assertEquals(sorted(self.dataset.get_advanced_search_results(search, []).values_list('id', flat=True)),
+                              ids)
+
+    def test_delta_encoding(self):
+        """The posting lists should decode to the sorted message ids"""
+        index = tasks.build_word_index(self.dataset.id)
+
+        bowl = models.TweetWord.objects.filter(dataset=self.dataset, text='bowl')
+        ids = sorted(set(bowl.values_list('messages__id', flat=True)))
+        self.assertEquals(index.postings('bowl').tolist(), ids)
+        self.assertEquals(index.deltas.dtype.itemsize, 2)
+
+    def test_stale_index_ignored(self):
+        """An index built before messages were added should not be used"""
+        from msgvis.apps.enhance.word_index import WordIndex
+
+        tasks.build_word_index(self.dataset.id)
+        self.assertIsNotNone(WordIndex.load(self.dataset.id))
+
+        self.dataset.message_set.create(text="bowl")
+        self.assertIsNone(WordIndex.load(self.dataset.id))
+        self.assertIsNone(self.dataset.get_advanced_search_ids("bowl", []))
+
+    def test_rebuild_keeps_loaded_index(self):
+        """Rebuilding should replace the files, so an index already loaded stays readable"""
+        from msgvis.apps.enhance.word_index import WordIndex
+
+        old = tasks.build_word_index(self.dataset.id)
+        self.create_word_messages(self.dataset, ['bowl'], ["bowl"])
+        tasks.build_word_index(self.dataset.id)
+
+        self.assertEquals(len(old.postings('bowl')), 3)
+        self.assertEquals(len(WordIndex.load(self.dataset.id).postings('bowl')), 4)
+
+    def test_search_fetches_page(self):
+        """Paging through indexed results should only fetch the messages shown"""
+        from django.core.paginator import Paginator
+
+        expected = sorted(self.dataset.get_advanced_search_results("bowl", []).values_list('id', flat=True))
+
+        tasks.build_word_index(self.dataset.id)
+        results = self.dataset.search_messages("bowl", [])
+        self.assertEquals(results.count(), 3)
+
+        with self.assertNumQueries(1):
+            messages = list(Paginator(results, 2).page(2).object_list)
+        self.assertEquals([m.id for m in messages], expected[2:])
+
+    def test_lemmas_rebuilt(self):
+        """Each normalized word should have one lemma linked to the messages of all its spellings"""
+        lemmas = models.Lemma.objects.filter(dataset=self.dataset)
+        self.assertEquals(sorted(lemmas.values_list('text', flat=True)), ['ad', 'bowl', 'super'])
+
+        bowl = lemmas.get(text='bowl')
+        self.assertEquals(sorted(bowl.spellings.values_list('original_text', flat=True)), ['bowl', 'bowls'])
+        self.assertEquals(sorted(bowl.messages.values_list('text', flat=True)),
+                          ["bowl ads", "super bowl", "super bowls ads"])
+
+        # rebuilding again should not duplicate anything
+        models.Lemma.rebuild(connection, self.dataset.id)
+        self.assertEquals(lemmas.count(), 3)
+        self.assertEquals(bowl.messages.count(), 3)
+
+
+class CompletionsTest(PrecalcTestCaseMixins, TestCase):
+    def setUp(self):
+        super(CompletionsTest, self).setUp()
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        for level, count in [('super', 5), ('superbowl', 7), ('support', 1), ('bowl', 4), ('bowls', 2),
+                             ('big', 9), (u'caf\xe9', 3), ('Super', 1)]:
+            models.PrecalcCategoricalDistribution.objects.create(dataset=self.dataset, dimension_key='words',
+                                                                 level=level, count=count)
+
+    def test_complete(self):
+        """The words starting with a prefix should be ranked by count"""
+        from msgvis.apps.enhance import completions
+
+        tasks.build_completions(self.dataset.id)
+        loaded = completions.Completions.load(self.dataset.id)
+
+        self.assertEquals(loaded.complete("SU"), [(u'superbowl', 7), (u'super', 6), (u'support', 1)])
+        self.assertEquals(loaded.complete("supe"), [(u'superbowl', 7), (u'super', 6)])
+        self.assertEquals(loaded.complete("bowl", limit=1), [(u'bowl', 4)])
+        self.assertEquals(loaded.complete(u"caf"), [(u'caf\xe9', 3)])
+        self.assertEquals(loaded.complete("x"), [])
+        self.assertEquals(loaded.complete("")[0], (u'big', 9))
+
+    def test_rebuild_keeps_loaded_completions(self):
+        """Rebuilding should replace the files, so completions already loaded stay readable"""
+        from msgvis.apps.enhance import completions
+
+        old = tasks.build_completions(self.dataset.id)
+        models.PrecalcCategoricalDistribution.objects.create(dataset=self.dataset, dimension_key='words',
+                                                             level='supper', count=2)
+        tasks.build_completions(self.dataset.id)
+
+        self.assertEquals(len(old.complete("sup")), 3)
+        self.assertEquals(len(completions.Completions.load(self.dataset.id).complete("sup")), 4)
+
+    def test_complete_phrase(self):
+        """The last word of a phrase should be ranked by co-occurrence with the earlier words"""
+        self.create_word_messages(self.dataset, ['super', 'bowl', 'big'], ["super bowl", "super bowl", "big"])
+
+        loaded = tasks.build_completions(self.dataset.id)
+        self.assertEquals(loaded.complete_phrase("b"), ['big', 'bowl', 'bowls'])
+        tasks.build_word_index(self.dataset.id)
+        self.assertEquals(loaded.complete_phrase("super b"), ['super bowl', 'super big', 'super bowls'])
@@ -0,0 +1,194 @@
+"""
+An inverted index from the words of a dataset to the messages that contain them,
+for answering keyword searches and groups without joining ``lemmas``.
+
+For every normalized word (:class:`.Lemma`) we keep the sorted ids of its
+messages as a posting list. The lists are delta-encoded (each id is stored as the
+gap from the previous one) in the smallest integer type that fits, concatenated into
+one ``.npy`` file under ``settings.PRECALC_ROOT`` and memory-mapped when loaded, so
+every worker process shares the same pages. Rebuilt files are renamed into place
+(the metadata last), so workers never read a partly written list.
+
+.. code-block:: python
+
+    index = WordIndex.load(dataset.id)
+    if index is not None:
+        index.search("super bowl,NOT ads")
+        # array([  12,   57, 1033, ...])
+
+Keyword queries are answered by intersecting, merging and subtracting posting lists
+(see :class:`msgvis.apps.corpus.keywords.PostingListPlan`).
+The database is only needed to fetch the messages that are shown.
+
+The index records the dataset's newest message when it was built
+(:meth:`msgvis.apps.corpus.models.Dataset.get_data_version`). After an import
+it is out of date, so it is not loaded and searches go to the database until it is rebuilt.
+"""
+import os
+import json
+import logging
+
+from django.conf import settings
+
+from msgvis.apps.base.utils import save_atomically
+
+logger = logging.getLogger(__name__)
+
+_loaded = {}
+
+
+class WordIndex(object):
+    """The posting lists of the words in one dataset"""
+
+    def __init__(self, dataset_id, words, variants, offsets, deltas, data_version=None):
+        self.dataset_id = dataset_id
+
+        self.data_version = data_version
+        """The dataset's data version when the index was built"""
+
+        self.words = dict((word, i) for i, word in enumerate(words))
+        """Maps each normalized word to its posting list number"""
+
+        self.variants = variants
+        """Maps each lower-cased original word to the normalized words it was parsed as"""
+
+        self.offsets = offsets
+        """The posting list of word i is deltas[offsets[i]:offsets[i + 1]]"""
+
+        self.deltas = deltas
+
+    def __len__(self):
+        return len(self.words)
+
+    @classmethod
+    def get_path(cls, dataset_id):
+        """The path of the index files, without an extension"""
+        return os.path.join(settings.PRECALC_ROOT, 'dataset_%d' % dataset_id, 'word_index')
+
+    @classmethod
+    def load(cls, dataset_id, check_version=True):
+        """
+        Memory-map the saved index, or return None if it has not been built
+        or (unless check_version is False) the dataset has changed since.
+        """
+        import numpy
+        from msgvis.apps.corpus.models import Dataset
+
+        path = cls.get_path(dataset_id)
+        if not all(os.path.exists(path + suffix) for suffix in ('.json', '_offsets.npy', '_postings.npy')):
+            return None
+
+        # reload if the files were rebuilt since we last looked
+        mtime = tuple(os.path.getmtime(path + suffix) for suffix in ('.json', '_offsets.npy', '_postings.npy'))
+        cached = _loaded.get(path)
+        if cached is not None and cached[0] == mtime:
+            index = cached[1]
+        else:
+            with open(path + '.json', 'rb') as fp:
+                meta = json.load(fp)
+
+            offsets = numpy.load(path + '_offsets.npy', mmap_mode='r')
+            deltas = numpy.load(path + '_postings.npy', mmap_mode='r')
+            if len(offsets) != len(meta['words']) + 1 or len(deltas) != meta.get('num_postings'):
+                # caught between the renames of a rebuild
+                return None
+            index = cls(dataset_id, meta['words'], meta['variants'], offsets, deltas, meta.get('data_version'))
+            _loaded[path] = (mtime, index)
+
+        if check_version and index.data_version != Dataset(id=dataset_id).get_data_version():
+            logger.warning("The word index of dataset %d is older than its messages; "
+                           "run build_word_index to use it again" % dataset_id)
+            return None
+        return index
+
+    @classmethod
+    def build(cls, dataset):
+        """Read the dataset's lemma-message links and save the index"""
+        import numpy
+        from msgvis.apps.enhance.models import TweetWord, Lemma
+
+        # before reading, so messages added meanwhile make the index out of date
+        data_version = dataset.get_data_version()
+
+        variants = {}
+        for original_text, text in TweetWord.objects.filter(dataset=dataset, lemma__isnull=False) \
+                .values_list('original_text', 'lemma__text').distinct().iterator():
+            texts = variants.setdefault(original_text.lower(), [])
+            if text not in texts:
+                texts.append(text)
+
+        links = Lemma.messages.through.objects.filter(lemma__dataset=dataset)
+        links = links.values_list('lemma__text', 'message_id').order_by('lemma__text', 'message_id')
+
+        words = []
+        offsets = [0]
+        deltas = []
+        current = None
+        previous_id = 0
+        for text, message_id in links.iterator():
+            if text != current:
+                if current is not None:
+                    offsets.append(len(deltas))
+                words.append(text)
+                current = text
+                previous_id = 0
+            deltas.append(message_id - previous_id)
+            previous_id = message_id
+        if current is not None:
+            offsets.append(len(deltas))
+
+        # the gaps between ids are usually small
+        max_delta = max(deltas) if len(deltas) > 0 else 0
+        dtype = numpy.uint16 if max_delta < 2 ** 16 else numpy.uint32 if max_delta < 2 ** 32 else numpy.uint64
+
+        path = cls.get_path(dataset.id)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        save_atomically(path + '_offsets.npy', lambda fp: numpy.save(fp, numpy.array(offsets, dtype=numpy.int64)))
+        save_atomically(path + '_postings.npy', lambda fp: numpy.save(fp, numpy.array(deltas, dtype=dtype)))
+        save_atomically(path + '.json', lambda fp: json.dump({
+            'words': words,
+            'variants': variants,
+            'data_version': data_version,
+            'num_postings': len(deltas),
+        }, fp))
+        _loaded.pop(path, None)
+
+        logger.info("Saved the posting lists of %d words for dataset %d" % (len(words), dataset.id))
+
+        return cls.load(dataset.id, check_version=False)
+
+    def postings(self, text):
+        """The sorted ids of the messages containing a normalized word"""
+        import numpy
+
+        i = self.words.get(text)
+        if i is None:
+            return numpy.array([], dtype=numpy.int64)
+        deltas = self.deltas[self.offsets[i]:self.offsets[i + 1]]
+        return numpy.cumsum(deltas, dtype=numpy.int64)
+
+    def lookup(self, word):
+        """
+        The sorted ids of the messages containing any normalized form of a word
+        as it was written, or None if the word does not occur.
+        """
+        import numpy
+
+        texts = self.variants.get(word.lower())
+        if not texts:
+            return None
+
+        ids = self.postings(texts[0])
+        for text in texts[1:]:
+            ids = numpy.union1d(ids, self.postings(text))
+        return ids
+
+    def search(self, keywords_text):
+        """
+        The sorted ids of the messages matching a keyword query
+        (see :mod:`msgvis.apps.corpus.keywords`).
+        """
+        from msgvis.apps.corpus import keywords
+        return keywords.PostingListPlan(self).evaluate(keywords.parse(keywords_text))
@@ -0,0 +1,360 @@
+"""
+Group membership as bitmaps over the messages of a dataset.
+
+Each message of a dataset gets a dense ordinal, its position in the sorted array
+of the dataset's message ids (saved under ``settings.PRECALC_ROOT`` and
+memory-mapped like the other precalculated arrays). A group is then a bit array
+with one bit per ordinal, so unions, intersections and differences of groups are
+byte-wise operations, and the overlap of every pair of groups needs no queries.
+
+.. code-block:: python
+
+    a = get_group_bitmap(group_a)
+    b = get_group_bitmap(group_b)
+    len(a & b), a.jaccard(b)
+    # (213, 0.081)
+
+    overlap_matrix([group_a, group_b, group_c])
+    # {'groups': [3, 4, 7], 'counts': [1520, 1315, 80], 'overlap': [[1520, 213, 0], ...], 'jaccard': [...]}
+
+A group may also be defined by a set expression over other groups of the same dataset
+(see :func:`parse_expression`), such as ``#3 & (#4 | #5) - #6``.
+
+The bitmaps are kept in the Django cache under a key that includes the group's
+keywords, message types and expression, so editing a group invalidates its bitmap
+and the bitmaps of the groups derived from it. The ordinals are saved again when
+the dataset has a newer message than the last one they include.
+"""
+import os
+import re
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+_loaded = {}
+
+MAX_EXPRESSION_DEPTH = 10
+"""How deeply groups may be defined in terms of other groups"""
+
+# the number of bits set in each byte
+_popcount = None
+
+
+def _bit_counts():
+    global _popcount
+    if _popcount is None:
+        import numpy
+        _popcount = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.int64)
+    return _popcount
+
+
+class MessageOrdinals(object):
+    """The sorted message ids of a dataset; the ordinal of a message is its position"""
+
+    def __init__(self, dataset_id, ids, mtime=None):
+        self.dataset_id = dataset_id
+        self.ids = ids
+        self.mtime = mtime
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def data_version(self):
+        """The newest message id included, comparable to :meth:`msgvis.apps.corpus.models.Dataset.get_data_version`"""
+        return int(self.ids[-1]) if len(self.ids) > 0 else 0
+
+    @classmethod
+    def get_path(cls, dataset_id):
+        return os.path.join(settings.PRECALC_ROOT, 'dataset_%d' % dataset_id, 'message_ordinals.npy')
+
+    @classmethod
+    def load(cls, dataset_id):
+        """Memory-map the saved ids, or return None if they have not been saved."""
+        import numpy
+
+        path = cls.get_path(dataset_id)
+        if not os.path.exists(path):
+            return None
+
+        mtime = os.path.getmtime(path)
+        cached = _loaded.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        ordinals = cls(dataset_id, numpy.load(path, mmap_mode='r'), mtime)
+        _loaded[path] = (mtime, ordinals)
+        return ordinals
+
+    @classmethod
+    def build(cls, dataset):
+        """Save the sorted ids of the dataset's messages"""
+        import numpy
+
+        ids = numpy.fromiter(dataset.message_set.order_by('id').values_list('id', flat=True).iterator(),
+                             dtype=numpy.int64)
+
+        path = cls.get_path(dataset.id)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # other processes may have the old file mapped, so replace it rather than writing over it
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as fp:
+            numpy.save(fp, ids)
+        os.rename(temp_path, path)
+        _loaded.pop(path, None)
+
+        logger.info("Saved the ordinals of %d messages for dataset %d" % (len(ids), dataset.id))
+        return cls.load(dataset.id)
+
+    @classmethod
+    def get(cls, dataset):
+        """Load the ordinals of the dataset, saving them first if needed or if there are newer messages"""
+        ordinals = cls.load(dataset.id)
+        if ordinals is None or ordinals.data_version != dataset.get_data_version():
+            ordinals = cls.build(dataset)
+        return ordinals
+
+    def find(self, ids):
+        """The ordinals of the message ids, and a mask of the ids that were found"""
+        import numpy
+
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        if len(self.ids) == 0:
+            return numpy.zeros(len(ids), dtype=numpy.int64), numpy.zeros(len(ids), dtype=bool)
+        ordinals = numpy.searchsorted(self.ids, ids)
+        found = ordinals < len(self.ids)
+        found[found] = self.ids[ordinals[found]] == ids[found]
+        return ordinals, found
+
+
+class GroupBitmap(object):
+    """A set of messages of a dataset, as a packed array of bits indexed by ordinal"""
+
+    def __init__(self, ordinals, bits):
+        self.ordinals = ordinals
+        self.bits = bits
+
+    @classmethod
+    def from_ids(cls, ordinals, ids):
+        import numpy
+
+        positions, found = ordinals.find(ids)
+        mask = numpy.zeros(len(ordinals), dtype=bool)
+        mask[positions[found]] = True
+        return cls(ordinals, numpy.packbits(mask))
+
+    def ids(self):
+        """The sorted message ids in the set"""
+        import numpy
+
+        mask = numpy.unpackbits(self.bits)[:len(self.ordinals)].astype(bool)
+        return numpy.asarray(self.ordinals.ids)[mask]
+
+    def __len__(self):
+        return int(_bit_counts()[self.bits].sum())
+
+    def __and__(self, other):
+        return GroupBitmap(self.ordinals, self.bits & other.bits)
+
+    def __or__(self, other):
+        return GroupBitmap(self.ordinals, self.bits | other.bits)
+
+    def __sub__(self, other):
+        return GroupBitmap(self.ordinals, self.bits & ~other.bits)
+
+    def jaccard(self, other):
+        union = len(self | other)
+        if union == 0:
+            return 0.0
+        return len(self & other) / float(union)
+
+
+_token_re = re.compile(r'\s*(?:#(\d+)|([&|()-]))')
+
+
+def parse_expression(expression):
+    """
+    Parse a set expression over groups, with ``#<group id>`` for a group,
+    ``&`` for intersection, ``|`` for union and ``-`` for difference.
+    Operators apply from left to right; use parentheses to group them.
+    Returns a nested tuple such as ``('-', ('&', 3, 4), 6)``, or raises ValueError.
+    """
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = _token_re.match(expression, position)
+        if match is None:
+            raise ValueError("Unexpected text in group expression: %s" % expression[position:])
+        tokens.append(int(match.group(1)) if match.group(1) else match.group(2))
+        position = match.end()
+        while position < len(expression) and expression[position].isspace():
+            position += 1
+
+    def operand(i):
+        if i >= len(tokens):
+            raise ValueError("Group expression ends too early")
+        if tokens[i] == '(':
+            node, i = sequence(i + 1)
+            if i >= len(tokens) or tokens[i] != ')':
+                raise ValueError("Missing ) in group expression")
+            return node, i + 1
+        if isinstance(tokens[i], int):
+            return tokens[i], i + 1
+        raise ValueError("Expected a group in group expression, found %s" % tokens[i])
+
+    def sequence(i):
+        node, i = operand(i)
+        while i < len(tokens) and tokens[i] in ('&', '|', '-'):
+            op = tokens[i]
+            right, i = operand(i + 1)
+            node = (op, node, right)
+        return node, i
+
+    node, i = sequence(0)
+    if i != len(tokens):
+        raise ValueError("Unexpected %s in group expression" % tokens[i])
+    return node
+
+
+def expression_groups(node):
+    """The ids of the groups in a parsed expression"""
+    if isinstance(node, tuple):
+        return expression_groups(node[1]) | expression_groups(node[2])
+    return {node}
+
+
+def check_expression(expression, dataset_id, owner_id, group_id=None):
+    """
+    Check that an expression only refers to existing groups of the same dataset and owner,
+    and that it would not make the group (None for a new group) depend on itself.
+    Raises ValueError otherwise.
+    """
+    from msgvis.apps.groups.models import Group
+
+    def check(node, path):
+        if len(path) > MAX_EXPRESSION_DEPTH:
+            raise ValueError("Group expressions are nested too deeply")
+        for member_id in sorted(expression_groups(node)):
+            if member_id in path:
+                raise ValueError("Group #%d would depend on itself" % member_id)
+            try:
+                member = Group.objects.get(id=member_id, dataset_id=dataset_id, owner_id=owner_id, deleted=False)
+            except Group.DoesNotExist:
+                raise ValueError("There is no group #%d in this dataset" % member_id)
+            if member.expression:
+                check(parse_expression(member.expression), path + (member_id,))
+
+    check(parse_expression(expression), (group_id,) if group_id is not None else ())
+
+
+def _expression_member(group, member_id):
+    """
+    The group that an expression refers to, or None if it has been deleted since.
+    Deleted groups count as groups without messages.
+    """
+    from msgvis.apps.groups.models import Group
+
+    try:
+        return Group.objects.get(id=member_id, dataset_id=group.dataset_id, deleted=False)
+    except Group.DoesNotExist:
+        return None
+
+
+def definition_version(group, depth=0):
+    """A string that changes whenever the definition of the group, or of a group in its expression, changes"""
+    if depth > MAX_EXPRESSION_DEPTH:
+        raise ValueError("Group expressions are nested too deeply")
+
+    parts = [group.keywords, ','.join(sorted(t.name for t in group.include_types.all())), group.expression]
+    if group.expression:
+        for group_id in sorted(expression_groups(parse_expression(group.expression))):
+            member = _expression_member(group, group_id)
+            parts.append(definition_version(member, depth + 1) if member is not None else 'deleted')
+    return hashlib.md5(u'\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def _version(group, ordinals):
+    """A string that changes whenever the group's messages may change"""
+    return '%s:%s:%d' % (definition_version(group), ordinals.mtime, len(ordinals))
+
+
+def _cache_key(group, ordinals):
+    return 'group_bitmap:%d:%s' % (group.id, _version(group, ordinals))
+
+
+def store_group_bitmap(group, ids, ordinals=None):
+    """Cache the bitmap of a group whose sorted message ids are already known"""
+    if ordinals is None:
+        ordinals = MessageOrdinals.get(group.dataset)
+    bitmap = GroupBitmap.from_ids(ordinals, ids)
+    cache.set(_cache_key(group, ordinals), bitmap.bits.tostring(), getattr(settings, 'GROUP_BITMAP_CACHE_SECONDS', 3600))
+    return bitmap
+
+
+def get_group_bitmap(group, ordinals=None):
+    """The bitmap of a group's messages, from the cache if it is unchanged"""
+    import numpy
+
+    if ordinals is None:
+        ordinals = MessageOrdinals.get(group.dataset)
+
+    key = _cache_key(group, ordinals)
+    bits = cache.get(key)
+    if bits is not None:
+        return GroupBitmap(ordinals, numpy.frombuffer(bits, dtype=numpy.uint8))
+
+    if group.expression:
+        def evaluate(node):
+            if isinstance(node, tuple):
+                op, left, right = node
+                left, right = evaluate(left), evaluate(right)
+                return left & right if op == '&' else left | right if op == '|' else left - right
+            member = _expression_member(group, node)
+            if member is None:
+                return GroupBitmap.from_ids(ordinals, numpy.zeros(0, dtype=numpy.int64))
+            return get_group_bitmap(member, ordinals)
+        bitmap = evaluate(parse_expression(group.expression))
+    else:
+        ids = group.dataset.get_advanced_search_ids(group.keywords, group.include_types.all())
+        if ids is None:
+            ids = group.messages.values_list('id', flat=True)
+            ids = numpy.fromiter(ids.iterator(), dtype=numpy.int64)
+        bitmap = GroupBitmap.from_ids(ordinals, ids)
+        if len(bitmap) < len(ids):
+            logger.warning("The message ordinals of dataset %d are missing %d messages of group %d; "
+                           "delete %s to rebuild them" % (group.dataset_id, len(ids) - len(bitmap), group.id,
+                                                          MessageOrdinals.get_path(group.dataset_id)))
+
+    cache.set(key, bitmap.bits.tostring(), getattr(settings, 'GROUP_BITMAP_CACHE_SECONDS', 3600))
+    return bitmap
+
+
+def overlap_matrix(groups):
+    """The size of each group, and the size and Jaccard index of the overlap of each pair"""
+    groups = list(groups)
+    bitmaps = [get_group_bitmap(group) for group in groups]
+
+    counts = [len(bitmap) for bitmap in bitmaps]
+    overlap = [[0] * len(groups) for group in groups]
+    jaccard = [[0.0] * len(groups) for group in groups]
+    for i in range(len(groups)):
+        overlap[i][i] = counts[i]
+        jaccard[i][i] = 1.0 if counts[i] > 0 else 0.0
+        for j in range(i + 1, len(groups)):
+            both = len(bitmaps[i] & bitmaps[j])
+            either = counts[i] + counts[j] - both
+            overlap[i][j] = overlap[j][i] = both
+            jaccard[i][j] = jaccard[j][i] = both / float(either) if either > 0 else 0.0
+
+    return {
+        'groups': [group.id for group in groups],
+        'counts': counts,
+        'overlap': overlap,
+        'jaccard': jaccard,
+    }
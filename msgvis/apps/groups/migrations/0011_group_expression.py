@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groups', '0010_auto_20151011_1756'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='expression',
+            field=models.TextField(default=b'', blank=True),
+            preserve_default=True,
+        ),
+    ]
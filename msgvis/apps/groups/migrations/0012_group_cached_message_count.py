@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groups', '0011_group_expression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='cached_message_count',
+            field=models.IntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from msgvis.apps.corpus import utils
 from msgvis.apps.corpus import models as corpus_models
 from msgvis.apps.enhance import models as enhance_models
@@ -32,6 +32,13 @@ class Group(models.Model):
     include_types = models.ManyToManyField(corpus_models.MessageType, null=True, blank=True, default=None)
     """include tweets/retweets/replies"""
 
+    expression = models.TextField(default="", blank=True)
+    """A set expression over other groups, such as ``#3 & #4 - #6``, instead of keywords
+    (see :func:`msgvis.apps.groups.bitmaps.parse_expression`)."""
+
+    cached_message_count = models.IntegerField(null=True, blank=True, default=None)
+    """The number of messages in the group, or None if it must be counted again"""
+
     is_search_record = models.BooleanField(default=False)
 
     deleted = models.BooleanField(default=False)
@@ -42,11 +49,109 @@ class Group(models.Model):
 
     @property
     def messages(self):
+        if self.expression:
+            from msgvis.apps.groups.bitmaps import get_group_bitmap
+            ids = get_group_bitmap(self).ids()
+            return self.dataset.message_set.filter(utils.levels_or('id', ids.tolist()))
         return self.dataset.get_advanced_search_results(self.keywords, self.include_types.all())
 
+    @property
+    def bitmap(self):
+        """The group's messages as a :class:`msgvis.apps.groups.bitmaps.GroupBitmap`"""
+        from msgvis.apps.groups.bitmaps import get_group_bitmap
+        return get_group_bitmap(self)
+
+    def __init__(self, *args, **kwargs):
+        super(Group, self).__init__(*args, **kwargs)
+        self._counted_definition = (self.keywords, self.expression, self.deleted)
+
+    def save(self, *args, **kwargs):
+        changed = self.pk is not None and (self.keywords, self.expression, self.deleted) != self._counted_definition
+        if changed:
+            self.cached_message_count = None
+        super(Group, self).save(*args, **kwargs)
+        if changed:
+            self.invalidate_message_count()
+        self._counted_definition = (self.keywords, self.expression, self.deleted)
+
+    def delete(self, *args, **kwargs):
+        self.invalidate_message_count()
+        super(Group, self).delete(*args, **kwargs)
+
     @property
     def message_count(self):
-        return self.messages.count()
+        """The number of messages, counted once after each change to the group or its dataset"""
+        if self.cached_message_count is None:
+            if self.expression:
+                self.cached_message_count = len(self.bitmap)
+            else:
+                ids = self.dataset.get_advanced_search_ids(self.keywords, self.include_types.all())
+                self.cached_message_count = len(ids) if ids is not None else self.messages.count()
+            Group.objects.filter(id=self.id).update(cached_message_count=self.cached_message_count)
+        return self.cached_message_count
+
+    def invalidate_message_count(self):
+        """Count the group again, and any group defined by an expression, when they are next used"""
+        self.cached_message_count = None
+        Group.objects.filter(id=self.id).update(cached_message_count=None)
+        Group.objects.filter(dataset_id=self.dataset_id).exclude(expression="").update(cached_message_count=None)
+
+    @classmethod
+    def create_batch(cls, dataset, definitions, owner=None):
+        """
+        Create keyword groups from dictionaries with a ``name``, ``keywords`` and
+        optionally ``types_list``. Their queries are evaluated together
+        (see :func:`msgvis.apps.corpus.keywords.evaluate_many`), and the groups are saved
+        in one transaction with their message counts and membership bitmaps.
+        """
+        import numpy
+        from msgvis.apps.corpus import keywords as keywords_module
+        from msgvis.apps.groups import bitmaps
+
+        results = keywords_module.evaluate_many(dataset, [definition.get('keywords') or "" for definition in definitions])
+
+        # the messages of each combination of types, fetched once
+        typed_ids = {}
+        for definition in definitions:
+            types = tuple(sorted(definition.get('types_list') or []))
+            if len(types) > 0 and types not in typed_ids:
+                ids = dataset.message_set.filter(type__name__in=types).values_list('id', flat=True)
+                typed_ids[types] = numpy.fromiter(ids.iterator(), dtype=numpy.int64)
+
+        message_types = dict((t.name, t) for t in corpus_models.MessageType.objects.all())
+        ordinals = bitmaps.MessageOrdinals.get(dataset)
+
+        order = 0
+        if owner is not None:
+            order = cls.objects.filter(owner=owner, is_search_record=False).count()
+
+        groups = []
+        with transaction.atomic():
+            type_links = []
+            for definition, ids in zip(definitions, results):
+                types = tuple(sorted(definition.get('types_list') or []))
+                if len(types) > 0:
+                    ids = numpy.intersect1d(ids, typed_ids[types], assume_unique=True)
+
+                order += 1
+                group = cls.objects.create(dataset=dataset, owner=owner, name=definition.get('name') or "",
+                                           keywords=definition.get('keywords') or "",
+                                           order=order if owner is not None else 0,
+                                           cached_message_count=len(ids))
+                type_links.extend(cls.include_types.through(group_id=group.id, messagetype_id=message_types[name].id)
+                                  for name in types)
+                groups.append((group, ids))
+
+            cls.include_types.through.objects.bulk_create(type_links)
+
+        for group, ids in groups:
+            bitmaps.store_group_bitmap(group, ids, ordinals)
+        return [group for group, ids in groups]
+
+    @classmethod
+    def invalidate_message_counts(cls, dataset_id):
+        """Count every group of the dataset again, e.g. after importing messages"""
+        cls.objects.filter(dataset_id=dataset_id).update(cached_message_count=None)
 
 
     def __repr__(self):
@@ -2,6 +2,8 @@ from django.test import TestCase
 from msgvis.apps.corpus import models as corpus_models
 from msgvis.apps.groups.models import Group
 from msgvis.apps.enhance import models as enhance_models
+from msgvis.apps.dimensions import registry
+from msgvis.apps.base.tests import PrecalcTestCaseMixins
 
 import json
 
@@ -141,3 +143,209 @@ class GroupTest(TestCase):
 
 
     
+
+
+class GroupBitmapTest(PrecalcTestCaseMixins, TestCase):
+    """Test group membership bitmaps and the overlap of groups"""
+
+    def setUp(self):
+        super(GroupBitmapTest, self).setUp()
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        self.create_word_messages(self.dataset, ['soup', 'ladies', 'food', 'jobs'],
+                                  ["soup ladies", "soup food", "food jobs", "ladies", "nothing"])
+
+        self.soup = Group.objects.create(dataset=self.dataset, name="soup", keywords="soup")
+        self.food = Group.objects.create(dataset=self.dataset, name="food", keywords="food")
+        self.ladies = Group.objects.create(dataset=self.dataset, name="ladies", keywords="ladies")
+
+    def texts(self, group):
+        return sorted(group.messages.values_list('text', flat=True))
+
+    def test_parse_expression(self):
+        """Operators should apply from left to right unless grouped"""
+        from msgvis.apps.groups.bitmaps import parse_expression
+
+        self.assertEquals(parse_expression("#1 & #2 - #3"), ('-', ('&', 1, 2), 3))
+        self.assertEquals(parse_expression("#1&(#2|#3)"), ('&', 1, ('|', 2, 3)))
+        self.assertRaises(ValueError, parse_expression, "#1 &")
+        self.assertRaises(ValueError, parse_expression, "#1 + #2")
+
+    def test_overlap_matrix(self):
+        """The matrix should count the messages in both of each pair of groups"""
+        from msgvis.apps.groups.bitmaps import overlap_matrix
+
+        result = overlap_matrix([self.soup, self.food, self.ladies])
+
+        self.assertEquals(result['counts'], [2, 2, 2])
+        self.assertEquals(result['overlap'], [[2, 1, 1], [1, 2, 0], [1, 0, 2]])
+        self.assertAlmostEquals(result['jaccard'][0][1], 1 / 3.0)
+        self.assertEquals(result['jaccard'][1][2], 0.0)
+
+    def test_derived_groups(self):
+        """Groups defined by expressions should follow changes to their groups"""
+        derived = Group.objects.create(dataset=self.dataset, name="derived",
+                                       expression="(#%d | #%d) - #%d" % (self.soup.id, self.food.id, self.ladies.id))
+        self.assertEquals(self.texts(derived), ["food jobs", "soup food"])
+
+        self.ladies.keywords = "jobs"
+        self.ladies.save()
+        self.assertEquals(self.texts(derived), ["soup food", "soup ladies"])
+
+    def test_deleted_members(self):
+        """Groups that were deleted from an expression should count as empty"""
+        derived = Group.objects.create(dataset=self.dataset, name="derived",
+                                       expression="#%d | #%d" % (self.soup.id, self.food.id))
+        self.assertEquals(derived.message_count, 3)
+
+        self.food.deleted = True
+        self.food.save()
+        derived = Group.objects.get(id=derived.id)
+        self.assertEquals(self.texts(derived), ["soup food", "soup ladies"])
+        self.assertEquals(derived.message_count, 2)
+
+        self.soup.delete()
+        derived = Group.objects.get(id=derived.id)
+        self.assertEquals(self.texts(derived), [])
+        self.assertEquals(derived.message_count, 0)
+
+    def test_ordinals_follow_new_messages(self):
+        """The ordinals should be saved again when messages are added"""
+        from msgvis.apps.groups.bitmaps import MessageOrdinals, get_group_bitmap
+
+        self.assertEquals(len(MessageOrdinals.get(self.dataset)), 5)
+        self.assertEquals(len(get_group_bitmap(self.soup)), 2)
+
+        self.create_word_messages(self.dataset, ['soup'], ["more soup"])
+        self.assertEquals(len(MessageOrdinals.get(self.dataset)), 6)
+        self.assertEquals(len(get_group_bitmap(self.soup)), 3)
+
+
+class GroupMessageCountTest(PrecalcTestCaseMixins, TestCase):
+    """Test the message counts stored with groups"""
+
+    def setUp(self):
+        super(GroupMessageCountTest, self).setUp()
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        self.create_word_messages(self.dataset, ['soup', 'food'], ["soup", "soup food", "food"])
+
+        self.group = Group.objects.create(dataset=self.dataset, name="soup", keywords="soup")
+
+    def test_counted_once(self):
+        """The count should be stored, and listing groups should not search again"""
+        self.assertEquals(self.group.message_count, 2)
+        with self.assertNumQueries(1):
+            counts = [group.message_count for group in Group.objects.filter(dataset=self.dataset)]
+        self.assertEquals(counts, [2])
+
+    def test_invalidated(self):
+        """Changing the keywords, or importing messages, should count the group again"""
+        derived = Group.objects.create(dataset=self.dataset, name="derived", expression="#%d" % self.group.id)
+        self.assertEquals(derived.message_count, 2)
+
+        group = Group.objects.get(id=self.group.id)
+        group.keywords = "food"
+        group.save()
+        self.assertIsNone(Group.objects.get(id=derived.id).cached_message_count)
+        self.assertEquals(group.message_count, 2)
+
+        group.name = "renamed"
+        group.save()
+        self.assertEquals(Group.objects.get(id=self.group.id).cached_message_count, 2)
+
+        Group.invalidate_message_counts(self.dataset.id)
+        self.assertIsNone(Group.objects.get(id=self.group.id).cached_message_count)
+
+
+class GroupBatchTest(PrecalcTestCaseMixins, TestCase):
+    """Test creating many keyword groups at once"""
+
+    def setUp(self):
+        super(GroupBatchTest, self).setUp()
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        tweet = corpus_models.MessageType.objects.create(name="tweet")
+        reply = corpus_models.MessageType.objects.create(name="reply")
+        self.create_word_messages(self.dataset, ['soup', 'ladies', 'food', 'jobs'],
+                                  [("soup ladies", {'type': tweet}), ("soup food", {'type': reply}),
+                                   ("food jobs", {'type': tweet}), ("soup ladies jobs", {'type': reply})])
+
+        self.definitions = [
+            {'name': 'soup', 'keywords': 'soup'},
+            {'name': 'soup ladies', 'keywords': 'soup ladies,NOT jobs'},
+            {'name': 'food tweets', 'keywords': 'food,ladies jobs', 'types_list': ['tweet']},
+            {'name': 'nothing', 'keywords': 'missing'},
+        ]
+
+    def test_create_batch(self):
+        """The groups should be saved with the counts and bitmaps of their own searches"""
+        groups = Group.create_batch(self.dataset, self.definitions)
+
+        self.assertEquals([group.cached_message_count for group in groups], [3, 1, 1, 0])
+        for group in groups:
+            expected = sorted(self.dataset.get_advanced_search_results(group.keywords, group.include_types.all())
+                              .values_list('id', flat=True))
+            self.assertEquals(group.bitmap.ids().tolist(), expected)
+            self.assertEquals(Group.objects.get(id=group.id).message_count, len(expected))
+
+        self.assertEquals(list(groups[2].include_types.values_list('name', flat=True)), ['tweet'])
+
+    def test_evaluate_many(self):
+        """Evaluating the queries together should match evaluating them one at a time"""
+        from msgvis.apps.corpus.keywords import evaluate_many
+
+        queries = ['soup', 'soup ladies', 'soup ladies,NOT jobs', 'ladies soup,food', 'missing']
+        with self.assertNumQueries(3):
+            results = evaluate_many(self.dataset, queries)
+        for query, ids in zip(queries, results):
+            self.assertEquals(ids.tolist(), sorted(self.dataset.get_advanced_search_results(query, [])
+                                                   .values_list('id', flat=True)))
+
+
+class GroupExampleMessagesTest(PrecalcTestCaseMixins, TestCase):
+    """Test paging through example messages of several groups"""
+
+    def setUp(self):
+        from datetime import datetime, timedelta
+        from django.utils import timezone
+
+        super(GroupExampleMessagesTest, self).setUp()
+        self.dataset = corpus_models.Dataset.objects.create(name="Test Corpus", description="My Dataset")
+        start = datetime(2015, 2, 2, tzinfo=timezone.utc)
+        texts = ["soup 1", "soup 2", "soup food 3", "soup 4", "food 5", "soup 6"]
+        self.create_word_messages(self.dataset, ['soup', 'food'],
+                                  [(text, {'time': start + timedelta(hours=i)}) for i, text in enumerate(texts)])
+
+        self.soup = Group.objects.create(dataset=self.dataset, name="soup", keywords="soup")
+        self.food = Group.objects.create(dataset=self.dataset, name="food", keywords="food")
+
+    def test_interleaved_pages(self):
+        """Each page should alternate between the groups, and the cursor should continue each group"""
+        groups = [self.soup.id, self.food.id]
+        page, cursor = self.dataset.get_example_messages_by_groups(groups, page_size=4)
+        self.assertEquals([m.text for m in page], ["soup 1", "food 5", "soup 2"])
+        self.assertIsNone(cursor[self.food.id])
+
+        # the unfinished group gets the whole page
+        page, cursor = self.dataset.get_example_messages_by_groups(groups, cursor=cursor, page_size=4)
+        self.assertEquals([m.text for m in page], ["soup food 3", "soup 4", "soup 6"])
+        self.assertIsNone(cursor)
+
+    def test_cursor_ids(self):
+        """Each group should continue after the id in the cursor, checking only a few ids at a time"""
+        soup_2 = self.dataset.message_set.get(text="soup 2")
+        self.assertEquals(len(self.soup.bitmap), 5)
+        # the group, the data version, the group's types for the bitmap key, the ids after the cursor, the page
+        with self.assertNumQueries(5):
+            page, cursor = self.dataset.get_example_messages_by_groups([self.soup.id], cursor={self.soup.id: soup_2.id},
+                                                                       page_size=1)
+        self.assertEquals([m.text for m in page], ["soup food 3"])
+        self.assertEquals(cursor, {self.soup.id: page[0].id})
+
+    def test_filters(self):
+        """Filters should apply to the group messages, and excluded groups should not be shown"""
+        time = registry.get_dimension('time')
+        filters = [{'dimension': time, 'min_time': self.dataset.message_set.get(text="soup 2").time}]
+        excludes = [{'dimension': registry.get_dimension('groups'), 'value': self.food.id}]
+        page, cursor = self.dataset.get_example_messages_by_groups([self.soup.id, self.food.id], filters, excludes,
+                                                                   page_size=2)
+        self.assertEquals([m.text for m in page], ["soup 2", "soup food 3"])
+        self.assertEquals(cursor.keys(), [self.soup.id])
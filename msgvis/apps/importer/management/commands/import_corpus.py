@@ -3,7 +3,13 @@ from msgvis.apps.importer.models import create_an_instance_from_json
 from optparse import make_option
 
 from msgvis.apps.corpus.models import Dataset
-from django.db import transaction
+from msgvis.apps.corpus import utils as corpus_utils
+from msgvis.apps.enhance.models import HeavyHitterSketch
+from msgvis.apps.enhance.sketches import SpaceSaving
+from msgvis.apps.enhance import tasks as enhance_tasks
+from msgvis.apps.groups.models import Group
+from msgvis.apps.groups.bitmaps import MessageOrdinals
+from django.db import transaction, connection
 import traceback
 import sys
 import path
@@ -60,6 +66,12 @@ class Command(BaseCommand):
                 importer = Importer(fp, dataset_obj)
                 importer.run()
 
+                with transaction.atomic(savepoint=False):
+                    HeavyHitterSketch.save_counts(dataset_obj, importer.sketches)
+
+                    # the groups may have new messages
+                    Group.invalidate_message_counts(dataset_obj.id)
+
                 min_time, max_time = importer.get_time_range()
 
                 if min_time is not None and \
@@ -72,8 +84,28 @@ class Command(BaseCommand):
                      or dataset_obj.end_time < max_time):
                     dataset_obj.end_time = max_time
 
+        # the importer updates people after their earlier messages were saved
+        with transaction.atomic(savepoint=False):
+            corpus_utils.refresh_sender_counters(connection, dataset_obj.id)
+
         dataset_obj.save()
 
+        # the cumulative time counts are only read from files, so they must be rebuilt
+        enhance_tasks.refresh_time_prefix_sums(dataset_obj.id)
+
+        # time charts are answered from the rollups without looking at the messages
+        with transaction.atomic(savepoint=False):
+            enhance_tasks.refresh_time_rollups(dataset_obj.id)
+            enhance_tasks.refresh_distinct_sketches(dataset_obj.id)
+
+        # approximate tables would leave out the new messages
+        with transaction.atomic(savepoint=False):
+            enhance_tasks.refresh_message_samples(dataset_obj.id)
+
+        # the group bitmaps need ordinals for the new messages
+        if MessageOrdinals.load(dataset_obj.id) is not None:
+            MessageOrdinals.build(dataset_obj)
+
         print "Dataset '%s' (%d) contains %d messages spanning %s, from %s to %s" % (
             dataset_obj.name, dataset_obj.id, dataset_obj.message_set.count(),
             dataset_obj.end_time - dataset_obj.start_time,
@@ -97,7 +129,12 @@ class Importer(object):
         self.min_time = None
         self.max_time = None
 
+        # words are counted when the tweet parser results are imported
+        self.sketches = dict((key, SpaceSaving(settings.HEAVY_HITTER_CAPACITY))
+                             for key in settings.HEAVY_HITTER_DIMENSIONS if key != 'words')
+
     def _import_group(self, lines):
+        message_ids = []
         with transaction.atomic(savepoint=False):
             for json_str in lines:
 
@@ -106,6 +143,7 @@ class Importer(object):
                         message = create_an_instance_from_json(json_str, self.dataset)
                         if message:
                             self.imported += 1
+                            message_ids.append(message.id)
 
                             if self.min_time is None or self.min_time > message.time:
                                 self.min_time = message.time
@@ -118,6 +156,9 @@ class Importer(object):
                         print >> sys.stderr, "Import error on line %d" % self.line
                         traceback.print_exc()
 
+        if len(message_ids) > 0:
+            HeavyHitterSketch.count_messages(self.dataset.message_set.filter(id__in=message_ids), self.sketches)
+
         #if settings.DEBUG:
             # prevent memory leaks
         #    from django.db import connection
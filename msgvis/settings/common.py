@@ -293,12 +293,25 @@ LOGGING = {
             'filename': LOGS_ROOT / 'django.db.log',
             'level': 'DEBUG',
         },
+        'slow_tables_handler': {
+            # one JSON object per slow data table request
+            'class': 'logging.FileHandler',
+            'filename': LOGS_ROOT / 'slow_tables.log',
+            'level': 'INFO',
+            # only create the file once a slow request is logged
+            'delay': True,
+        },
     },
     'loggers': {
         'msgvis': {
             'handlers': ['console'],
             'level': 'WARNING',
         },
+        'msgvis.slow_tables': {
+            'handlers': ['slow_tables_handler'],
+            'level': 'INFO',
+            'propagate': False,
+        },
         'django.request': {
             'handlers': ['mail_admins'],
             'level': 'ERROR',
@@ -432,5 +445,67 @@ TWITTER_ACCESS_TOKEN_SECRET = get_env_setting('TWITTER_ACCESS_TOKEN_SECRET', '')
 
 ######### DIMENSION SETTINGS
 QUANTITATIVE_DIMENSION_BINS = 50
+
+# Pairs of categorical dimensions whose 2-D distributions are precalculated
+PRECALC_DIMENSION_PAIRS = (
+    ('hashtags', 'type'),
+    ('hashtags', 'sentiment'),
+    ('sender', 'type'),
+    ('sender', 'sentiment'),
+    ('mentions', 'type'),
+    ('urls', 'type'),
+)
+
+# Low-cardinality dimensions that are split out in the time rollups
+TIME_ROLLUP_DIMENSIONS = ('type', 'sentiment', 'language')
+
+# Dimensions with memory-mapped cumulative time counts for fast time-range brushing
+TIME_PREFIX_SUM_DIMENSIONS = ('type', 'sentiment', 'language',
+                              'contains_hashtag', 'contains_url', 'contains_media', 'contains_mention')
+TIME_PREFIX_SUM_MAX_BINS = 2 ** 18
+
+# High-cardinality dimensions whose most frequent levels are tracked in heavy-hitter sketches
+HEAVY_HITTER_DIMENSIONS = ('words', 'hashtags', 'mentions', 'sender', 'urls')
+# The number of counters in each sketch
+HEAVY_HITTER_CAPACITY = 10000
+# Recount the candidate top levels exactly in the database
+HEAVY_HITTER_EXACT_RECOUNT = True
+
+# The number of index bits in the HyperLogLog sketches of approximate distinct count measures
+HYPERLOGLOG_PRECISION = 11
+# Approximate distinct count measures whose sketches are precalculated for each time bin
+DISTINCT_SKETCH_MEASURES = ('sender_count_approx', 'hashtag_count_approx')
+# The time bin size (in seconds) of the precalculated sketches
+DISTINCT_SKETCH_BIN_SIZE = 3600
+
+# The default sampling rate for approximate data tables
+APPROXIMATE_SAMPLE_RATE = 0.01
+
+# Where precalculated files (e.g. the cumulative time counts) are saved
+PRECALC_ROOT = get_env_setting('PRECALC_ROOT', PROJECT_ROOT / 'precalc')
+
+# Filters on more levels than this are loaded into a temporary table instead of an IN list
+LEVEL_FILTER_TEMP_TABLE_THRESHOLD = 500
+
+# Data table requests that take longer than this many seconds are written to logs/slow_tables.log
+DATATABLE_SLOW_REQUEST_SECONDS = 5.0
+
+# How long the data table planner trusts its dataset statistics, in seconds
+DATASET_STATISTICS_SECONDS = 300
+
+# Live data table results estimated to read at least this many rows are cached for a while
+DATATABLE_RESULT_CACHE_MIN_COST = 100000
+DATATABLE_RESULT_CACHE_SECONDS = 600
+
+# Each session remembers the message ids of its last few keyword searches (in each process),
+# unless a search matches more than SEARCH_HISTORY_MAX_IDS messages.
+# The oldest searches are forgotten when all sessions together remember more than SEARCH_HISTORY_MAX_TOTAL_IDS ids.
+SEARCH_HISTORY_SIZE = 10
+SEARCH_HISTORY_SESSIONS = 100
+SEARCH_HISTORY_MAX_IDS = 100000
+SEARCH_HISTORY_MAX_TOTAL_IDS = 1000000
+
+# How long group membership bitmaps are cached (editing a group invalidates its bitmap)
+GROUP_BITMAP_CACHE_SECONDS = 3600
 ######### END DIMENSION SETTINGS
 